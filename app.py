@@ -0,0 +1,304 @@
+import os
+import logging
+import asyncio
+import hashlib
+import hmac
+import json
+import uuid
+import urllib.parse
+
+import aiohttp.web
+
+# Konfigurasi antrian, kunci job, dan broker dipakai bersama dengan bot.py (handler Telegram dan worker).
+# Gateway tidak mengimpor bot.py: tidak butuh kredensial Telegram, Pyrogram, atau direktori unduhan.
+from broker import BROKER_URL, MAX_JOBS_PER_CHAT, MAX_QUEUE_SIZE, create_job_broker, download_coalesce_key
+
+logging.basicConfig(format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s', level=logging.INFO)
+
+# --- Konfigurasi Gateway HTTP ---
+# Dijalankan lewat server.py (gunicorn, worker aiohttp.GunicornWebWorker). Job dari API masuk ke broker
+# yang sama (BROKER_URL) dengan handler /download mode frontend, lalu diambil worker bot
+# (BOT_ROLE=worker, atau mode all dengan BOT_CONSUME_BROKER=true). Hasil dikirim ke chat_id Telegram.
+# Token Bearer untuk API; kosong = tanpa autentikasi (hanya untuk jaringan internal)
+GATEWAY_API_TOKEN = os.environ.get("GATEWAY_API_TOKEN", "")
+# Jumlah URL maksimum per job (lebih dari satu URL = batch/album)
+GATEWAY_MAX_URLS = int(os.environ.get("GATEWAY_MAX_URLS", 50))
+# Interval polling status job di broker (detik); satu poller per proses dipakai bersama semua klien
+GATEWAY_POLL_INTERVAL = float(os.environ.get("GATEWAY_POLL_INTERVAL", 1.0))
+# Batas waktu tunggu long-poll GET /api/jobs/{job_id}?wait= (detik)
+GATEWAY_LONG_POLL_TIMEOUT = float(os.environ.get("GATEWAY_LONG_POLL_TIMEOUT", 30))
+# Interval komentar keep-alive pada stream SSE (detik) agar proxy tidak menutup koneksi
+GATEWAY_SSE_KEEPALIVE = float(os.environ.get("GATEWAY_SSE_KEEPALIVE", 15))
+# Durasi maksimum satu koneksi SSE (detik); klien menyambung ulang jika job belum selesai
+GATEWAY_SSE_MAX_SECONDS = float(os.environ.get("GATEWAY_SSE_MAX_SECONDS", 3600))
+
+BROKER_KEY = aiohttp.web.AppKey("broker", object)
+WATCHER_KEY = aiohttp.web.AppKey("watcher", object)
+
+
+def status_version(status):
+    """
+    Versi status job untuk long-poll/SSE: hanya berubah jika state atau teks status berubah
+    (heartbeat worker memperbarui updated_at tanpa mengubah isi).
+    """
+    if status is None:
+        return None
+    return hashlib.sha1(f"{status['state']}|{status['status_text']}".encode()).hexdigest()[:12]
+
+
+def status_payload(status):
+    return dict(status, version=status_version(status))
+
+
+# --- Pemantau Status Job ---
+class JobStatusWatcher:
+    """
+    Satu task per proses yang membaca status job yang sedang ditunggu klien (long-poll/SSE) dari broker,
+    sehingga banyak klien untuk job yang sama tidak masing-masing mem-polling broker.
+    """
+    def __init__(self, broker, interval):
+        self.broker = broker
+        self.interval = interval
+        self._watched = {} # job_id -> {"status", "changed" (asyncio.Event), "clients"}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def wait_change(self, job_id, known_status, timeout):
+        """
+        Menunggu sampai versi status job berbeda dari known_status (maksimal timeout detik).
+        Mengembalikan status terbaru (known_status jika tidak berubah), atau None jika job sudah tidak ada di broker.
+        """
+        known_version = status_version(known_status)
+        entry = self._watched.setdefault(job_id, {"status": None, "changed": asyncio.Event(), "clients": 0})
+        entry["clients"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                status = entry["status"]
+                if status is not None and status_version(status) != known_version:
+                    return status
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return status or known_status
+                try:
+                    await asyncio.wait_for(entry["changed"].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                if entry.get("gone"):
+                    return None
+        finally:
+            entry["clients"] -= 1
+            if entry["clients"] <= 0:
+                self._watched.pop(job_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for job_id, entry in list(self._watched.items()):
+                try:
+                    status = await self.broker.status(job_id)
+                except Exception as e:
+                    logging.warning(f"Gagal membaca status job {job_id} dari broker: {e}")
+                    continue
+                if status is None:
+                    entry["gone"] = True
+                elif status == entry["status"]:
+                    continue
+                entry["status"] = status
+                # Event lama dibangunkan lalu diganti, klien berikutnya menunggu perubahan selanjutnya
+                changed, entry["changed"] = entry["changed"], asyncio.Event()
+                changed.set()
+
+
+# --- Autentikasi dan Validasi ---
+@aiohttp.web.middleware
+async def auth_middleware(request, handler):
+    """
+    Memeriksa header Authorization: Bearer <GATEWAY_API_TOKEN> untuk semua route /api/.
+    """
+    if GATEWAY_API_TOKEN and request.path.startswith("/api/"):
+        authorization = request.headers.get("Authorization", "")
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+        if not hmac.compare_digest(token.encode(), GATEWAY_API_TOKEN.encode()):
+            return aiohttp.web.json_response({"error": "Token API tidak valid."}, status=401)
+    return await handler(request)
+
+
+def parse_job_request(body):
+    """
+    Memvalidasi body POST /api/jobs. Mengembalikan ((chat_id, urls), None) atau (None, pesan error).
+    """
+    if not isinstance(body, dict):
+        return None, "Body harus objek JSON."
+    chat_id = body.get("chat_id")
+    if isinstance(chat_id, bool) or not isinstance(chat_id, int):
+        return None, "chat_id (integer, chat Telegram tujuan hasil unduhan) wajib diisi."
+    urls = body.get("urls")
+    if urls is None and body.get("url") is not None:
+        urls = [body["url"]]
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return None, "url (string) atau urls (daftar string) wajib diisi."
+    # Sama seperti /download: URL duplikat dibuang dengan urutan tetap
+    urls = list(dict.fromkeys(url.strip() for url in urls if url.strip()))
+    if not urls:
+        return None, "url (string) atau urls (daftar string) wajib diisi."
+    if len(urls) > GATEWAY_MAX_URLS:
+        return None, f"Maksimal {GATEWAY_MAX_URLS} URL per job."
+    for url in urls:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            return None, f"URL tidak valid: {url}"
+    return (chat_id, urls), None
+
+
+# --- Handler API ---
+async def submit_job_handler(request):
+    """
+    POST /api/jobs: {"chat_id": 123, "url": "..."} atau {"chat_id": 123, "urls": [...]}.
+    Mengantrikan job di broker; 202 dengan job_id dan posisi antrian, 429 jika kuota/antrian penuh.
+    """
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return aiohttp.web.json_response({"error": "Body bukan JSON yang valid."}, status=400)
+    parsed, error_message = parse_job_request(body)
+    if error_message:
+        return aiohttp.web.json_response({"error": error_message}, status=400)
+    chat_id, urls = parsed
+
+    # Kunci coalesce ikut disimpan agar permintaan /download yang sama dari Telegram bisa menumpang ke job ini
+    coalesce_key = download_coalesce_key(urls[0]) if len(urls) == 1 else None
+    job_id = uuid.uuid4().hex[:12]
+    broker = request.app[BROKER_KEY]
+    # Tanpa pesan status: worker mengirim pesan status baru ke chat saat job diambil
+    position, error_message = await broker.enqueue(
+        job_id, coalesce_key, chat_id, urls, None, MAX_JOBS_PER_CHAT, MAX_QUEUE_SIZE
+    )
+    if error_message:
+        logging.warning(f"Job API untuk {urls} ke chat {chat_id} ditolak: {error_message}")
+        return aiohttp.web.json_response({"error": error_message}, status=429)
+    logging.info(f"Job API {job_id} ({len(urls)} URL) ke chat {chat_id} masuk broker, posisi {position}.")
+    return aiohttp.web.json_response(
+        {
+            "job_id": job_id,
+            "position": position,
+            "status_url": f"/api/jobs/{job_id}",
+            "events_url": f"/api/jobs/{job_id}/events",
+        },
+        status=202,
+    )
+
+
+async def job_status_handler(request):
+    """
+    GET /api/jobs/{job_id}: status job. Long-poll dengan ?wait=<detik>&version=<versi terakhir>:
+    respons ditahan sampai status berubah dari versi tersebut atau waktu tunggu habis.
+    """
+    job_id = request.match_info["job_id"]
+    status = await request.app[BROKER_KEY].status(job_id)
+    if status is None:
+        return aiohttp.web.json_response({"error": "Job tidak ditemukan."}, status=404)
+
+    known_version = request.query.get("version")
+    try:
+        wait = min(float(request.query.get("wait", 0)), GATEWAY_LONG_POLL_TIMEOUT)
+    except ValueError:
+        return aiohttp.web.json_response({"error": "wait harus berupa angka (detik)."}, status=400)
+    if wait > 0 and known_version == status_version(status) and status["state"] != "done":
+        status = await request.app[WATCHER_KEY].wait_change(job_id, status, wait)
+        if status is None:
+            return aiohttp.web.json_response({"error": "Job tidak ditemukan."}, status=404)
+    return aiohttp.web.json_response(status_payload(status))
+
+
+async def job_events_handler(request):
+    """
+    GET /api/jobs/{job_id}/events: stream Server-Sent Events. Event "status" dikirim setiap status berubah,
+    stream ditutup setelah job selesai (state done).
+    """
+    job_id = request.match_info["job_id"]
+    status = await request.app[BROKER_KEY].status(job_id)
+    if status is None:
+        return aiohttp.web.json_response({"error": "Job tidak ditemukan."}, status=404)
+
+    response = aiohttp.web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no", # Nonaktifkan buffering nginx agar event langsung sampai
+    })
+    await response.prepare(request)
+    watcher = request.app[WATCHER_KEY]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GATEWAY_SSE_MAX_SECONDS
+    version = None
+    try:
+        while status is not None and loop.time() < deadline:
+            if status_version(status) != version:
+                version = status_version(status)
+                await response.write(f"event: status\nid: {version}\ndata: {json.dumps(status_payload(status))}\n\n".encode())
+                if status["state"] == "done":
+                    break
+            else:
+                await response.write(b": keep-alive\n\n")
+            status = await watcher.wait_change(job_id, status, min(GATEWAY_SSE_KEEPALIVE, max(0, deadline - loop.time())))
+    except ConnectionResetError:
+        return response # Klien menutup koneksi
+    await response.write_eof()
+    return response
+
+
+async def health_handler(request):
+    """
+    Readiness gateway: siap jika broker terhubung.
+    """
+    broker = request.app.get(BROKER_KEY)
+    ready = broker is not None and broker.connected
+    return aiohttp.web.json_response({"broker_connected": ready, "ready": ready}, status=200 if ready else 503)
+
+
+# --- Siklus Hidup Aplikasi ---
+async def open_broker(application):
+    broker = create_job_broker(BROKER_URL)
+    await broker.open()
+    application[BROKER_KEY] = broker
+    watcher = JobStatusWatcher(broker, GATEWAY_POLL_INTERVAL)
+    watcher.start()
+    application[WATCHER_KEY] = watcher
+    if not GATEWAY_API_TOKEN:
+        logging.warning("GATEWAY_API_TOKEN tidak disetel: API gateway terbuka tanpa autentikasi.")
+    logging.info(f"Gateway HTTP siap (broker {BROKER_URL}).")
+
+
+async def close_broker(application):
+    watcher = application.get(WATCHER_KEY)
+    if watcher is not None:
+        await watcher.stop()
+    broker = application.get(BROKER_KEY)
+    if broker is not None:
+        await broker.close()
+
+
+def create_app():
+    """
+    Membuat aiohttp Application gateway (dipanggil gunicorn lewat app:app).
+    """
+    application = aiohttp.web.Application(middlewares=[auth_middleware])
+    application.on_startup.append(open_broker)
+    application.on_cleanup.append(close_broker)
+    application.router.add_post("/api/jobs", submit_job_handler)
+    application.router.add_get("/api/jobs/{job_id}", job_status_handler)
+    application.router.add_get("/api/jobs/{job_id}/events", job_events_handler)
+    application.router.add_get("/health", health_handler)
+    return application
+
+
+app = create_app()
@@ -0,0 +1,414 @@
+"""
+Benchmark offline untuk bot: menjalankan handle_download_command dengan Client/Message Pyrogram palsu
+dan executable yt-dlp tiruan, tanpa menyentuh Telegram atau situs video sungguhan.
+
+Contoh:
+    python benchmark.py --concurrency 1,10,50,100,500 --file-size-mb 5 --download-speed-mb 50
+
+Laporan per tingkat konkurensi: jobs/detik, latensi end-to-end p50/p99, puncak RSS (bot + semua proses
+anak), jumlah edit pesan per job, dan puncak pemakaian disk di DOWNLOAD_DIR.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import types
+
+FAKE_YTDLP_FLAG = "--fake-ytdlp"
+RESULT_PREFIX = "__BOT_RESULT__ "
+
+
+# --- yt-dlp Tiruan ---
+def run_fake_ytdlp(argv):
+    """
+    Meniru output yt-dlp yang dipakai bot: baris progres %(progress)j di stdout, file hasil di path -o,
+    lalu baris --print after_move dengan metadata JSON. Ukuran dan kecepatan diatur lewat environment.
+    """
+    file_size = int(os.environ.get("BENCH_FILE_SIZE", 5 * 1024 * 1024))
+    speed = float(os.environ.get("BENCH_DOWNLOAD_SPEED", 50 * 1024 * 1024))
+    extract_delay = float(os.environ.get("BENCH_EXTRACT_DELAY", 0.2))
+    fail_every = int(os.environ.get("BENCH_FAIL_EVERY", 0))
+
+    output_template = argv[argv.index("-o") + 1] if "-o" in argv else "%(title)s.%(ext)s"
+    if output_template == "-":
+        output_template = "%(title)s.%(ext)s"
+    if not os.path.isabs(output_template):
+        # Jangan pernah menulis ke direktori kerja (repo): path relatif diarahkan ke DOWNLOAD_DIR
+        # benchmark yang ada di dalam TemporaryDirectory
+        output_template = os.path.join(os.environ["DOWNLOAD_DIR"], output_template)
+    if "--load-info-json" in argv:
+        # Unduhan memakai metadata hasil probe: tanpa jeda ekstraksi
+        with open(argv[argv.index("--load-info-json") + 1], encoding="utf-8") as info_file:
+            url = json.load(info_file)["webpage_url"]
+        extract_delay = 0
+    else:
+        url = argv[-1]
+    video_id = url.rsplit("=", 1)[-1]
+    if fail_every and (int(video_id.rsplit("-", 1)[-1]) + 1) % fail_every == 0: # Indeks mulai dari 0: request ke-N = indeks N-1
+        sys.stderr.write(f"ERROR: [generic] {video_id}: Simulated failure\n")
+        return 1
+
+    time.sleep(extract_delay)
+    info = {
+        "id": video_id, "title": f"bench-{video_id}", "ext": "mp4", "duration": 60, "width": 1280, "height": 720,
+        "extractor_key": "Generic", "webpage_url": url, "format_id": "18",
+    }
+    if "-j" in argv:
+        # Ekspansi batch / resolve aria2c RPC: hanya metadata, tanpa unduhan
+        sys.stdout.write(json.dumps(dict(info, url=url)) + "\n")
+        return 0
+    if "-J" in argv:
+        # Tahap probe bot: metadata dengan satu format pre-muxed berukuran file simulasi
+        formats = [{"format_id": "18", "ext": "mp4", "vcodec": "avc1", "acodec": "mp4a", "height": 720, "filesize": file_size, "url": url, "protocol": "https"}]
+        sys.stdout.write(json.dumps(dict(info, formats=formats)) + "\n")
+        return 0
+    file_path = output_template.replace("%(title)s", info["title"]).replace("%(ext)s", info["ext"])
+    part_path = f"{file_path}.part"
+    chunk = b"\0" * min(1024 * 1024, max(1, file_size))
+    started_at = time.monotonic()
+    downloaded = 0
+    with open(part_path, "wb") as part_file:
+        while downloaded < file_size:
+            data = chunk[:file_size - downloaded]
+            part_file.write(data)
+            downloaded += len(data)
+            elapsed = time.monotonic() - started_at
+            # Tahan laju tulis agar sesuai kecepatan unduh yang disimulasikan
+            target_elapsed = downloaded / speed
+            if target_elapsed > elapsed:
+                time.sleep(target_elapsed - elapsed)
+                elapsed = target_elapsed
+            progress = {
+                "status": "downloading", "downloaded_bytes": downloaded, "total_bytes": file_size,
+                "speed": downloaded / elapsed if elapsed else None,
+                "eta": (file_size - downloaded) / speed, "elapsed": elapsed, "filename": part_path,
+            }
+            sys.stdout.write(json.dumps(progress) + "\n")
+            sys.stdout.flush()
+    os.replace(part_path, file_path)
+    sys.stdout.write(json.dumps({"status": "finished", "downloaded_bytes": file_size, "total_bytes": file_size, "filename": file_path}) + "\n")
+    sys.stdout.write(RESULT_PREFIX + json.dumps(dict(info, filepath=file_path, filesize=file_size)) + "\n")
+    sys.stdout.flush()
+    return 0
+
+
+# --- Pyrogram Tiruan ---
+class FakeMessage:
+    """
+    Pesan Telegram palsu: hanya atribut dan method yang dipakai handler/bot.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, client, chat_id, text="", command=None):
+        self.id = next(self._ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.command = command
+        self._client = client
+        self.document = None
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        client = self._client
+        client.edit_calls += 1
+        await asyncio.sleep(client.api_latency)
+        self.text = text
+        if text.startswith("❌"):
+            client.on_failed(self, text)
+        return self
+
+
+class FakeClient:
+    """
+    Client Pyrogram palsu yang mencatat pemanggilan API dan menyimulasikan latensi/kecepatan upload.
+    """
+    def __init__(self, api_latency, upload_speed):
+        self.api_latency = api_latency
+        self.upload_speed = upload_speed
+        self.edit_calls = 0
+        self.send_calls = 0
+        self.on_delivered = lambda caption: None
+        self.on_failed = lambda message, text: None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.send_calls += 1
+        await asyncio.sleep(self.api_latency)
+        return FakeMessage(self, chat_id, text)
+
+    async def send_document(self, chat_id, document, caption="", progress=None, **kwargs):
+        self.send_calls += 1
+        file_size = os.path.getsize(document)
+        await asyncio.sleep(self.api_latency + file_size / self.upload_speed)
+        if progress is not None:
+            await progress(file_size, file_size)
+        return self._delivered(chat_id, caption)
+
+    async def send_cached_media(self, chat_id, file_id, caption="", **kwargs):
+        self.send_calls += 1
+        await asyncio.sleep(self.api_latency)
+        return self._delivered(chat_id, caption)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.send_calls += 1
+        upload_bytes = sum(os.path.getsize(item.media) for item in media if os.path.exists(item.media))
+        await asyncio.sleep(self.api_latency + upload_bytes / self.upload_speed)
+        return [self._delivered(chat_id, item.caption) for item in media]
+
+    def _delivered(self, chat_id, caption):
+        sent_message = FakeMessage(self, chat_id, caption)
+        sent_message.document = types.SimpleNamespace(file_id=f"file-{sent_message.id}", file_unique_id=f"unique-{sent_message.id}")
+        self.on_delivered(caption)
+        return sent_message
+
+
+# --- Sampler RSS dan Disk ---
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _process_tree_rss(root_pid):
+    # Jumlah RSS proses bot + semua turunannya (subprocess yt-dlp, worker pool)
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                parent_pid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(entry))
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += _rss_bytes(pid)
+        stack.extend(children.get(pid, ()))
+    return total
+
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass # File bisa dihapus/dipindah saat dipindai
+    return total
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Mencatat puncak RSS dan puncak pemakaian disk selama satu putaran benchmark.
+    """
+    def __init__(self, download_dir, interval):
+        super().__init__(daemon=True)
+        self.download_dir = download_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        pid = os.getpid()
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, _process_tree_rss(pid))
+            self.peak_disk = max(self.peak_disk, _directory_size(self.download_dir))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+# --- Jalannya Benchmark ---
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def run_level(bot, concurrency, args, run_index):
+    """
+    Mengirim `concurrency` perintah /download sekaligus dan menunggu semuanya selesai (atau timeout).
+    """
+    client = FakeClient(args.api_latency, args.upload_speed_mb * 1024 * 1024)
+    started = {}
+    finished = {}
+    status_to_url = {}
+
+    def on_delivered(caption):
+        for url in started:
+            if url in caption and url not in finished:
+                finished[url] = (time.monotonic(), True)
+                break
+
+    def on_failed(message, text):
+        url = status_to_url.get(message.id)
+        if url is not None and url not in finished:
+            finished[url] = (time.monotonic(), False)
+
+    client.on_delivered = on_delivered
+    client.on_failed = on_failed
+    all_done = asyncio.Event()
+
+    async def one_request(index):
+        url = f"https://bench.invalid/watch?v=r{run_index}-{index}"
+        chat_id = 1000 + index % args.chats if args.chats else 1000 + index
+        command_message = FakeMessage(client, chat_id, f"/download {url}", ["download", url])
+        started[url] = time.monotonic()
+        original_reply_text = command_message.reply_text
+
+        async def reply_text(text, **kwargs):
+            status_message = await original_reply_text(text, **kwargs)
+            status_to_url[status_message.id] = url
+            return status_message
+        command_message.reply_text = reply_text
+        await bot.handle_download_command(client, command_message)
+
+    async def wait_all():
+        while len(finished) < concurrency:
+            await asyncio.sleep(0.05)
+        all_done.set()
+
+    sampler = ResourceSampler(bot.DOWNLOAD_DIR, args.sample_interval)
+    sampler.start()
+    wall_started = time.monotonic()
+    await asyncio.gather(*[one_request(index) for index in range(concurrency)])
+    try:
+        await asyncio.wait_for(wait_all(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    wall = time.monotonic() - wall_started
+    sampler.stop()
+
+    latencies = [finished[url][0] - started[url] for url in finished]
+    succeeded = sum(1 for _, ok in finished.values() if ok)
+    return {
+        "concurrency": concurrency,
+        "completed": len(finished),
+        "succeeded": succeeded,
+        "failed": len(finished) - succeeded,
+        "timed_out": concurrency - len(finished),
+        "wall_seconds": wall,
+        "jobs_per_second": len(finished) / wall if wall else 0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p99": percentile(latencies, 0.99),
+        "peak_rss_mib": sampler.peak_rss / 1024 / 1024,
+        "edits_per_job": client.edit_calls / concurrency,
+        "peak_disk_mib": sampler.peak_disk / 1024 / 1024,
+    }
+
+
+def print_report(results):
+    header = f"{'conc':>5} {'ok':>5} {'fail':>5} {'t/o':>5} {'wall s':>8} {'jobs/s':>8} {'p50 s':>8} {'p99 s':>8} {'RSS MiB':>9} {'edit/job':>9} {'disk MiB':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['concurrency']:>5} {r['succeeded']:>5} {r['failed']:>5} {r['timed_out']:>5} {r['wall_seconds']:>8.2f} "
+            f"{r['jobs_per_second']:>8.2f} {r['latency_p50']:>8.2f} {r['latency_p99']:>8.2f} {r['peak_rss_mib']:>9.1f} "
+            f"{r['edits_per_job']:>9.2f} {r['peak_disk_mib']:>9.1f}"
+        )
+
+
+def prepare_environment(args, work_dir):
+    """
+    Menyiapkan environment sebelum bot diimpor: konfigurasi dibaca bot saat import.
+    """
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    stub_path = os.path.join(bin_dir, "yt-dlp")
+    with open(stub_path, "w") as stub_file:
+        stub_file.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} {FAKE_YTDLP_FLAG} \"$@\"\n")
+    os.chmod(stub_path, 0o755)
+
+    os.environ.update({
+        "API_ID": "1",
+        "API_HASH": "benchmark",
+        "BOT_TOKEN": "1:benchmark",
+        "DOWNLOAD_DIR": os.path.join(work_dir, "downloads"),
+        "DATA_DIR": os.path.join(work_dir, "data"),
+        "RESULT_CACHE_ENABLED": "false", # Setiap request harus benar-benar melewati pipeline unduhan
+        "STREAMING_UPLOAD_ENABLED": "false", # Upload streaming butuh sesi MTProto sungguhan
+        "UPLOAD_PART_WORKERS": "0", # Uploader part paralel juga butuh sesi MTProto; pakai jalur send_* Pyrogram
+        "YTDLP_ENGINE": "subprocess",
+        "MAX_CONCURRENT_DOWNLOADS": str(args.workers),
+    })
+    # Antrian harus muat semua request di tingkat konkurensi tertinggi kecuali disetel sendiri
+    os.environ.setdefault("MAX_QUEUE_SIZE", str(max(args.concurrency)))
+    # Timeline job (JSON lines) ditulis ke file agar tidak bercampur dengan laporan di stdout
+    os.environ.setdefault("TRACE_LOG_PATH", os.path.join(work_dir, "traces.jsonl"))
+    os.environ["BENCH_FILE_SIZE"] = str(int(args.file_size_mb * 1024 * 1024))
+    os.environ["BENCH_DOWNLOAD_SPEED"] = str(args.download_speed_mb * 1024 * 1024)
+    os.environ["BENCH_EXTRACT_DELAY"] = str(args.extract_delay)
+    os.environ["BENCH_FAIL_EVERY"] = str(args.fail_every)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+
+async def run_benchmark(args):
+    import logging
+    import bot # Diimpor setelah environment siap
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bot.download_scheduler.start()
+    bot.progress_updater.start()
+    results = []
+    try:
+        for run_index, concurrency in enumerate(args.concurrency):
+            results.append(await run_level(bot, concurrency, args, run_index))
+    finally:
+        await bot.download_scheduler.stop()
+        await bot.progress_updater.stop()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline bot downloader (Telegram dan yt-dlp tiruan).")
+    parser.add_argument("--concurrency", type=lambda value: [int(part) for part in value.split(",")], default=[1, 10, 50, 100, 500],
+                        help="Daftar jumlah request bersamaan, dipisah koma (default: 1,10,50,100,500)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 3)), help="MAX_CONCURRENT_DOWNLOADS bot")
+    parser.add_argument("--chats", type=int, default=0, help="Jumlah chat berbeda (0 = satu chat per request)")
+    parser.add_argument("--file-size-mb", type=float, default=5, help="Ukuran file yang ditulis yt-dlp tiruan")
+    parser.add_argument("--download-speed-mb", type=float, default=50, help="Kecepatan unduh simulasi (MiB/s per job)")
+    parser.add_argument("--upload-speed-mb", type=float, default=20, help="Kecepatan upload simulasi (MiB/s per upload)")
+    parser.add_argument("--extract-delay", type=float, default=0.2, help="Waktu ekstraksi simulasi per job (detik)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Latensi simulasi setiap panggilan API Telegram (detik)")
+    parser.add_argument("--fail-every", type=int, default=0, help="Gagalkan setiap request ke-N (0 = tidak ada)")
+    parser.add_argument("--timeout", type=float, default=600, help="Batas waktu per tingkat konkurensi (detik)")
+    parser.add_argument("--sample-interval", type=float, default=0.2, help="Interval sampling RSS/disk (detik)")
+    parser.add_argument("--json", action="store_true", help="Cetak hasil sebagai JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as work_dir:
+        prepare_environment(args, work_dir)
+        results = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == FAKE_YTDLP_FLAG:
+        sys.exit(run_fake_ytdlp(sys.argv[2:]))
+    main()
@@ -5,17 +5,39 @@ import json
 import sys
 import asyncio
 import shutil
-import re # Impor modul regex (mungkin tidak lagi utama jika menggunakan progres JSON, tapi jaga jika perlu parsing lain)
+import collections
+import contextvars
+import uuid
+import sqlite3
+import hashlib
+import threading
+import time
+import socket
+import re
+import urllib.parse
 
 # Impor dari Pyrogram
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from pyrogram.enums import ParseMode # Import ParseMode untuk formatting pesan
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session # Session media untuk upload part langsung (mode streaming)
+from pyrogram import raw, utils as pyrogram_utils, types as pyrogram_types
+from pyrogram.file_id import FileId, FileType # Jenis media file_id hasil cache (album batch)
 
 # Impor aiohttp untuk server health check
 import aiohttp
 import aiohttp.web
 
+# Konfigurasi antrian/format, kunci job, dan broker dipakai bersama dengan gateway HTTP (app.py)
+from broker import (
+    DATA_DIR, BROKER_URL, JOB_JOURNAL_RETENTION, MAX_JOBS_PER_CHAT, MAX_QUEUE_SIZE,
+    TELEGRAM_MAX_UPLOAD_BYTES, DOWNLOAD_FORMAT_SELECTOR, PROBE_ENABLED, FORMAT_TARGET_HEIGHT, FORMAT_PREFER_PREMUXED,
+    normalize_url, result_cache_keys, download_coalesce_key, create_job_broker,
+)
+# Titik masuk proses worker engine yt-dlp in-process (ringan: hanya stdlib; yt_dlp diimpor di worker)
+import ytdlp_worker
+
 # --- Konfigurasi Logger ---
 # Mengatur format dan level logging untuk output konsol
 logging.basicConfig(format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
@@ -56,38 +78,331 @@ if not os.path.exists(DOWNLOAD_DIR):
         logging.error(f"Gagal membuat direktori unduhan {DOWNLOAD_DIR}: {e}")
         sys.exit(1)
 
+# Folder untuk data persisten bot (cache hasil, dll.), terpisah dari file unduhan sementara.
+# DATA_DIR dibaca di broker.py (default lokasi broker SQLite); di sini hanya dipastikan ada
+if not os.path.exists(DATA_DIR):
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        logging.info(f"Created data directory: {DATA_DIR}")
+    except Exception as e:
+        logging.error(f"Gagal membuat direktori data {DATA_DIR}: {e}")
+        sys.exit(1)
+
 # --- Konfigurasi Cookies ---
 # Path ke file cookies.txt di dalam container
 # Dibaca dari Environment Variable COOKIES_FILE_PATH
 COOKIES_FILE_PATH = os.environ.get("COOKIES_FILE_PATH")
 if COOKIES_FILE_PATH:
     logging.info(f"COOKIES_FILE_PATH disetel: {COOKIES_FILE_PATH}")
-    # Cek keberadaan file saat startup (opsional, tapi membantu deteksi masalah awal)
-    if not os.path.exists(COOKIES_FILE_PATH):
-         logging.warning(f"PERINGATAN: File cookies tidak ditemukan di path yang disetel: {COOKIES_FILE_PATH}")
-         # Biarkan COOKIES_FILE_PATH tetap disetel, yt-dlp akan error jika file tidak ada saat dipanggil.
+    # Isi file diparse dan divalidasi sekali saat boot (lihat CookieJarState), bukan di setiap job
+# Folder file lease cookies per pemanggil yt-dlp (subset per domain), dikosongkan saat boot
+COOKIES_LEASE_DIR = os.path.join(DATA_DIR, "cookie-leases")
+# Interval (detik) penulisan balik batch perubahan cookie dari yt-dlp ke COOKIES_FILE_PATH
+COOKIES_FLUSH_INTERVAL = float(os.environ.get("COOKIES_FLUSH_INTERVAL", 30))
+# Interval (detik) pengecekan mtime COOKIES_FILE_PATH untuk hot reload tanpa restart
+COOKIES_RELOAD_INTERVAL = float(os.environ.get("COOKIES_RELOAD_INTERVAL", 10))
+# Tulis balik cookie yang diperbarui yt-dlp; matikan jika file cookies di-mount read-only
+COOKIES_WRITEBACK = os.environ.get("COOKIES_WRITEBACK", "true").lower() == "true"
+
+# --- Konfigurasi Penjadwal Unduhan ---
+# Batas global jumlah job yang berjalan bersamaan (setiap job = 1 yt-dlp + aria2c dengan hingga 16 koneksi)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 3))
+# Batas jumlah job yang boleh berjalan bersamaan untuk satu chat
+MAX_RUNNING_JOBS_PER_CHAT = int(os.environ.get("MAX_RUNNING_JOBS_PER_CHAT", 1))
+# Jeda minimum (detik) antar update posisi antrian di pesan status
+QUEUE_POSITION_UPDATE_INTERVAL = float(os.environ.get("QUEUE_POSITION_UPDATE_INTERVAL", 5))
+
+# --- Konfigurasi Tuning Koneksi Unduhan per Host ---
+# Jumlah koneksi aria2c dan fragmen HLS/DASH paralel dipelajari per host dari kecepatan unduhan
+# yang teramati (field speed progres yt-dlp); nonaktif = selalu nilai default di bawah
+ADAPTIVE_TUNING_ENABLED = os.environ.get("ADAPTIVE_TUNING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Profil host disimpan di sini agar hasil belajar bertahan setelah restart
+HOST_PROFILES_PATH = os.environ.get("HOST_PROFILES_PATH", os.path.join(DATA_DIR, "host_profiles.json"))
+# Titik awal untuk host yang belum punya profil
+ARIA2_DEFAULT_CONNECTIONS = int(os.environ.get("ARIA2_DEFAULT_CONNECTIONS", 4))
+DEFAULT_CONCURRENT_FRAGMENTS = int(os.environ.get("DEFAULT_CONCURRENT_FRAGMENTS", 4))
+# Setelah error throttle/blokir (403/429/reset), level di atas level gagal tidak dicoba selama ini (detik)
+HOST_PROFILE_PENALTY_SECONDS = int(os.environ.get("HOST_PROFILE_PENALTY_SECONDS", 6 * 3600))
+# Jumlah host maksimum di file profil (yang paling lama tidak dipakai dibuang)
+HOST_PROFILE_MAX_HOSTS = int(os.environ.get("HOST_PROFILE_MAX_HOSTS", 500))
+
+# --- Konfigurasi Kapasitas Disk ---
+# Kuota total DOWNLOAD_DIR dalam MiB (0 = hanya dibatasi ruang kosong disk)
+DOWNLOAD_DIR_QUOTA_BYTES = int(os.environ.get("DOWNLOAD_DIR_QUOTA_MB", 0)) * 1024 * 1024
+# Ruang kosong yang selalu disisakan di disk (MiB)
+DISK_MIN_FREE_BYTES = int(os.environ.get("DISK_MIN_FREE_MB", 512)) * 1024 * 1024
+# Perkiraan ukuran job saat ukuran sebenarnya belum diketahui (MiB)
+DISK_DEFAULT_JOB_ESTIMATE_BYTES = int(os.environ.get("DISK_DEFAULT_JOB_ESTIMATE_MB", 500)) * 1024 * 1024
+# Interval janitor DOWNLOAD_DIR (detik)
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", 600))
+# Umur (detik sejak terakhir ditulis) fragmen .part/.ytdl/aria2 sebelum dianggap yatim
+JANITOR_FRAGMENT_MAX_AGE = int(os.environ.get("JANITOR_FRAGMENT_MAX_AGE", 3600))
+# Umur file lain (hasil unduhan yang gagal dihapus) sebelum dihapus janitor
+JANITOR_FILE_MAX_AGE = int(os.environ.get("JANITOR_FILE_MAX_AGE", 6 * 3600))
+DOWNLOAD_FRAGMENT_SUFFIXES = (".part", ".ytdl", ".aria2", ".temp")
+
+# --- Konfigurasi Cache Hasil (file_id Telegram) ---
+# URL yang sama tidak diunduh/diunggah ulang: file dikirim ulang memakai file_id dari upload pertama
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join(DATA_DIR, "result_cache.sqlite3"))
+# Umur maksimum entri cache (detik), default 7 hari
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 7 * 24 * 3600))
+# Jumlah maksimum entri; entri yang paling lama tidak dipakai dibuang lebih dulu (LRU)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 5000))
+
+# --- Konfigurasi Jurnal Job (Tahan Crash) ---
+# Status setiap job dicatat di SQLite; job yang belum selesai dilanjutkan saat bot start ulang
+JOB_JOURNAL_ENABLED = os.environ.get("JOB_JOURNAL_ENABLED", "true").lower() in ("1", "true", "yes")
+JOB_JOURNAL_PATH = os.environ.get("JOB_JOURNAL_PATH", os.path.join(DATA_DIR, "job_journal.sqlite3"))
+
+# --- Konfigurasi Peran Proses dan Broker Job (Scale-Out) ---
+# all      = satu proses menerima /download sekaligus mengunduh/mengunggah (default)
+# frontend = hanya menerima update Telegram dan mengantrikan job ke broker
+# worker   = mengambil job dari broker, mengunduh, mengunggah dan mengedit status langsung (python bot.py --worker)
+BOT_ROLE = "worker" if "--worker" in sys.argv[1:] else os.environ.get("BOT_ROLE", "all").lower()
+if BOT_ROLE not in ("all", "frontend", "worker"):
+    logging.error(f"Error: BOT_ROLE harus all, frontend, atau worker (bukan {BOT_ROLE}).")
+    sys.exit(1)
+# Interval polling worker saat broker kosong (detik)
+BROKER_POLL_INTERVAL = float(os.environ.get("BROKER_POLL_INTERVAL", 1.0))
+# Worker memperbarui lease job (dan teks status terakhir) setiap interval ini (detik)
+BROKER_HEARTBEAT_INTERVAL = int(os.environ.get("BROKER_HEARTBEAT_INTERVAL", 10))
+# Job yang lease-nya tidak diperbarui selama ini dianggap yatim (worker mati) dan diantrikan ulang
+BROKER_LEASE_TIMEOUT = int(os.environ.get("BROKER_LEASE_TIMEOUT", 60))
+# Identitas worker; jika stabil (mis. nama pod), job miliknya langsung diantrikan ulang saat worker start ulang
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Mode all: ikut mengambil job dari broker (misalnya job dari HTTP gateway app.py) di samping /download lokal
+BOT_CONSUME_BROKER = os.environ.get("BOT_CONSUME_BROKER", "false").lower() in ("1", "true", "yes")
+# Broker dibuka oleh proses ini (frontend, worker, atau mode all yang ikut mengambil job broker)
+BROKER_ENABLED = BOT_ROLE != "all" or BOT_CONSUME_BROKER
+
+# --- Konfigurasi Upload Streaming ---
+# Jika aktif, format satu-stream diunggah ke Telegram sambil diunduh (tanpa file di disk).
+# Hanya dipakai jika probe (PROBE_ENABLED) memilih format satu-stream yang ukurannya diketahui/diperkirakan
+# muat dalam batas upload; format yang butuh merge ffmpeg atau terlalu besar langsung lewat jalur biasa.
+STREAMING_UPLOAD_ENABLED = os.environ.get("STREAMING_UPLOAD_ENABLED", "false").lower() in ("1", "true", "yes")
+# Jumlah part yang diunggah paralel
+STREAMING_UPLOAD_WORKERS = int(os.environ.get("STREAMING_UPLOAD_WORKERS", 4))
+# Jumlah part (@512 KiB) yang boleh menunggu di memori; membatasi pemakaian memori per job
+STREAMING_UPLOAD_BUFFER_PARTS = int(os.environ.get("STREAMING_UPLOAD_BUFFER_PARTS", 8))
+
+# --- Konfigurasi Batas Ukuran dan Upload ---
+# Jumlah upload bersamaan (bagian file besar, dan batas transmisi bersamaan Pyrogram)
+UPLOAD_PARALLELISM = int(os.environ.get("UPLOAD_PARALLELISM", 2))
+# Part yang diunggah bersamaan per file lewat koneksi media sendiri (0 = uploader bawaan Pyrogram)
+UPLOAD_PART_WORKERS = int(os.environ.get("UPLOAD_PART_WORKERS", 4))
+# Ukuran part upload (KiB). Telegram mensyaratkan kelipatan 1 KiB yang membagi habis 512 KiB;
+# dinaikkan otomatis jika file akan melebihi batas jumlah part
+UPLOAD_PART_SIZE_KB = int(os.environ.get("UPLOAD_PART_SIZE_KB", 512))
+if UPLOAD_PART_SIZE_KB <= 0 or 512 % UPLOAD_PART_SIZE_KB:
+    logging.error(f"Error: UPLOAD_PART_SIZE_KB harus pembagi 512 (1, 2, 4, ..., 512), bukan {UPLOAD_PART_SIZE_KB}.")
+    sys.exit(1)
+# Kirim hasil video/audio sebagai media (durasi, resolusi, thumbnail) agar Telegram tidak memproses ulang di server
+UPLOAD_AS_MEDIA = os.environ.get("UPLOAD_AS_MEDIA", "true").lower() in ("1", "true", "yes")
 
+# --- Konfigurasi Probe dan Pemilihan Format ---
+# Umur cache metadata probe (detik); URL stream di dalamnya kedaluwarsa, jadi dibuat singkat
+PROBE_CACHE_TTL = int(os.environ.get("PROBE_CACHE_TTL", 300))
+PROBE_CACHE_MAX_ENTRIES = int(os.environ.get("PROBE_CACHE_MAX_ENTRIES", 256))
+# Bitrate audio maksimum (kbps) saat memasangkan audio dengan stream video-only
+FORMAT_MAX_AUDIO_ABR = float(os.environ.get("FORMAT_MAX_AUDIO_ABR", 160))
+
+# --- Konfigurasi Batch / Playlist ---
+# Jumlah item batch yang boleh antri/berjalan bersamaan (tetap dibatasi MAX_CONCURRENT_DOWNLOADS global)
+BATCH_MAX_PARALLEL = int(os.environ.get("BATCH_MAX_PARALLEL", 3))
+# Jumlah item maksimum per permintaan batch (playlist panjang dipotong)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+# Lama (detik) item yang sudah siap menunggu item lain sebelum media group dikirim
+BATCH_GROUP_LINGER = float(os.environ.get("BATCH_GROUP_LINGER", 10))
+
+# --- Konfigurasi Update Pesan Progres ---
+# Batas edit pesan per chat per menit (Telegram membatasi edit per chat)
+PROGRESS_CHAT_EDITS_PER_MINUTE = int(os.environ.get("PROGRESS_CHAT_EDITS_PER_MINUTE", 20))
+# Batas edit pesan global per detik untuk seluruh bot
+PROGRESS_GLOBAL_EDITS_PER_SECOND = float(os.environ.get("PROGRESS_GLOBAL_EDITS_PER_SECOND", 20))
+# Interval minimum (detik) antar update progres untuk satu pesan
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", 3))
+# Jumlah pesan progres aktif sebelum interval mulai dilebarkan secara proporsional
+PROGRESS_INTERVAL_SCALE_AT = int(os.environ.get("PROGRESS_INTERVAL_SCALE_AT", 10))
+# Interval minimum (detik) antar parsing baris progres yt-dlp per job; baris di antaranya dibuang tanpa di-decode
+PROGRESS_PARSE_INTERVAL = float(os.environ.get("PROGRESS_PARSE_INTERVAL", 1.0))
+# Jumlah baris stderr terakhir yt-dlp yang disimpan untuk pesan error (ring buffer)
+YTDLP_STDERR_TAIL_LINES = int(os.environ.get("YTDLP_STDERR_TAIL_LINES", 50))
+# Batas panjang satu baris output subprocess (JSON info lengkap dari -j bisa beberapa MiB)
+YTDLP_PIPE_LIMIT = 32 * 1024 * 1024
+
+# --- Konfigurasi Tracing Job ---
+# Timeline per job (span antri, probe, extract, download, merge, split, upload, cleanup) ditulis sebagai JSON lines
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Tujuan JSON lines: "-" = stdout (terpisah dari log biasa di stderr), atau path file (append)
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "-")
+# Fraksi job sukses yang ditulis (0..1); job gagal dan job lambat selalu ditulis
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+# Job yang berjalan lebih lama dari ini (detik) selalu ditulis
+TRACE_SLOW_JOB_SECONDS = float(os.environ.get("TRACE_SLOW_JOB_SECONDS", 300))
+# Batas baris trace per detik; kelebihan dibuang (dihitung di metrik) agar log tetap terbatas saat beban tinggi
+TRACE_MAX_LINES_PER_SECOND = float(os.environ.get("TRACE_MAX_LINES_PER_SECOND", 20))
+# Jumlah maksimum event (mis. baris output yt-dlp) yang disimpan per job
+TRACE_MAX_EVENTS_PER_JOB = int(os.environ.get("TRACE_MAX_EVENTS_PER_JOB", 20))
+# Endpoint OTLP/HTTP (JSON), mis. http://otel-collector:4318/v1/traces. Kosong = exporter mati
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "")
+TRACE_OTLP_INTERVAL = float(os.environ.get("TRACE_OTLP_INTERVAL", 5))
+# Span yang menunggu diekspor; yang tertua dibuang jika collector lambat/mati
+TRACE_OTLP_MAX_QUEUE = int(os.environ.get("TRACE_OTLP_MAX_QUEUE", 2048))
 
 # --- Konfigurasi Health Check Server ---
 # Port yang akan didengarkan oleh server health check
 # Dibaca dari Environment Variable, default ke 8080
 HEALTH_CHECK_PORT = int(os.environ.get("HEALTH_CHECK_PORT", 8080))
 
+# --- Metrik (Format Teks Prometheus) ---
+class MetricCounter:
+    """
+    Counter monoton dengan label opsional.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = collections.defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class MetricGauge(MetricCounter):
+    """
+    Gauge yang diset/dinaikkan/diturunkan manual, atau dibaca dari callback saat scrape.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, (), self.callback()
+            return
+        yield from super().samples()
+
+
+class MetricHistogram:
+    """
+    Histogram latensi (detik) dengan bucket kumulatif.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = {} # label -> [jumlah per bucket..., +Inf]
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        counts[-1] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        for key, counts in self.counts.items():
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                yield f"{self.name}_bucket", key + (("le", "+Inf" if bound == float("inf") else repr(bound)),), count
+            yield f"{self.name}_sum", key, self.sums[key]
+            yield f"{self.name}_count", key, counts[-1]
+
+
+class BotMetrics:
+    """
+    Kumpulan metrik bot yang diekspos di /metrics. Hanya diakses dari event loop, jadi tanpa lock.
+    """
+    def __init__(self):
+        stage_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+        self.requests = MetricCounter("ytbot_requests_total", "Permintaan /download menurut hasil penanganan awal")
+        self.jobs = MetricCounter("ytbot_jobs_total", "Job unduhan selesai menurut hasil")
+        self.ytdlp_active = MetricGauge("ytbot_ytdlp_active", "Proses/worker yt-dlp yang sedang berjalan")
+        self.ytdlp_active.inc(0) # Tampilkan 0 sejak awal, bukan metrik kosong
+        self.downloaded_bytes = MetricCounter("ytbot_downloaded_bytes_total", "Byte yang diunduh yt-dlp")
+        self.uploaded_bytes = MetricCounter("ytbot_uploaded_bytes_total", "Byte yang diunggah ke Telegram")
+        self.stage_seconds = MetricHistogram("ytbot_stage_seconds", "Latensi per tahap job", stage_buckets)
+        self.message_edits = MetricCounter("ytbot_message_edits_total", "Edit pesan status menurut hasil")
+        self.flood_wait_seconds = MetricCounter("ytbot_flood_wait_seconds_total", "Total waktu FloodWait dari Telegram")
+        self.janitor_removed_bytes = MetricCounter("ytbot_janitor_removed_bytes_total", "Byte file usang yang dihapus janitor")
+        self.traces = MetricCounter("ytbot_traces_total", "Timeline job menurut nasib (written, sampled_out, rate_limited)")
+        self._metrics = [
+            self.requests, self.jobs, self.ytdlp_active, self.downloaded_bytes, self.uploaded_bytes,
+            self.stage_seconds, self.message_edits, self.flood_wait_seconds, self.janitor_removed_bytes,
+            self.traces,
+        ]
+
+    def add_gauge(self, name, help_text, callback):
+        """
+        Menambahkan gauge yang nilainya dibaca dari state lain saat scrape (misal kedalaman antrian).
+        """
+        self._metrics.append(MetricGauge(name, help_text, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{label_value}"' for key, label_value in labels)
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = BotMetrics()
+
+
 # --- Health Check Handler (Fungsi yang akan dipanggil saat /health diakses) ---
 async def health_handler(request):
     """
-    Handler HTTP untuk health check. Merespons status bot.
+    Handler HTTP untuk health check (readiness). Merespons 200 hanya jika boot selesai, bot terhubung
+    ke Telegram, dan worker penjadwal berjalan; selain itu 503 dengan rincian state.
     """
-    # Anda bisa menambahkan logika yang lebih canggih di sini
-    # Misalnya, cek apakah klien Pyrogram masih terhubung ke Telegram
-    # if app and app.is_connected:
-    #      return aiohttp.web.Response(text="Bot connected and healthy", status=200)
-    # else:
-    #      logging.warning("Health check requested, but Pyrogram client is not connected.")
-    #      return aiohttp.web.Response(text="Bot not connected to Telegram", status=503)
+    scheduler_workers = download_scheduler.alive_workers
+    checks = {
+        "role": BOT_ROLE,
+        "telegram_connected": bool(app and app.is_connected),
+        "scheduler_workers": scheduler_workers,
+        "ytdlp_engine": YTDLP_ENGINE,
+        "boot": boot_phases.summary(),
+    }
+    if COOKIES_FILE_PATH and BOT_ROLE != "frontend":
+        checks["cookies"] = cookie_jar.summary()
+    if YTDLP_ENGINE == "inprocess":
+        # Pool mati tidak membuat bot tidak siap (fallback ke subprocess), tapi tetap dilaporkan
+        checks["ytdlp_pool_available"] = ytdlp_engine_pool.available
+    if BROKER_ENABLED:
+        checks["broker_connected"] = job_broker is not None and job_broker.connected
+    # Frontend tidak menjalankan worker penjadwal; cukup terhubung ke Telegram dan broker
+    ready = boot_phases.ready and checks["telegram_connected"] and (scheduler_workers > 0 or BOT_ROLE == "frontend")
+    if BROKER_ENABLED:
+        ready = ready and checks["broker_connected"]
+    if not ready:
+        logging.warning(f"Health check requested, but bot is not ready: {checks}")
+    return aiohttp.web.json_response(dict(checks, ready=ready), status=200 if ready else 503)
 
-    # Untuk health check sederhana, cukup kembalikan status 200 OK
-    return aiohttp.web.Response(text="Bot service is healthy", status=200)
+
+async def metrics_handler(request):
+    """
+    Handler HTTP /metrics dalam format teks Prometheus.
+    """
+    return aiohttp.web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
 
 # --- Fungsi pembantu untuk membuat aiohttp app ---
 async def create_health_app():
@@ -97,6 +412,7 @@ async def create_health_app():
     app = aiohttp.web.Application()
     # Menambahkan route untuk /health
     app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
     return app
 
 # --- Fungsi untuk Memulai Health Check Server ---
@@ -116,430 +432,4746 @@ async def start_health_server():
 # --- Inisialisasi Pyrogram Client ---
 # Instance Pyrogram Client yang akan digunakan di seluruh bot
 app = Client(
-    SESSION_NAME, # Nama sesi untuk file sesi
+    SESSION_NAME if BOT_ROLE != "worker" else f"{SESSION_NAME}-worker", # Nama sesi untuk file sesi
     api_id=API_ID, # API ID (sudah dikonversi ke integer)
     api_hash=API_HASH, # API Hash (string)
     bot_token=BOT_TOKEN, # Token Bot (string)
+    max_concurrent_transmissions=UPLOAD_PARALLELISM, # Default Pyrogram 1: semua upload akan antri satu per satu
+    # Worker tidak menerima update (hanya frontend yang menangani perintah); sesi di memori agar
+    # beberapa worker di host yang sama tidak berebut file sesi
+    no_updates=BOT_ROLE == "worker",
+    in_memory=BOT_ROLE == "worker",
     # workdir='/app' # Opsional: jika Anda ingin file sesi di sub-folder /app
 )
 logging.info("Pyrogram Client initialized.")
 
-# --- Fungsi untuk Memanggil yt-dlp dan Melaporkan Progres ---
-# Fungsi ini sekarang adalah async function karena menggunakan subprocess async dan edit pesan async
-async def download_with_ytdlp(url, status_message: Message):
+# --- Layanan Update Pesan Progres (Rate Limit Terpusat) ---
+# Semua edit pesan status lewat layanan ini: state terbaru per pesan digabung (coalesce),
+# dibatasi token bucket per chat dan global, FloodWait dihormati, dan interval progres
+# melebar otomatis saat banyak job aktif. Dengan begitu satu job yang cerewet tidak
+# menghabiskan jatah edit Telegram untuk job lain.
+class TokenBucket:
     """
-    Menjalankan yt-dlp sebagai subprocess non-blocking dan melaporkan progres di pesan status.
-    Mengembalikan path file yang diunduh atau None jika gagal, beserta pesan error.
+    Token bucket sederhana: `rate` token per detik, maksimum `capacity` token.
     """
-    logging.info(f"Memulai unduhan async dengan yt-dlp untuk: {url}")
-    last_update_time = 0 # Untuk membatasi frekuensi update pesan Telegram
-    last_progress_text = "" # Untuk menghindari edit pesan jika progress sama
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = None
 
-    output_template = os.path.join(DOWNLOAD_DIR, "%(title)s.%(ext)s")
+    def _refill(self, now):
+        if self.updated_at is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
 
-    # Base command untuk yt-dlp
-    ytdlp_command = [
-        "yt-dlp",
-        "--ignore-errors",
-        "--restrict-filenames",
-        "--no-warnings",
-        "--newline", # Penting: memastikan setiap line output diakhiri newline
-        "--progress", # Aktifkan output progres
-        "--progress-template", "%(progress)j", # Output progres dalam format JSON
-        "-o", output_template,
-        "--external-downloader", "aria2c", # Menggunakan aria2c (pastikan terinstal di Dockerfile)
-        "--external-downloader-args", "aria2c:\"-x 16 -s 16 -k 1M\"", # Argumen untuk aria2c (sudah diperbaiki)
-        # Argumen tambahan lainnya jika diperlukan...
-    ]
+    def time_until_token(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
 
-    # --- Tambahkan argumen cookies jika COOKIES_FILE_PATH disetel ---
-    # Periksa lagi keberadaan file cookies saat menjalankan subprocess, lebih aman
-    if COOKIES_FILE_PATH and os.path.exists(COOKIES_FILE_PATH):
-         logging.info(f"Menambahkan argumen cookies: --cookies {COOKIES_FILE_PATH}")
-         ytdlp_command.extend(["--cookies", COOKIES_FILE_PATH])
-    elif COOKIES_FILE_PATH:
-         # Jika COOKIES_FILE_PATH disetel tapi file tidak ada saat proses download dimulai
-         logging.warning(f"COOKIES_FILE_PATH disetel ({COOKIES_FILE_PATH}), tetapi file TIDAK ditemukan saat mencoba unduh. Unduhan mungkin gagal.")
-    # --- Akhir penambahan argumen cookies ---
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
 
-    # Tambahkan URL sebagai elemen terakhir
-    ytdlp_command.append(url)
 
-    logging.info(f"Perintah dijalankan: {' '.join(ytdlp_command)}")
+class PendingEdit:
+    def __init__(self, message, text, kwargs, final):
+        self.message = message
+        self.text = text
+        self.kwargs = kwargs
+        self.final = final
+        self.futures = [] # Pemanggil edit() yang menunggu pesan ini terkirim
 
-    process = None # Inisialisasi proses di luar try untuk cleanup
-    try:
-        # Menjalankan subprocess yt-dlp secara async
-        process = await asyncio.create_subprocess_exec(
-            *ytdlp_command, # Gunakan * untuk meneruskan list sebagai argumen terpisah
-            stdout=asyncio.subprocess.PIPE, # Ambil stdout jika diperlukan
-            stderr=asyncio.subprocess.PIPE # Ambil stderr untuk progres
-        )
 
-        # --- Membaca dan Mem-parsing Progres dari stderr ---
-        # Membaca output stderr line by line secara async
+class ProgressMessageUpdater:
+    """
+    Antrian edit pesan status dengan coalescing per pesan dan pembatasan laju.
+    submit(): update progres, boleh dilewati jika ada update yang lebih baru.
+    edit(): update final (hasil/error), tidak terkena interval progres dan ditunggu pemanggil.
+    """
+    def __init__(self, chat_edits_per_minute, global_edits_per_second, min_interval, scale_at):
+        self.chat_edits_per_minute = chat_edits_per_minute
+        self.min_interval = min_interval
+        self.scale_at = scale_at
+        self.max_global_rate = global_edits_per_second
+        self._global_bucket = TokenBucket(global_edits_per_second, global_edits_per_second)
+        self._chat_buckets = {}
+        self._pending = {} # key pesan -> PendingEdit terbaru
+        self._in_flight = set()
+        self._last_text = {}
+        self._last_edit_at = {}
+        self._active_progress = {} # key pesan -> waktu update progres terakhir (untuk interval adaptif)
+        self._chat_blocked_until = {} # chat_id -> waktu FloodWait berakhir
+        self._last_flood_at = 0
+        self._last_prune_at = 0
+        self._wakeup = None
+        self._task = None
+        self.flood_wait_seconds = 0 # Total waktu FloodWait yang diterima (untuk observabilitas)
+
+    @staticmethod
+    def _key(message):
+        return (message.chat.id, getattr(message, "id", id(message)))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def current_interval(self, now):
+        """
+        Interval minimum antar edit progres per pesan, melebar sebanding jumlah pesan progres aktif.
+        """
+        for key, updated_at in list(self._active_progress.items()):
+            if now - updated_at > 30:
+                del self._active_progress[key]
+        return self.min_interval * max(1.0, len(self._active_progress) / self.scale_at)
+
+    def _enqueue(self, message, text, kwargs, final):
+        self.start()
+        key = self._key(message)
+        pending = PendingEdit(message, text, kwargs, final)
+        previous = self._pending.get(key)
+        if previous is not None:
+            # State lama digantikan: pemanggil yang menunggu ikut selesai saat state baru terkirim
+            pending.futures = previous.futures
+            pending.final = pending.final or previous.final
+        self._pending[key] = pending
+        if not final:
+            self._active_progress[key] = asyncio.get_running_loop().time()
+        self._wakeup.set()
+        return pending
+
+    def submit(self, message, text, **kwargs):
+        """
+        Menjadwalkan update progres tanpa menunggu.
+        """
+        self._enqueue(message, text, kwargs, final=False)
+
+    async def edit(self, message, text, timeout=10, **kwargs):
+        """
+        Menjadwalkan update final dan menunggu sampai terkirim (maksimal `timeout` detik).
+        Jika masih tertahan FloodWait setelah timeout, update tetap di antrian dan akan dikirim nanti.
+        Error Telegram selain FloodWait diteruskan ke pemanggil.
+        """
+        pending = self._enqueue(message, text, kwargs, final=True)
+        future = asyncio.get_running_loop().create_future()
+        pending.futures.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Edit pesan {self._key(message)} masih tertunda (rate limit/FloodWait), tetap diantrikan.")
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.chat_edits_per_minute / 60
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, max(1, self.chat_edits_per_minute // 10))
+        return bucket
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
         while True:
-            line_bytes = await process.stderr.readline()
-            if not line_bytes:
-                break # Keluar loop jika stream stderr ditutup
+            self._wakeup.clear()
+            now = loop.time()
+            self._recover_global_rate(now)
+            interval = self.current_interval(now)
+            next_wake = None
 
-            line = line_bytes.decode('utf-8', errors='ignore').strip()
-            if not line:
-                continue # Lewati baris kosong
+            # Pesan yang paling lama tidak diedit didahulukan
+            for key in sorted(self._pending, key=lambda k: self._last_edit_at.get(k, 0)):
+                if key in self._in_flight:
+                    continue
+                pending = self._pending[key]
+                chat_id = key[0]
+                ready_at = self._chat_blocked_until.get(chat_id, 0)
+                if not pending.final:
+                    ready_at = max(ready_at, self._last_edit_at.get(key, 0) + interval)
+                if ready_at <= now:
+                    bucket = self._chat_bucket(chat_id)
+                    wait = max(bucket.time_until_token(now), self._global_bucket.time_until_token(now))
+                    if wait <= 0:
+                        bucket.consume(now)
+                        self._global_bucket.consume(now)
+                        del self._pending[key]
+                        self._in_flight.add(key)
+                        asyncio.create_task(self._send(key, pending))
+                        continue
+                    ready_at = now + wait
+                next_wake = ready_at if next_wake is None else min(next_wake, ready_at)
 
-            # yt-dlp --progress-template "%(progress)j" output adalah JSON
+            if now - self._last_prune_at > 60:
+                self._prune(now)
+
+            timeout = None if next_wake is None else max(0.05, next_wake - now)
             try:
-                progress_data = json.loads(line)
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-                # Cek status unduhan
-                status = progress_data.get("status")
-                if status == "finished":
-                    logging.info(f"Unduhan selesai: {url}")
-                    # Kirim update progres terakhir sebelum keluar loop
-                    final_progress_text = f"Mengunduh: `{url}`\n**✅ Selesai**"
-                    if final_progress_text != last_progress_text:
-                         try:
-                              await status_message.edit_text(final_progress_text, parse_mode=ParseMode.MARKDOWN)
-                              last_progress_text = final_progress_text
-                         except Exception as edit_e:
-                              logging.warning(f"Gagal mengedit pesan final progres untuk {url}: {edit_e}")
-
-                    break # Keluar loop jika status finished
-                elif status == "downloading" or status == "extracting":
-                    # Parsing data progres untuk status downloading/extracting
-                    percent = progress_data.get("fraction_downloaded") # 0.0 - 1.0
-                    speed = progress_data.get("speed") # byte/detik
-                    eta = progress_data.get("eta") # detik
-                    downloaded_bytes = progress_data.get("downloaded_bytes")
-                    total_bytes = progress_data.get("total_bytes") or progress_data.get("total_bytes_estimate") # total bisa estimasi
-
-                    if percent is not None:
-                        percent_str = f"{percent * 100:.1f}%"
-                        speed_str = "N/A"
-                        if speed is not None and speed > 0:
-                             speed_str = f"{speed/1024/1024:.2f} MiB/s" if speed > 1024*1024 else f"{speed/1024:.2f} KiB/s"
-                        eta_str = "N/A"
-                        if eta is not None:
-                             minutes, seconds = divmod(int(eta), 60)
-                             eta_str = f"{minutes}m {seconds}s" if minutes > 0 else f"{seconds}s"
-
-                        downloaded_str = "N/A"
-                        if downloaded_bytes is not None:
-                             downloaded_str = f"{downloaded_bytes/1024/1024:.2f} MiB" if downloaded_bytes > 1024*1024 else f"{downloaded_bytes/1024:.2f} KiB"
-                        total_str = "N/A"
-                        if total_bytes is not None:
-                             total_str = f"{total_bytes/1024/1024:.2f} MiB" if total_bytes > 1024*1024 else f"{total_bytes/1024:.2f} KiB"
-
-
-                        progress_text = (
-                            f"Mengunduh: `{url}`\n"
-                            f"Status: **{status.capitalize()}**\n" # Status seperti Downloading/Extracting
-                            f"Progress: **{percent_str}**\n"
-                            f"Sudah terunduh: {downloaded_str} / {total_str}\n"
-                            f"Kecepatan: {speed_str}\n"
-                            f"ETA: {eta_str}"
-                        )
-
-                        # Update pesan Telegram
-                        # Batasi frekuensi edit pesan untuk menghindari FloodWait Telegram
-                        current_time = asyncio.get_event_loop().time()
-                        # Update jika > 3 detik sejak update terakhir ATAU progresnya tepat 100%
-                        if current_time - last_update_time > 3 or percent == 1.0:
-                             if progress_text != last_progress_text: # Hanya edit jika teks berubah
-                                  try:
-                                      # await status_message.edit_text(progress_text, parse_mode=ParseMode.MARKDOWN)
-                                      # Menggunakan edit_text dengan disable_web_page_preview=True karena URL di pesan
-                                      await status_message.edit_text(progress_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-                                      last_update_time = current_time
-                                      last_progress_text = progress_text
-                                      # logging.debug(f"Pesan progres diupdate untuk {url}: {percent_str}")
-                                  except Exception as edit_e:
-                                      # Tangani FloodWait atau error edit lainnya
-                                      # logging.warning(f"Gagal mengedit pesan progres untuk {url}: {edit_e}")
-                                      # Jika error adalah FloodWait, Pyrogram sering menghandle internal, tapi mungkin perlu logic retry
-                                      # Jika error lain, mungkin ada masalah dengan pesan atau koneksi Telegram
-                                      pass # Biarkan logging di atas yang handle
+    async def _send(self, key, pending):
+        loop = asyncio.get_running_loop()
+        try:
+            if pending.text != self._last_text.get(key):
+                await pending.message.edit_text(pending.text, **pending.kwargs)
+                metrics.message_edits.inc(result="ok")
+            self._last_text[key] = pending.text
+            self._last_edit_at[key] = loop.time()
+            for future in pending.futures:
+                if not future.done():
+                    future.set_result(None)
+        except FloodWait as e:
+            wait_seconds = e.value if isinstance(e.value, (int, float)) else 5
+            self.flood_wait_seconds += wait_seconds
+            metrics.message_edits.inc(result="flood_wait")
+            metrics.flood_wait_seconds.inc(wait_seconds, source="edit")
+            logging.warning(f"FloodWait {wait_seconds}s saat mengedit pesan di chat {key[0]}, menunda edit chat ini.")
+            self._chat_blocked_until[key[0]] = loop.time() + wait_seconds
+            self._on_flood_wait(loop.time())
+            # Kembalikan ke antrian kecuali sudah ada state yang lebih baru
+            newer = self._pending.get(key)
+            if newer is None:
+                self._pending[key] = pending
+            else:
+                newer.futures.extend(pending.futures)
+                newer.final = newer.final or pending.final
+        except Exception as e:
+            if "MESSAGE_NOT_MODIFIED" in str(e):
+                self._last_text[key] = pending.text
+                metrics.message_edits.inc(result="not_modified")
+                error = None
+            else:
+                metrics.message_edits.inc(result="failed")
+                error = e
+            for future in pending.futures:
+                if not future.done():
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            self._in_flight.discard(key)
+            self._wakeup.set()
 
-                else:
-                    # Log status atau info lain dari yt-dlp (misal: destination, downloading f...)
-                    logging.info(f"Info yt-dlp: {line}")
+    def _on_flood_wait(self, now):
+        # Back-off global multiplikatif; FloodWait yang datang beruntun dihitung sekali
+        if now - self._last_flood_at > 5:
+            self._global_bucket.rate = max(1.0, self._global_bucket.rate / 2)
+        self._last_flood_at = now
 
-            except json.JSONDecodeError:
-                # Jika output bukan JSON (misalnya, pesan error lain dari yt-dlp yang tidak dalam format JSON)
-                logging.warning(f"Output non-JSON dari yt-dlp stderr: {line}")
-                # Anda bisa menambahkan logic untuk menampilkan pesan non-progress penting ini ke user
-                # Tapi hati-hati agar tidak spam chat.
-                # Contoh: await status_message.reply_text(f"Info dari downloader: {line}")
+    def _recover_global_rate(self, now):
+        # Pulihkan laju global perlahan setelah 60 detik tanpa FloodWait
+        if self._global_bucket.rate < self.max_global_rate and now - self._last_flood_at > 60:
+            self._global_bucket.rate = min(self.max_global_rate, self._global_bucket.rate * 1.1)
+            self._last_flood_at = now - 50 # Langkah pemulihan berikutnya ~10 detik lagi
 
-        # --- Menunggu Proses yt-dlp Selesai dan Memeriksa Return Code ---
-        returncode = await process.wait() # Tunggu proses yt-dlp selesai sepenuhnya
-        logging.info(f"Proses yt-dlp selesai dengan kode {returncode} untuk {url}")
+    def _prune(self, now):
+        self._last_prune_at = now
+        for key, edited_at in list(self._last_edit_at.items()):
+            if now - edited_at > 600 and key not in self._pending:
+                del self._last_edit_at[key]
+                self._last_text.pop(key, None)
+        for chat_id, blocked_until in list(self._chat_blocked_until.items()):
+            if blocked_until < now:
+                del self._chat_blocked_until[chat_id]
 
-        if returncode != 0:
-            # Baca sisa output error jika ada
-            remaining_stderr = await process.stderr.read()
-            error_output = remaining_stderr.decode('utf-8', errors='ignore').strip()
-            # Ambil error dari stderr yt-dlp jika return code bukan 0
-            error_message = error_output or f"yt-dlp exited with code {returncode} without stderr output."
-            logging.error(f"Unduhan gagal untuk {url}. Error: {error_message}")
-            return None, error_message # Kembalikan None dan pesan error
-
-        # --- Menemukan File yang Diunduh Setelah Sukses ---
-        # Setelah yt-dlp selesai mengunduh (return code 0), dapatkan info -j untuk menemukan path file.
-        # Ini juga harus dijalankan secara async.
-        info_command = ["yt-dlp", "-j", url]
-        logging.info(f"Menjalankan perintah info (-j): {' '.join(info_command)}")
-
-        info_process = await asyncio.create_subprocess_exec(
-            *info_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE # Biarkan stderr agar bisa lihat error info
-        )
-        info_stdout_bytes, info_stderr_bytes = await info_process.communicate() # Tunggu info selesai
-        info_returncode = info_process.returncode
 
-        info_stdout = info_stdout_bytes.decode('utf-8', errors='ignore')
-        info_stderr = info_stderr_bytes.decode('utf-8', errors='ignore').strip()
+progress_updater = ProgressMessageUpdater(
+    chat_edits_per_minute=PROGRESS_CHAT_EDITS_PER_MINUTE,
+    global_edits_per_second=PROGRESS_GLOBAL_EDITS_PER_SECOND,
+    min_interval=PROGRESS_MIN_INTERVAL,
+    scale_at=PROGRESS_INTERVAL_SCALE_AT,
+)
 
 
-        downloaded_file_path = None
-        if info_returncode == 0:
-            try:
-                info = json.loads(info_stdout)
-                # yt-dlp v2023.11.16+ menambahkan properti 'filepath' saat menggunakan -o
-                downloaded_file_path = info.get('filepath')
-
-                if not downloaded_file_path:
-                     # Fallback jika 'filepath' tidak ada (kurang handal)
-                     # Perlu memastikan template output di awal sama persis dengan yang dipakai yt-dlp
-                     # dan karakter ilegal dihandle seperti --restrict-filenames
-                     # Mengandalkan 'filepath' di JSON adalah cara terbaik
-                     logging.warning("Properti 'filepath' tidak ditemukan di output -j. Rekonstruksi path mungkin tidak akurat.")
-                     # Jika tidak ada filepath, Anda mungkin perlu logika yang lebih canggih
-                     # atau asumsikan nama file berdasarkan title dan ext jika template -o sederhana.
-                     # Contoh rekonstruksi sangat sederhana (bisa salah):
-                     title = info.get('title', 'download')
-                     ext = info.get('ext', 'mp4')
-                     # Membersihkan nama file agar sesuai dengan --restrict-filenames butuh regex
-                     # Pola yt-dlp bisa bervariasi, ini hanya contoh
-                     cleaned_title = re.sub(r'[^\w\s.-]', '', title).replace(' ', '_')
-                     downloaded_file_path = os.path.join(DOWNLOAD_DIR, f"{cleaned_title}.{ext}")
-                     logging.warning(f"Mencoba merekonstruksi path: {downloaded_file_path}")
-
-
-                logging.info(f"Diperkirakan file terunduh di: {downloaded_file_path}")
-
-                # Pastikan file benar-benar ada dan bisa diakses
-                if downloaded_file_path and os.path.exists(downloaded_file_path):
-                    logging.info(f"File ditemukan di: {downloaded_file_path}")
-                    return downloaded_file_path, None # Sukses, kembalikan path dan None error
-                else:
-                    error_message = f"File {downloaded_file_path} tidak ditemukan di direktori unduhan setelah yt-dlp selesai."
-                    logging.error(error_message)
-                    return None, error_message
+# --- Tracing per Job (Timeline JSON Lines + Exporter OTLP Opsional) ---
+# Trace job aktif disimpan di ContextVar: diset worker penjadwal di process_download_job dan otomatis
+# terbawa ke semua coroutine/task di bawahnya, sehingga tahap-tahap pipeline tidak perlu menerima
+# objek trace sebagai argumen. Semua waktu dicatat dengan time.monotonic().
+current_trace = contextvars.ContextVar("current_trace", default=None)
 
-            except json.JSONDecodeError:
-                 error_message = f"Gagal mem-parse output info JSON dari yt-dlp:\n{info_stdout}"
-                 logging.error(error_message)
-                 return None, error_message
-            except Exception as e:
-                 error_message = f"Terjadi kesalahan saat memproses info yt-dlp: {e}"
-                 logging.error(error_message)
-                 return None, error_message
-        else:
-             error_message = f"Gagal mendapatkan info yt-dlp (-j). Return code: {info_returncode}. Stderr:\n{info_stderr}"
-             logging.error(error_message)
-             return None, error_message
 
+class TraceSpan:
+    """
+    Satu span di timeline job. Dipakai sebagai context manager; atribut bisa ditambah dengan set().
+    """
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.started_at = None
 
-    except Exception as e:
-        # Tangani error saat membuat subprocess atau membaca stream
-        error_message = f"Terjadi kesalahan saat menjalankan proses yt-dlp: {e}"
-        logging.error(error_message)
-        # Coba terminasi proses jika sempat dibuat
-        if process and process.returncode is None:
-            try:
-                logging.warning("Mencoba terminasi proses yt-dlp yang sedang berjalan...")
-                process.terminate()
-                await asyncio.wait_for(process.wait(), timeout=5) # Tunggu sebentar setelah terminate
-                logging.warning("Proses yt-dlp berhasil di-terminate.")
-            except asyncio.TimeoutError:
-                 logging.error("Proses yt-dlp tidak terminate setelah diberi sinyal, mencoba kill.")
-                 try:
-                     process.kill()
-                     await asyncio.wait_for(process.wait(), timeout=5)
-                     logging.error("Proses yt-dlp berhasil di-kill.")
-                 except Exception as kill_e:
-                     logging.error(f"Gagal membunuh proses yt-dlp: {kill_e}")
-            except Exception as term_e:
-                logging.error(f"Gagal terminate proses yt-dlp: {term_e}")
-        return None, error_message
+    def set(self, **attributes):
+        self.attributes.update(attributes)
 
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
 
-# --- Fungsi untuk Menangani Cloudflare (Sangat Kompleks, Hanya Kerangka) ---
-# Fungsi ini akan sangat bervariasi tergantung situs dan metode bypass yang digunakan (pyppeteer/selenium)
-# Jika Anda mengimplementasikan ini, pastikan library yang relevan terinstal dan dependencies sistem ada di Dockerfile.
-async def bypass_cloudflare(url):
-   """
-   Placeholder untuk fungsi bypass Cloudflare menggunakan browser headless.
-   """
-   logging.info(f"Mencoba melewati Cloudflare untuk: {url}")
-   logging.warning("Fungsi bypass Cloudflare belum diimplementasikan sepenuhnya.")
-   return None # Kembalikan data bypass (misalnya cookie, final URL) jika berhasil
+    def __exit__(self, exc_type, exc, traceback):
+        error = None
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            error = f"{exc_type.__name__}: {exc}"
+        self.trace.record(self.name, self.started_at, time.monotonic(), error=error, **self.attributes)
+        return False
 
 
-# --- Event Handler untuk Pesan Masuk (Pyrogram) ---
+class NoopSpan:
+    """
+    Pengganti TraceSpan saat tidak ada trace aktif (tracing mati, atau di luar job).
+    """
+    def set(self, **attributes):
+        pass
 
-# Handler untuk perintah /start
-@app.on_message(filters.command("start") & filters.private) # Hanya merespons /start di chat pribadi
-async def handle_start_command(client: Client, message: Message):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class JobTrace:
     """
-    Menangani perintah /start. Mengirim pesan sambutan.
+    Timeline satu job: span per tahap beserta atribut (byte, laju) dan sejumlah terbatas event.
     """
-    logging.info(f"Received /start command from chat ID: {message.chat.id}")
+    def __init__(self, job_id, started_at, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.job_id = job_id
+        self.started_at = started_at # monotonic; untuk job dari penjadwal = saat job masuk antrian
+        # Jangkar untuk mengubah waktu monotonic ke waktu wall-clock saat diekspor
+        self.wall_offset = time.time() - time.monotonic()
+        self.attributes = attributes
+        self.spans = []
+        self.events = collections.deque(maxlen=TRACE_MAX_EVENTS_PER_JOB)
+        self.dropped_events = 0
+        self.error = None
 
-    welcome_message = """
-Halo! 👋 Saya adalah bot pengunduh video.
+    def span(self, name, **attributes):
+        return TraceSpan(self, name, attributes)
 
-Saya bisa mengunduh video dari berbagai platform menggunakan yt-dlp.
+    def record(self, name, started_at, ended_at, error=None, **attributes):
+        self.spans.append({"name": name, "start": started_at, "end": ended_at, "error": error, "attributes": attributes})
+        if error and self.error is None:
+            self.error = f"{name}: {error}"
 
-**Cara Menggunakan:**
-Kirimkan perintah `/download` diikuti dengan link video yang ingin Anda unduh.
+    def event(self, name, **attributes):
+        if len(self.events) == self.events.maxlen:
+            self.dropped_events += 1
+        self.events.append({"name": name, "time": time.monotonic(), "attributes": attributes})
 
-Contoh:
-`/download https://www.youtube.com/watch?v=dQw4w9WgXcQ`
+    def to_json_line(self, ended_at):
+        spans = []
+        for span in self.spans:
+            entry = {
+                "name": span["name"],
+                "offset_s": round(span["start"] - self.started_at, 3),
+                "duration_s": round(span["end"] - span["start"], 3),
+            }
+            entry.update(span["attributes"])
+            if span["error"]:
+                entry["error"] = span["error"]
+            spans.append(entry)
+        timeline = {
+            "ts": round(self.started_at + self.wall_offset, 3),
+            "trace_id": self.trace_id,
+            "job_id": self.job_id,
+            "duration_s": round(ended_at - self.started_at, 3),
+        }
+        timeline.update(self.attributes)
+        if self.error:
+            timeline["error"] = self.error
+        timeline["spans"] = spans
+        if self.events:
+            timeline["events"] = [
+                dict(event["attributes"], name=event["name"], offset_s=round(event["time"] - self.started_at, 3))
+                for event in self.events
+            ]
+        if self.dropped_events:
+            timeline["dropped_events"] = self.dropped_events
+        return json.dumps(timeline, ensure_ascii=False, default=str)
 
-Saya akan berusaha mengunduh video tersebut dan mengirimkannya kepada Anda.
 
-*Pastikan Anda menggunakan perintah ini di chat pribadi dengan bot.*
+def trace_span(name, **attributes):
     """
-    # Mengirim pesan balasan ke pengguna menggunakan Markdown
-    # Menggunakan parse_mode=ParseMode.MARKDOWN
-    await message.reply_text(welcome_message, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True) # disable_web_page_preview=True agar link contoh tidak menampilkan preview
+    Span pada trace job aktif, atau no-op di luar job.
+    """
+    trace = current_trace.get()
+    return trace.span(name, **attributes) if trace is not None else NOOP_SPAN
 
 
-# Handler untuk perintah /download
-@app.on_message(filters.command("download") & filters.private) # Hanya merespons /download di chat pribadi
-async def handle_download_command(client: Client, message: Message):
+def observe_stage(stage, started_at, ended_at=None, **attributes):
     """
-    Menangani perintah /download. Memproses link, memulai unduhan async, dan mengirim file.
+    Mencatat latensi satu tahap ke histogram metrik dan (jika ada job aktif) sebagai span di trace-nya.
+    started_at/ended_at dari time.monotonic().
     """
-    chat_id = message.chat.id
-    logging.info(f"Received /download command from chat ID: {chat_id}")
+    ended_at = time.monotonic() if ended_at is None else ended_at
+    metrics.stage_seconds.observe(ended_at - started_at, stage=stage)
+    trace = current_trace.get()
+    if trace is not None:
+        attributes = {key: value for key, value in attributes.items() if value is not None}
+        if attributes.get("bytes") and ended_at > started_at:
+            attributes["rate_bps"] = round(attributes["bytes"] / (ended_at - started_at))
+        trace.record(stage, started_at, ended_at, **attributes)
 
-    # Memeriksa apakah URL disediakan setelah perintah
-    if len(message.command) < 2:
-        # Menggunakan parse_mode=ParseMode.MARKDOWN
-        await message.reply_text("Mohon berikan URL setelah perintah /download. Contoh: `/download <link_video>`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-        logging.warning(f"Received /download command without URL from chat ID: {chat_id}")
-        return
 
-    # Mengambil URL dari argumen perintah
-    url = message.command[1].strip()
+def trace_event(name, **attributes):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.event(name, **attributes)
 
-    logging.info(f"Processing download request for URL: {url}")
 
-    # Memberi tahu pengguna bahwa proses unduhan dimulai dan simpan objek pesan ini
-    # Pesan ini akan diupdate dengan progres
-    try:
-        status_message = await message.reply_text(f"Memulai unduhan untuk: `{url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-    except Exception as e:
-        logging.error(f"Gagal mengirim pesan status awal ke {chat_id}: {e}")
-        # Jika gagal mengirim pesan status, tidak bisa update progres. Berikan pesan error fatal.
-        await client.send_message(chat_id, f"❌ Gagal memulai proses unduhan. Tidak dapat mengirim pesan status awal: `{e}`", parse_mode=ParseMode.MARKDOWN)
-        return
+def record_job_result(result, error=None):
+    """
+    Mencatat hasil akhir job (dan pesan error-nya) ke metrik dan ke trace job aktif.
+    """
+    metrics.jobs.inc(result=result)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.attributes["result"] = result
+        if error and trace.error is None:
+            trace.error = str(error)[:500]
 
 
-    # --- Alur Logika Unduhan ---
-    # Memanggil fungsi unduhan yang sekarang async dan melaporkan progres ke status_message
-    downloaded_file_path, error_message = await download_with_ytdlp(url, status_message)
+def otlp_attributes(attributes):
+    converted = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            converted.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            converted.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            converted.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            converted.append({"key": key, "value": {"stringValue": str(value)}})
+    return converted
 
 
-    # --- Mengirim File Setelah Unduhan Selesai atau Melaporkan Error ---
-    if downloaded_file_path:
-        logging.info(f"Unduhan lokal selesai: {downloaded_file_path}. Mengirim file ke {chat_id}.")
-        try:
-            # Update pesan status terakhir sebelum upload
-            try:
-                await status_message.edit_text("✅ Unduhan selesai. Mengunggah file ke Telegram...")
-            except Exception as e:
-                 logging.warning(f"Gagal mengedit pesan status sebelum upload: {e}")
-                 # Kirim pesan baru jika edit gagal
-                 await client.send_message(chat_id, "✅ Unduhan selesai. Mengunggah file ke Telegram...", parse_mode=ParseMode.MARKDOWN)
+class JobTracer:
+    """
+    Menutup trace job: sampling (job gagal/lambat selalu ditulis), batas baris per detik,
+    penulisan JSON lines, dan antrian ekspor OTLP/HTTP yang terbatas.
+    """
+    def __init__(self, enabled, log_path, sample_rate, slow_seconds, max_lines_per_second, otlp_endpoint, otlp_max_queue):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.otlp_endpoint = otlp_endpoint
+        self._bucket = TokenBucket(max_lines_per_second, max(1, max_lines_per_second))
+        self._otlp_queue = collections.deque(maxlen=otlp_max_queue)
+        self._otlp_task = None
+        # Logger terpisah tanpa format tambahan: setiap record adalah satu baris JSON
+        self.logger = logging.getLogger("ytbot.trace")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if enabled and not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout) if log_path == "-" else logging.FileHandler(log_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
 
+    def begin(self, job_id, started_at=None, **attributes):
+        if not self.enabled:
+            return None
+        return JobTrace(job_id, time.monotonic() if started_at is None else started_at, **attributes)
 
-            # Mengunggah file menggunakan Pyrogram
-            # send_document lebih cocok untuk file media
-            await client.send_document(
-                chat_id=chat_id, # ID chat tujuan
-                document=downloaded_file_path, # Path ke file lokal
-                caption=f"✅ Unduhan selesai:\n`{url}`", # Contoh caption dengan Markdown
-                parse_mode=ParseMode.MARKDOWN, # Menggunakan ParseMode.MARKDOWN
-                # Pertimbangkan penambahan progress callback untuk upload juga jika file besar
-                disable_web_page_preview=True # Disable preview link di caption
-            )
-            logging.info(f"File {downloaded_file_path} berhasil dikirim ke {chat_id}")
+    def _sampled(self, trace: JobTrace, duration):
+        if trace.error or trace.attributes.get("result") not in (None, "success", "cached") or duration >= self.slow_seconds:
+            return True
+        # Keputusan deterministik dari trace_id agar rate konsisten
+        return int(trace.trace_id[:8], 16) / 0xFFFFFFFF < self.sample_rate
 
-            # --- Cleanup ---
-            # Opsional: Hapus file lokal setelah dikirim
+    def finish(self, trace: JobTrace):
+        if trace is None:
+            return
+        ended_at = time.monotonic()
+        if self.otlp_endpoint:
+            self._otlp_queue.extend(self._otlp_spans(trace, ended_at))
+        if not self._sampled(trace, ended_at - trace.started_at):
+            metrics.traces.inc(outcome="sampled_out")
+            return
+        if self._bucket.time_until_token(ended_at) > 0:
+            metrics.traces.inc(outcome="rate_limited")
+            return
+        self._bucket.consume(ended_at)
+        metrics.traces.inc(outcome="written")
+        self.logger.info(trace.to_json_line(ended_at))
+
+    def _otlp_spans(self, trace: JobTrace, ended_at):
+        def nanos(monotonic_time):
+            return str(int((monotonic_time + trace.wall_offset) * 1e9))
+
+        root_span_id = uuid.uuid4().hex[:16]
+        root_attributes = dict(trace.attributes, job_id=trace.job_id)
+        spans = [{
+            "traceId": trace.trace_id, "spanId": root_span_id, "name": "job", "kind": 1,
+            "startTimeUnixNano": nanos(trace.started_at), "endTimeUnixNano": nanos(ended_at),
+            "attributes": otlp_attributes(root_attributes),
+            "status": {"code": 2, "message": trace.error} if trace.error else {"code": 1},
+        }]
+        for span in trace.spans:
+            spans.append({
+                "traceId": trace.trace_id, "spanId": uuid.uuid4().hex[:16], "parentSpanId": root_span_id,
+                "name": span["name"], "kind": 1,
+                "startTimeUnixNano": nanos(span["start"]), "endTimeUnixNano": nanos(span["end"]),
+                "attributes": otlp_attributes(span["attributes"]),
+                "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+            })
+        return spans
+
+    def start(self):
+        """
+        Memulai task ekspor OTLP jika endpoint dikonfigurasi. Harus dipanggil dari dalam event loop.
+        """
+        if self.enabled and self.otlp_endpoint:
+            self._otlp_task = asyncio.create_task(self._export_loop())
+            logging.info(f"Exporter trace OTLP aktif ke {self.otlp_endpoint}.")
+
+    async def stop(self):
+        if self._otlp_task is not None:
+            self._otlp_task.cancel()
+            await asyncio.gather(self._otlp_task, return_exceptions=True)
+            self._otlp_task = None
+            await self._export_batch() # Kirim sisa span sebelum keluar (sekali coba)
+
+    async def _export_loop(self):
+        while True:
+            await asyncio.sleep(TRACE_OTLP_INTERVAL)
             try:
-                logging.info(f"Menghapus file lokal: {downloaded_file_path}")
-                os.remove(downloaded_file_path)
-                logging.info(f"File {downloaded_file_path} dihapus.")
+                await self._export_batch()
             except Exception as e:
-                 logging.error(f"Gagal menghapus file lokal {downloaded_file_path}: {e}")
+                logging.warning(f"Ekspor trace OTLP gagal, batch dibuang: {e}")
 
-        except Exception as e:
-            logging.error(f"Gagal mengirim file {downloaded_file_path} ke {chat_id}: {e}")
-            # Menggunakan parse_mode=ParseMode.MARKDOWN
-            try:
-                 await status_message.edit_text(f"❌ Gagal mengirim file `{os.path.basename(downloaded_file_path)}`:\n`{e}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-            except Exception as edit_e:
-                 logging.warning(f"Gagal mengedit pesan error pengiriman: {edit_e}. Mengirim pesan error baru.")
-                 await client.send_message(chat_id, f"❌ Gagal mengirim file `{os.path.basename(downloaded_file_path)}`:\n`{e}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    async def _export_batch(self):
+        if not self._otlp_queue:
+            return
+        spans = [self._otlp_queue.popleft() for _ in range(min(512, len(self._otlp_queue)))]
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": "ytbot", "ytbot.role": BOT_ROLE})},
+            "scopeSpans": [{"scope": {"name": "ytbot"}, "spans": spans}],
+        }]}
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(self.otlp_endpoint, json=payload) as response:
+                if response.status >= 300:
+                    raise RuntimeError(f"HTTP {response.status}: {(await response.text())[:200]}")
 
 
-            # Penting: Jika pengiriman gagal, file lokal mungkin masih ada. Hapus di sini juga.
-            try:
-                 logging.info(f"Mencoba menghapus file lokal setelah gagal kirim: {downloaded_file_path}")
-                 os.remove(downloaded_file_path)
-                 logging.info(f"File {downloaded_file_path} dihapus setelah gagal kirim.")
-            except Exception as del_e:
-                 logging.error(f"Gagal menghapus file lokal {downloaded_file_path} setelah gagal kirim: {del_e}")
+job_tracer = JobTracer(
+    TRACE_ENABLED, TRACE_LOG_PATH, TRACE_SAMPLE_RATE, TRACE_SLOW_JOB_SECONDS,
+    TRACE_MAX_LINES_PER_SECOND, TRACE_OTLP_ENDPOINT, TRACE_OTLP_MAX_QUEUE,
+)
 
 
-    else:
-        # Jika unduhan gagal (error_message sudah diisi oleh download_with_ytdlp)
-        logging.error(f"Unduhan gagal untuk {url}. Error: {error_message}")
-        # Edit pesan status terakhir dengan pesan error
-        try:
-             await status_message.edit_text(f"❌ Unduhan gagal untuk `{url}`.\nError: `{error_message}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-        except Exception as edit_e:
-             logging.warning(f"Gagal mengedit pesan error unduhan: {edit_e}. Mengirim pesan error baru.")
-             await client.send_message(chat_id, f"❌ Unduhan gagal untuk `{url}`.\nError: `{error_message}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+# --- Fungsi untuk Memanggil yt-dlp dan Melaporkan Progres ---
+# Penanda baris hasil akhir di stdout yt-dlp. Dicetak lewat --print after_move:... sehingga
+# path file final dan metadata didapat dari proses unduhan yang sama (tanpa yt-dlp -j kedua).
+YTDLP_RESULT_PREFIX = "__BOT_RESULT__ "
+# Field info yt-dlp yang ikut dicetak di baris hasil (dipakai untuk upload dan cache)
+YTDLP_RESULT_FIELDS = "id,title,uploader,ext,filepath,duration,width,height,filesize,filesize_approx,extractor_key,webpage_url,format_id,vcodec,acodec"
+# Field progres yang diteruskan dari progress hook worker in-process (info_dict tidak ikut karena besar)
+YTDLP_PROGRESS_FIELDS = ("status", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "speed", "eta", "elapsed", "filename", "fragment_index", "fragment_count")
 
 
-    # Opsional: Membersihkan direktori unduhan secara berkala atau setelah setiap unduhan
-    # Jika DOWNLOAD_DIR hanya digunakan oleh satu proses download pada satu waktu, bisa dibersihkan.
-    # Jika multiple concurrent downloads mungkin terjadi, ini TIDAK AMAN.
-    # Pendekatan yang lebih aman adalah memastikan setiap file dihapus setelah diproses.
-    # Kode cleanup os.remove() di atas lebih disarankan.
+class DownloadProgressReporter:
+    """
+    Mengubah data progres yt-dlp (baris JSON di stdout atau progress hook in-process)
+    menjadi update pesan status. Frekuensi edit diatur oleh progress_updater.
+    """
+    def __init__(self, url, status_message, reservation=None, tuning=None):
+        self.url = url
+        self.status_message = status_message # StatusMessageGroup
+        self.reservation = reservation # DiskReservation job, dinaikkan saat ukuran sebenarnya diketahui
+        self.tuning = tuning # DownloadTuning: mengumpulkan sampel kecepatan untuk profil host
+        self.last_progress_text = "" # Untuk menghindari update jika progress sama
+        self.total_bytes_by_file = {} # Ukuran per stream (video dan audio diunduh terpisah sebelum merge)
+        # Waktu per tahap untuk metrik: ekstraksi -> unduh -> merge/post-processing
+        self.started_at = time.monotonic()
+        self.download_started_at = None
+        self.download_finished_at = None
+        self._last_parsed_at = None # Waktu parsing baris progres terakhir (lihat needs_parse)
+        self.skipped_lines = 0
 
+    def needs_parse(self, line):
+        """
+        Menentukan apakah baris progres mentah (bytes) perlu di-decode dan di-parse. Baris status
+        selain "downloading" (finished, error) selalu diproses; baris "downloading" hanya sekali per
+        PROGRESS_PARSE_INTERVAL karena update pesan tetap di-throttle di belakangnya.
+        """
+        if b'"downloading"' not in line:
+            return True
+        now = time.monotonic()
+        if self._last_parsed_at is not None and now - self._last_parsed_at < PROGRESS_PARSE_INTERVAL:
+            self.skipped_lines += 1
+            return False
+        self._last_parsed_at = now
+        return True
 
-# --- Menjalankan Bot dan Health Check Server ---
-# --- Menjalankan Bot dan Health Check Server ---
-# Struktur terbaik dengan Pyrogram async:
-async def main():
-    logging.info("Memulai aplikasi bot dan health check server...")
-    # 1. Mulai Health Check Server sebagai task
-    health_server_task = asyncio.create_task(start_health_server())
-    logging.info("Health check server task created.")
+    @property
+    def expected_total_bytes(self):
+        """
+        Perkiraan ukuran akhir dari total_bytes di progres yt-dlp (jumlah semua stream).
+        """
+        return sum(self.total_bytes_by_file.values())
 
-    # 2. Start Pyrogram Client (async)
-    # Ini akan terhubung dan mengotentikasi bot
-    await app.start()
-    logging.info("Pyrogram Client terhubung ke Telegram.")
-    logging.info("Bot siap menerima perintah.")
+    def observe_stages(self):
+        """
+        Mencatat latensi tahap extract/download/merge ke metrik dan trace job setelah yt-dlp selesai.
+        """
+        if self.download_started_at is None:
+            return
+        observe_stage("extract", self.started_at, self.download_started_at)
+        if self.download_finished_at is not None:
+            observe_stage("download", self.download_started_at, self.download_finished_at,
+                          bytes=self.expected_total_bytes or None, streams=len(self.total_bytes_by_file))
+            observe_stage("merge", self.download_finished_at)
+
+    async def report(self, progress_data):
+        """
+        Memproses satu data progres. Mengembalikan False jika status tidak dikenali sebagai progres.
+        """
+        url = self.url
+        status_message = self.status_message
+
+        if self.tuning is not None:
+            self.tuning.observe(progress_data)
+
+        # Cek status unduhan
+        status = progress_data.get("status")
+        if status == "downloading" and self.download_started_at is None:
+            self.download_started_at = time.monotonic()
+        if status == "finished":
+            self.download_finished_at = time.monotonic()
+            logging.info(f"Unduhan selesai: {url}")
+            # Kirim update progres terakhir. Jangan berhenti membaca: baris hasil after_move
+            # (dan stream kedua untuk format video+audio) masih akan menyusul.
+            final_progress_text = f"Mengunduh: `{url}`\n**✅ Selesai**"
+            if final_progress_text != self.last_progress_text:
+                # Non-blocking: pembaca pipe tidak boleh menunggu rate limit edit Telegram
+                status_message.update_progress(final_progress_text, parse_mode=ParseMode.MARKDOWN)
+                self.last_progress_text = final_progress_text
+            return True
+
+        if status != "downloading" and status != "extracting":
+            return False
+
+        # Parsing data progres untuk status downloading/extracting
+        speed = progress_data.get("speed") # byte/detik
+        eta = progress_data.get("eta") # detik
+        downloaded_bytes = progress_data.get("downloaded_bytes")
+        total_bytes = progress_data.get("total_bytes") or progress_data.get("total_bytes_estimate") # total bisa estimasi
+        percent = progress_data.get("fraction_downloaded") # 0.0 - 1.0
+        if percent is None and downloaded_bytes is not None and total_bytes:
+            # yt-dlp versi baru tidak lagi menyertakan fraction_downloaded, hitung dari byte
+            percent = min(downloaded_bytes / total_bytes, 1.0)
+
+        if total_bytes:
+            self.total_bytes_by_file[progress_data.get("filename")] = total_bytes
+            if self.reservation is not None:
+                # File yang harus dipecah butuh ruang dua kali (file asli + bagian-bagiannya)
+                expected = self.expected_total_bytes
+                self.reservation.update(expected * 2 if expected > TELEGRAM_MAX_UPLOAD_BYTES else expected)
+
+        if percent is None:
+            return True
+
+        percent_str = f"{percent * 100:.1f}%"
+        speed_str = "N/A"
+        if speed is not None and speed > 0:
+             speed_str = f"{speed/1024/1024:.2f} MiB/s" if speed > 1024*1024 else f"{speed/1024:.2f} KiB/s"
+        eta_str = "N/A"
+        if eta is not None:
+             minutes, seconds = divmod(int(eta), 60)
+             eta_str = f"{minutes}m {seconds}s" if minutes > 0 else f"{seconds}s"
+
+        downloaded_str = "N/A"
+        if downloaded_bytes is not None:
+             downloaded_str = f"{downloaded_bytes/1024/1024:.2f} MiB" if downloaded_bytes > 1024*1024 else f"{downloaded_bytes/1024:.2f} KiB"
+        total_str = "N/A"
+        if total_bytes is not None:
+             total_str = f"{total_bytes/1024/1024:.2f} MiB" if total_bytes > 1024*1024 else f"{total_bytes/1024:.2f} KiB"
+
+
+        progress_text = (
+            f"Mengunduh: `{url}`\n"
+            f"Status: **{status.capitalize()}**\n" # Status seperti Downloading/Extracting
+            f"Progress: **{percent_str}**\n"
+            f"Sudah terunduh: {downloaded_str} / {total_str}\n"
+            f"Kecepatan: {speed_str}\n"
+            f"ETA: {eta_str}"
+        )
+        if self.expected_total_bytes > TELEGRAM_MAX_UPLOAD_BYTES:
+            # Deteksi dini: pengguna tahu hasilnya akan dikirim dalam beberapa bagian
+            part_count = -(-self.expected_total_bytes // int(TELEGRAM_MAX_UPLOAD_BYTES * 0.9))
+            progress_text += f"\n⚠️ Melebihi batas Telegram, akan dikirim dalam ±{part_count} bagian"
+
+        # Update pesan Telegram lewat layanan terpusat: hanya state terbaru yang dikirim,
+        # dengan interval dan rate limit yang menyesuaikan jumlah job aktif
+        if progress_text != self.last_progress_text: # Hanya update jika teks berubah
+            # Menggunakan disable_web_page_preview=True karena URL di pesan
+            status_message.update_progress(progress_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            self.last_progress_text = progress_text
+        return True
+
+
+# --- Pembaca Output Subprocess yt-dlp ---
+class StderrTail:
+    """
+    Ring buffer baris stderr terakhir: pesan error memakai ekor output, memori tetap terbatas.
+    """
+    def __init__(self, max_lines=YTDLP_STDERR_TAIL_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def to_list(self):
+        if self.dropped:
+            return [f"... ({self.dropped} baris sebelumnya dilewati)", *self.lines]
+        return list(self.lines)
+
+    def text(self):
+        return "\n".join(self.to_list())
+
+
+async def read_stream_lines(stream, on_line):
+    """
+    Membaca stream subprocess baris per baris (bytes, tanpa newline) sampai EOF dan memanggil on_line.
+    Baris yang melebihi YTDLP_PIPE_LIMIT dibuang, bukan menghentikan pembacaan (pipe tetap dikuras).
+    """
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError as e:
+            logging.warning(f"Baris output subprocess terlalu panjang, dilewati: {e}")
+            continue
+        if not line:
+            return
+        line = line.strip()
+        if line:
+            result = on_line(line)
+            if asyncio.iscoroutine(result):
+                await result
+
+
+# --- Cookie Jar (Diparse dan Divalidasi Sekali saat Boot) ---
+def parse_netscape_cookies(text):
+    """
+    Mem-parse isi cookies.txt (format Netscape, seperti yang dibaca yt-dlp).
+    Mengembalikan (daftar cookie dict, jumlah baris rusak).
+    """
+    cookies = []
+    invalid_lines = 0
+    for line in text.splitlines():
+        http_only = line.startswith("#HttpOnly_")
+        if http_only:
+            line = line[len("#HttpOnly_"):]
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) != 7 or not (fields[4] == "" or fields[4].isdigit()):
+            invalid_lines += 1
+            continue
+        domain, include_subdomains, path, secure, expires, name, value = fields
+        cookies.append({
+            "domain": domain, "include_subdomains": include_subdomains == "TRUE", "path": path,
+            "secure": secure == "TRUE", "expires": int(expires or 0), "name": name, "value": value,
+            "http_only": http_only,
+        })
+    return cookies, invalid_lines
+
+
+def format_netscape_cookies(cookies):
+    """
+    Kebalikan parse_netscape_cookies(): menyusun isi cookies.txt dari daftar cookie dict.
+    """
+    lines = ["# Netscape HTTP Cookie File"]
+    for cookie in cookies:
+        lines.append("\t".join([
+            ("#HttpOnly_" if cookie["http_only"] else "") + cookie["domain"],
+            "TRUE" if cookie["include_subdomains"] else "FALSE", cookie["path"],
+            "TRUE" if cookie["secure"] else "FALSE", str(cookie["expires"]), cookie["name"], cookie["value"],
+        ]))
+    return "\n".join(lines) + "\n"
+
+
+def _cookie_key(cookie):
+    return cookie["domain"], cookie["path"], cookie["name"]
+
+
+def _write_private_file(path, text):
+    # Cookies adalah kredensial: file lease hanya bisa dibaca pemilik proses
+    file_descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(file_descriptor, "w", encoding="utf-8") as cookies_file:
+        cookies_file.write(text)
+
+
+# Lease cookies aktif untuk job/coroutine ini (diset CookieLease), dibaca get_cookies_file_for_job()
+# di semua builder perintah/opsi yt-dlp tanpa perlu meneruskan path lewat argumen
+current_cookies_file = contextvars.ContextVar("current_cookies_file", default=None)
+
+
+class CookieLease:
+    """
+    Salinan subset cookies (domain URL job) di file sementara milik satu pemanggil yt-dlp.
+    yt-dlp menulis ulang file cookies saat keluar; perubahan itu digabung kembali ke jar di memori
+    saat lease ditutup, sehingga job paralel tidak pernah menulis file yang sama.
+    Dipakai sebagai context manager (menyetel current_cookies_file) atau lewat open()/close().
+    """
+    def __init__(self, jar, url):
+        self.jar = jar
+        self.url = url
+        self.path = None
+        self._issued = {}
+        self._token = None
+
+    def open(self):
+        self.path, self._issued = self.jar._issue(self.url)
+        return self.path
+
+    def close(self):
+        if self.path is not None and self._issued is not None:
+            self.jar._collect(self.path, self._issued)
+        self.path = None
+
+    def __enter__(self):
+        path = self.open()
+        self._token = current_cookies_file.set(path)
+        return path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_cookies_file.reset(self._token)
+        self.close()
+        return False
+
+
+class CookieJarState:
+    """
+    Cookie jar bersama di memori: file cookies diparse sekali saat boot, setiap pemanggil yt-dlp
+    mendapat lease berisi subset per domain, perubahan dari yt-dlp ditulis balik secara batch dan
+    atomik (file sementara + os.replace), dan file dimuat ulang otomatis jika diganti dari luar.
+    File yang hilang atau tidak berisi cookie valid tidak diteruskan ke yt-dlp (yang akan gagal di setiap job).
+    """
+    def __init__(self, path, lease_dir, flush_interval=30, reload_interval=10, writeback=True):
+        self.path = path
+        self.lease_dir = lease_dir
+        self.flush_interval = flush_interval
+        self.reload_interval = reload_interval
+        self.writeback = writeback
+        self.loaded = False
+        self.usable = False
+        self.cookies = {} # (domain, path, name) -> cookie dict
+        self.cookie_count = 0
+        self.expired_count = 0
+        self.domain_count = 0
+        self.error = None
+        self.active_leases = 0
+        self.reloads = 0
+        self._mtime_ns = None
+        self._dirty = False
+        self._last_flushed_at = time.monotonic()
+        self._shared_path = None
+        self._task = None
+
+    def _read(self):
+        with open(self.path, encoding="utf-8", errors="replace") as cookies_file:
+            mtime_ns = os.fstat(cookies_file.fileno()).st_mtime_ns
+            cookies, invalid_lines = parse_netscape_cookies(cookies_file.read())
+        return cookies, invalid_lines, mtime_ns
+
+    def _update_stats(self):
+        now = time.time()
+        cookies = self.cookies.values()
+        self.cookie_count = len(self.cookies)
+        # expires 0 = cookie sesi, tetap dipakai
+        self.expired_count = sum(1 for cookie in cookies if 0 < cookie["expires"] < now)
+        self.domain_count = len({cookie["domain"].lstrip(".") for cookie in cookies})
+        self.usable = self.cookie_count > 0
+        self._shared_path = None # Snapshot penuh ditulis ulang saat diminta berikutnya
+
+    def load(self):
+        if not self.path:
+            self.loaded = True
+            return
+        # Lease sisa proses sebelumnya (crash) tidak akan pernah digabung lagi
+        shutil.rmtree(self.lease_dir, ignore_errors=True)
+        try:
+            os.makedirs(self.lease_dir, exist_ok=True)
+            cookies, invalid_lines, self._mtime_ns = self._read()
+        except OSError as e:
+            self.error = f"File cookies tidak bisa dibaca: {e}"
+            logging.warning(f"{self.error}. Unduhan berjalan tanpa cookies.")
+            self.loaded = True
+            return
+        self.cookies = {_cookie_key(cookie): cookie for cookie in cookies}
+        self._update_stats()
+        if invalid_lines:
+            logging.warning(f"{invalid_lines} baris rusak di {self.path} dilewati.")
+        if not self.usable:
+            self.error = "File cookies tidak berisi cookie valid (format Netscape)."
+            logging.warning(f"{self.error} Unduhan berjalan tanpa cookies.")
+        else:
+            logging.info(f"Cookies dimuat: {self.cookie_count} cookie untuk {self.domain_count} domain ({self.expired_count} kedaluwarsa).")
+            if self.expired_count == self.cookie_count:
+                logging.warning(f"Semua cookie di {self.path} sudah kedaluwarsa; perbarui file cookies.")
+        self.loaded = True
+
+    def _subset(self, url):
+        """
+        Cookie untuk domain terdaftar host URL (www.youtube.com -> *.youtube.com, www.bbc.co.uk ->
+        *.bbc.co.uk). Jika tidak ada yang cocok (misalnya URL pendek yang dialihkan ke domain lain),
+        seluruh jar diberikan.
+        """
+        base = profile_host(url) if url else ""
+        if base:
+            subset = [
+                cookie for cookie in self.cookies.values()
+                if cookie["domain"].lstrip(".") == base or cookie["domain"].endswith("." + base)
+            ]
+            if subset:
+                return subset
+        return list(self.cookies.values())
+
+    def _issue(self, url):
+        if not self.loaded:
+            # Dipanggil sebelum fase boot cookies (misalnya dari benchmark/skrip): perilaku lama
+            return (self.path if self.path and os.path.exists(self.path) else None), None
+        if not self.usable:
+            return None, None
+        subset = self._subset(url)
+        path = os.path.join(self.lease_dir, f"{uuid.uuid4().hex}.txt")
+        try:
+            _write_private_file(path, format_netscape_cookies(subset))
+        except OSError as e:
+            logging.warning(f"Gagal menulis lease cookies {path}, job berjalan tanpa cookies: {e}")
+            return None, None
+        self.active_leases += 1
+        return path, {_cookie_key(cookie): cookie for cookie in subset}
+
+    def _collect(self, path, issued):
+        """
+        Menggabungkan file lease yang (mungkin) ditulis ulang yt-dlp ke jar di memori, lalu menghapusnya.
+        """
+        self.active_leases -= 1
+        try:
+            with open(path, encoding="utf-8", errors="replace") as cookies_file:
+                returned, _ = parse_netscape_cookies(cookies_file.read())
+        except OSError:
+            returned = None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if returned is None:
+            return
+        returned = {_cookie_key(cookie): cookie for cookie in returned}
+        changed = 0
+        for key, cookie in returned.items():
+            if issued.get(key) != cookie and self.cookies.get(key) != cookie:
+                self.cookies[key] = cookie
+                changed += 1
+        for key, cookie in issued.items():
+            # Dihapus yt-dlp (server menghapus/mengganti cookie), hanya jika belum diubah lease lain
+            if key not in returned and self.cookies.get(key) == cookie:
+                del self.cookies[key]
+                changed += 1
+        if changed:
+            self._update_stats()
+            self._dirty = True
+            logging.debug(f"{changed} perubahan cookie dari lease digabung, menunggu ditulis balik.")
+
+    def lease(self, url):
+        return CookieLease(self, url)
+
+    def shared_file(self):
+        """
+        Snapshot seluruh jar untuk pembaca yang tidak menulis balik dan tidak terikat job (daemon aria2c).
+        """
+        if not self.loaded:
+            return self.path if self.path and os.path.exists(self.path) else None
+        if not self.usable:
+            return None
+        if self._shared_path is None:
+            path = os.path.join(self.lease_dir, "shared.txt")
+            try:
+                _write_private_file(path, format_netscape_cookies(self.cookies.values()))
+            except OSError as e:
+                logging.warning(f"Gagal menulis snapshot cookies {path}: {e}")
+                return None
+            self._shared_path = path
+        return self._shared_path
+
+    def _snapshot(self):
+        self._dirty = False
+        self._last_flushed_at = time.monotonic()
+        # Diserialisasi di event loop agar thread penulis tidak membaca dict yang sedang diubah
+        return format_netscape_cookies(self.cookies.values())
+
+    def _write(self, payload):
+        """
+        Menulis jar secara atomik (file sementara + os.replace). Mengembalikan mtime file baru atau None.
+        """
+        temp_path = f"{self.path}.tmp"
+        try:
+            _write_private_file(temp_path, payload)
+            os.replace(temp_path, self.path)
+            return os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logging.warning(f"Gagal menulis balik cookies ke {self.path}, penulisan balik dinonaktifkan: {e}")
+            self.writeback = False
+            return None
+
+    async def _reload_if_changed(self):
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns == self._mtime_ns:
+            return
+        try:
+            cookies, invalid_lines, mtime_ns = await asyncio.to_thread(self._read)
+        except OSError as e:
+            logging.warning(f"File cookies {self.path} berubah tapi tidak bisa dibaca: {e}")
+            return
+        self._mtime_ns = mtime_ns
+        if not cookies:
+            # Kemungkinan file sedang ditulis (bukan atomik) atau rusak: jar lama tetap dipakai
+            logging.warning(f"File cookies {self.path} berubah tapi tidak berisi cookie valid, jar lama tetap dipakai.")
+            return
+        if self._dirty:
+            logging.warning("Perubahan cookie dari job yang belum ditulis balik dibuang: file cookies diganti dari luar.")
+        self.cookies = {_cookie_key(cookie): cookie for cookie in cookies}
+        self._update_stats()
+        self._dirty = False
+        self.error = None
+        self.reloads += 1
+        logging.info(f"Cookies dimuat ulang dari {self.path}: {self.cookie_count} cookie untuk {self.domain_count} domain ({invalid_lines} baris rusak).")
+
+    async def flush(self):
+        if self._dirty and self.writeback:
+            mtime_ns = await asyncio.to_thread(self._write, self._snapshot())
+            if mtime_ns is not None:
+                # Tulisan sendiri tidak boleh memicu hot reload
+                self._mtime_ns = mtime_ns
+
+    def start(self):
+        """
+        Memulai task hot reload + penulisan balik batch. Harus dipanggil dari dalam event loop setelah load().
+        """
+        if self.path and self.loaded and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.flush() # Perubahan yang masih tertunda ditulis sebelum keluar
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                # Cek perubahan dari luar lebih dulu agar flush tidak menimpa file yang baru diganti
+                await self._reload_if_changed()
+                if time.monotonic() - self._last_flushed_at >= self.flush_interval:
+                    await self.flush()
+            except Exception as e:
+                logging.error(f"Pemeliharaan cookie jar gagal: {e}")
+
+    def summary(self):
+        return {
+            "usable": self.usable, "cookies": self.cookie_count, "expired": self.expired_count, "error": self.error,
+            "active_leases": self.active_leases, "pending_writeback": self._dirty, "reloads": self.reloads,
+        }
+
+
+cookie_jar = CookieJarState(COOKIES_FILE_PATH, COOKIES_LEASE_DIR, COOKIES_FLUSH_INTERVAL, COOKIES_RELOAD_INTERVAL, COOKIES_WRITEBACK)
+
+
+def get_cookies_file_for_job():
+    """
+    Mengembalikan path file cookies untuk perintah/opsi yt-dlp yang sedang disusun: file lease job
+    ini jika ada, selain itu snapshot seluruh jar (read-only). None jika tidak ada cookies yang valid.
+    """
+    leased = current_cookies_file.get()
+    if leased is not None:
+        return leased
+    return cookie_jar.shared_file()
+
+
+# --- Tuning Koneksi Unduhan per Host (Adaptif) ---
+# Level yang dicoba; aria2c sendiri membatasi -x maksimal 16
+TUNING_LEVELS = (1, 2, 4, 8, 16)
+# Bobot sampel baru pada rata-rata kecepatan (EWMA) per level
+TUNING_EWMA_ALPHA = 0.3
+# Level lebih rendah dipilih jika kecepatannya minimal sebesar ini dari level tercepat (hemat koneksi)
+TUNING_GOOD_ENOUGH = 0.9
+# Error yang menandakan host membatasi/memblokir koneksi paralel
+THROTTLE_ERROR_PATTERN = re.compile(r"\b(403|429|503)\b|Too Many Requests|Connection reset|timed out|network problem", re.IGNORECASE)
+# Suffix domain dua label (co.uk, com.br, ...) yang bukan domain milik situs
+SHORT_SECOND_LEVEL_LABELS = {"co", "com", "net", "org", "ac", "gov", "edu"}
+
+
+def profile_host(url):
+    """
+    Kunci profil untuk URL: domain terdaftar (rr3---sn-abc.googlevideo.com -> googlevideo.com), sehingga
+    server-server CDN yang berganti per video tetap berbagi satu profil.
+    """
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    labels = host.split(".")
+    if len(labels) <= 2 or host.replace(".", "").isdigit():
+        return host
+    if labels[-2] in SHORT_SECOND_LEVEL_LABELS and len(labels[-1]) == 2:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+class DownloadTuning:
+    """
+    Pilihan koneksi untuk satu unduhan dan kecepatan yang teramati selama unduhan berjalan.
+    """
+    def __init__(self, host, connections, concurrent_fragments, expected_size=None):
+        self.host = host
+        self.connections = connections
+        self.concurrent_fragments = concurrent_fragments
+        self.expected_size = expected_size
+        self.fragmented = False # Terdeteksi dari fragment_count di progres (HLS/DASH)
+        self.speed_samples = []
+
+    @property
+    def chunk_size_mb(self):
+        """
+        -k aria2c (min-split-size): file besar dipotong lebih kasar agar tiap koneksi tidak terus membuka request baru.
+        """
+        if not self.expected_size:
+            return 1
+        return max(1, min(16, self.expected_size // (self.connections * 4 * 1024 * 1024)))
+
+    def aria2_args(self):
+        return ["-x", str(self.connections), "-s", str(self.connections), "-k", f"{self.chunk_size_mb}M"]
+
+    def observe(self, progress_data):
+        """
+        Dipanggil DownloadProgressReporter untuk setiap data progres yang di-parse.
+        """
+        if progress_data.get("status") != "downloading":
+            return
+        if progress_data.get("fragment_count"):
+            self.fragmented = True
+        speed = progress_data.get("speed")
+        if speed:
+            self.speed_samples.append(speed)
+
+    @property
+    def average_speed(self):
+        if not self.speed_samples:
+            return None
+        return sum(self.speed_samples) / len(self.speed_samples)
+
+
+def _expected_size(info):
+    streams = (info.get("requested_formats") or [info]) if info else []
+    sizes = [stream.get("filesize") or stream.get("filesize_approx") for stream in streams]
+    return sum(sizes) if sizes and all(sizes) else None
+
+
+class HostTuner:
+    """
+    Profil per host: rata-rata kecepatan (EWMA) per level koneksi aria2c dan per level fragmen paralel,
+    plus batas atas sementara setelah error throttle. Level dipilih dengan hill-climbing: level terbaik
+    yang diketahui, satu level di atasnya dicoba sekali jika belum pernah, dan level lebih rendah
+    diutamakan jika hampir sama cepat.
+    """
+    def __init__(self, path, enabled=True, max_hosts=HOST_PROFILE_MAX_HOSTS, save_interval=30):
+        self.path = path
+        self.enabled = enabled
+        self.max_hosts = max_hosts
+        self.save_interval = save_interval
+        self.profiles = {}
+        self._dirty = False
+        self._last_saved_at = time.monotonic()
+
+    def load(self):
+        if not self.enabled or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as profiles_file:
+                self.profiles = json.load(profiles_file)
+            logging.info(f"{len(self.profiles)} profil host dimuat dari {self.path}.")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Profil host {self.path} tidak bisa dibaca, mulai dari nol: {e}")
+            self.profiles = {}
+
+    def _snapshot(self):
+        if len(self.profiles) > self.max_hosts:
+            by_age = sorted(self.profiles, key=lambda host: self.profiles[host].get("last_used", 0))
+            for host in by_age[:len(self.profiles) - self.max_hosts]:
+                del self.profiles[host]
+        self._dirty = False
+        self._last_saved_at = time.monotonic()
+        # Diserialisasi di event loop agar thread penulis tidak membaca dict yang sedang diubah
+        return json.dumps(self.profiles)
+
+    def _write(self, payload):
+        """
+        Menulis profil secara atomik (file sementara + os.replace).
+        """
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as profiles_file:
+                profiles_file.write(payload)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Gagal menyimpan profil host ke {self.path}: {e}")
+
+    def save(self):
+        if self._dirty:
+            self._write(self._snapshot())
+
+    @staticmethod
+    def _choose(stats, default, now):
+        ceiling = stats.get("ceiling", TUNING_LEVELS[-1]) if stats.get("ceiling_until", 0) > now else TUNING_LEVELS[-1]
+        allowed = [level for level in TUNING_LEVELS if level <= ceiling]
+        speeds = {int(level): speed for level, speed in stats.get("speeds", {}).items() if int(level) in allowed}
+        if not speeds:
+            return max([level for level in allowed if level <= default] or allowed[:1])
+        fastest = max(speeds.values())
+        best = min(level for level, speed in speeds.items() if speed >= fastest * TUNING_GOOD_ENOUGH)
+        higher = [level for level in allowed if level > best]
+        if higher and higher[0] not in speeds and best == max(speeds):
+            return higher[0] # Belum pernah dicoba: eksplorasi satu level ke atas
+        return best
+
+    def tuning_for(self, url, info=None):
+        """
+        Pilihan koneksi untuk unduhan berikutnya. Dengan info hasil probe, host diambil dari URL stream media.
+        """
+        streams = (info.get("requested_formats") or [info]) if info else []
+        stream_url = next((stream.get("url") for stream in streams if stream.get("url")), None)
+        host = profile_host(stream_url or url)
+        if not self.enabled:
+            return DownloadTuning(host, ARIA2_DEFAULT_CONNECTIONS, DEFAULT_CONCURRENT_FRAGMENTS, _expected_size(info))
+        profile = self.profiles.get(host, {})
+        now = time.time()
+        return DownloadTuning(
+            host,
+            self._choose(profile.get("aria2", {}), ARIA2_DEFAULT_CONNECTIONS, now),
+            self._choose(profile.get("fragments", {}), DEFAULT_CONCURRENT_FRAGMENTS, now),
+            _expected_size(info),
+        )
+
+    async def record(self, tuning: DownloadTuning, error_message=None):
+        """
+        Mencatat hasil unduhan: kecepatan rata-rata untuk level yang dipakai, atau penalti jika gagal karena throttle.
+        """
+        if not self.enabled or not tuning.host:
+            return
+        kind, level = ("fragments", tuning.concurrent_fragments) if tuning.fragmented else ("aria2", tuning.connections)
+        profile = self.profiles.setdefault(tuning.host, {})
+        stats = profile.setdefault(kind, {})
+        profile["last_used"] = time.time()
+        if error_message and THROTTLE_ERROR_PATTERN.search(error_message):
+            lower = [candidate for candidate in TUNING_LEVELS if candidate < level]
+            stats["ceiling"] = lower[-1] if lower else TUNING_LEVELS[0]
+            stats["ceiling_until"] = time.time() + HOST_PROFILE_PENALTY_SECONDS
+            profile["errors"] = profile.get("errors", 0) + 1
+            # Kecepatan lama di level yang kini diblokir tidak relevan lagi
+            stats["speeds"] = {key: speed for key, speed in stats.get("speeds", {}).items() if int(key) < level}
+            logging.info(f"Host {tuning.host}: error throttle pada {level} {kind}, batas diturunkan ke {stats['ceiling']}.")
+        elif not error_message and tuning.average_speed:
+            speeds = stats.setdefault("speeds", {})
+            previous = speeds.get(str(level))
+            speed = tuning.average_speed
+            speeds[str(level)] = speed if previous is None else previous + TUNING_EWMA_ALPHA * (speed - previous)
+        else:
+            return
+        self._dirty = True
+        if time.monotonic() - self._last_saved_at >= self.save_interval:
+            await asyncio.to_thread(self._write, self._snapshot())
+
+
+host_tuner = HostTuner(HOST_PROFILES_PATH, ADAPTIVE_TUNING_ENABLED)
+
+
+def default_download_tuning():
+    return DownloadTuning("", ARIA2_DEFAULT_CONNECTIONS, DEFAULT_CONCURRENT_FRAGMENTS)
+
+
+def build_ytdlp_command(url, format_selector=DOWNLOAD_FORMAT_SELECTOR, info_path=None, output_dir=DOWNLOAD_DIR, tuning: DownloadTuning = None):
+    """
+    Menyusun argumen CLI yt-dlp untuk engine subprocess.
+    Jika info_path diberikan, metadata hasil probe dipakai ulang (--load-info-json) tanpa ekstraksi ulang.
+    output_dir adalah direktori milik job, sehingga fragmen .part dari run sebelumnya bisa dilanjutkan.
+    tuning menentukan jumlah koneksi aria2c dan fragmen paralel (lihat HostTuner).
+    """
+    tuning = tuning or default_download_tuning()
+    output_template = os.path.join(output_dir, "%(title)s.%(ext)s")
+
+    # Base command untuk yt-dlp
+    ytdlp_command = [
+        "yt-dlp",
+        "--ignore-errors",
+        "--restrict-filenames",
+        "--no-warnings",
+        "--newline", # Penting: memastikan setiap line output diakhiri newline
+        "--progress", # Aktifkan output progres
+        "--progress-template", "%(progress)j", # Output progres dalam format JSON
+        # Cetak path final + metadata ke stdout setelah file dipindah ke lokasi akhir (setelah merge/postprocess)
+        "--print", f"after_move:{YTDLP_RESULT_PREFIX}%(.{{{YTDLP_RESULT_FIELDS}}})j",
+        "-f", format_selector, # Format hasil probe, atau selector yang muat di batas upload Telegram
+        "-o", output_template,
+        "--continue", # Lanjutkan fragmen .part yang tertinggal (job yang dilanjutkan setelah restart)
+        "--external-downloader", "aria2c", # Menggunakan aria2c (pastikan terinstal di Dockerfile)
+        # HLS/DASH: argumen koneksi aria2c tidak berlaku per fragmen, jadi pakai downloader bawaan dengan fragmen paralel
+        "--external-downloader", "dash,m3u8:native",
+        "--external-downloader-args", f"aria2c:{' '.join(tuning.aria2_args())}",
+        "--concurrent-fragments", str(tuning.concurrent_fragments),
+        # Argumen tambahan lainnya jika diperlukan...
+    ]
+
+    # --- Tambahkan argumen cookies jika file cookies tersedia ---
+    cookies_file = get_cookies_file_for_job()
+    if cookies_file:
+         logging.info(f"Menambahkan argumen cookies: --cookies {cookies_file}")
+         ytdlp_command.extend(["--cookies", cookies_file])
+
+    # Tambahkan URL (atau file info hasil probe) sebagai elemen terakhir
+    if info_path:
+        ytdlp_command.extend(["--load-info-json", info_path])
+    else:
+        ytdlp_command.append(url)
+    return ytdlp_command
+
+
+def build_ytdlp_options(format_selector=DOWNLOAD_FORMAT_SELECTOR, output_dir=DOWNLOAD_DIR, tuning: DownloadTuning = None):
+    """
+    Menyusun opsi YoutubeDL untuk engine in-process. Harus setara dengan build_ytdlp_command().
+    """
+    tuning = tuning or default_download_tuning()
+    options = {
+        "ignoreerrors": True,
+        "restrictfilenames": True,
+        "no_warnings": True,
+        "quiet": True,
+        "noprogress": True, # Progres dikirim lewat progress hook, bukan dicetak
+        "format": format_selector,
+        "outtmpl": os.path.join(output_dir, "%(title)s.%(ext)s"),
+        "continuedl": True,
+        "external_downloader": {"default": "aria2c", "dash": "native", "m3u8": "native"},
+        "external_downloader_args": {"aria2c": tuning.aria2_args()},
+        "concurrent_fragment_downloads": tuning.concurrent_fragments,
+    }
+    cookies_file = get_cookies_file_for_job()
+    if cookies_file:
+        options["cookiefile"] = cookies_file
+    return options
+
+
+def _pick_downloaded_file(url, results, failed, error_lines):
+    """
+    Memilih file hasil unduhan dari daftar hasil after_move.
+    Mengembalikan (path, metadata, error) dengan konvensi yang sama seperti download_with_ytdlp.
+    """
+    # Path final diambil dari field 'filepath' yang dilaporkan yt-dlp setelah after_move
+    for media_info in results:
+        downloaded_file_path = media_info.get('filepath')
+        if downloaded_file_path and os.path.exists(downloaded_file_path):
+            if failed:
+                # --ignore-errors: sebagian item bisa gagal tetapi file ini berhasil
+                logging.warning(f"yt-dlp melaporkan error, tetapi file berhasil diunduh: {downloaded_file_path}")
+            logging.info(f"File ditemukan di: {downloaded_file_path}")
+            return downloaded_file_path, media_info, None # Sukses, kembalikan path, metadata, dan None error
+
+    if failed:
+        error_message = "\n".join(error_lines) or "yt-dlp gagal tanpa pesan error."
+        logging.error(f"Unduhan gagal untuk {url}. Error: {error_message}")
+        return None, None, error_message # Kembalikan None dan pesan error
+
+    if results:
+        error_message = f"File {results[0].get('filepath')} tidak ditemukan di direktori unduhan setelah yt-dlp selesai."
+    else:
+        error_message = "yt-dlp selesai tanpa melaporkan file hasil unduhan."
+    logging.error(error_message)
+    return None, None, error_message
+
+
+# --- Tahap Probe: Cache Metadata dan Pra-Seleksi Format ---
+class ProbeCache:
+    """
+    Cache metadata extractor (hasil yt-dlp -J) per URL di memori dengan TTL pendek.
+    URL stream di dalamnya kedaluwarsa, jadi TTL sengaja singkat.
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # kunci URL -> (waktu simpan, info)
+
+    def get(self, url):
+        key = normalize_url(url)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, info = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def put(self, url, info):
+        key = normalize_url(url)
+        self._entries[key] = (time.monotonic(), info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+probe_cache = ProbeCache(PROBE_CACHE_TTL, PROBE_CACHE_MAX_ENTRIES)
+
+
+def estimate_format_size(media_format, duration):
+    """
+    Ukuran format dalam byte: filesize, filesize_approx, atau perkiraan dari bitrate x durasi.
+    """
+    size = media_format.get("filesize") or media_format.get("filesize_approx")
+    if size:
+        return size
+    if media_format.get("tbr") and duration:
+        return int(media_format["tbr"] * 1000 / 8 * duration)
+    return None
+
+
+def select_format(info):
+    """
+    Memilih format terkecil yang memenuhi kebijakan kualitas (tinggi >= FORMAT_TARGET_HEIGHT) dan ukuran
+    (<= batas upload Telegram). Format pre-muxed (video+audio dalam satu stream, tanpa merge ffmpeg)
+    didahulukan. Jika tidak ada yang mencapai target, dipilih kualitas tertinggi di bawahnya yang muat.
+    Mengembalikan (format spec untuk -f, perkiraan ukuran) atau (None, None) jika tidak bisa menentukan.
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    has_video = lambda f: f.get("vcodec") not in (None, "none")
+    has_audio = lambda f: f.get("acodec") not in (None, "none")
+
+    candidates = [] # (format spec, ukuran, tinggi, pre-muxed?)
+    audio_formats = [f for f in formats if has_audio(f) and f.get("vcodec") == "none"]
+    # Audio untuk dipasangkan dengan stream video-only: bitrate tertinggi sampai FORMAT_MAX_AUDIO_ABR
+    audio_formats.sort(key=lambda f: (f.get("abr") or 0) <= FORMAT_MAX_AUDIO_ABR and (f.get("abr") or 0), reverse=True)
+    best_audio = audio_formats[0] if audio_formats else None
+    for media_format in formats:
+        if not has_video(media_format):
+            continue
+        size = estimate_format_size(media_format, duration)
+        if has_audio(media_format):
+            candidates.append((media_format["format_id"], size, media_format.get("height") or 0, True))
+        elif best_audio is not None:
+            audio_size = estimate_format_size(best_audio, duration)
+            combined_size = size + audio_size if size and audio_size else None
+            candidates.append((f"{media_format['format_id']}+{best_audio['format_id']}", combined_size, media_format.get("height") or 0, False))
+
+    # Ukuran tak diketahui dianggap muat, tetapi kalah dari format yang ukurannya diketahui
+    fitting = [c for c in candidates if c[1] is None or c[1] <= TELEGRAM_MAX_UPLOAD_BYTES]
+    if not fitting:
+        return None, None
+    size_key = lambda c: c[1] if c[1] is not None else float("inf")
+
+    meeting_target = [c for c in fitting if c[2] >= FORMAT_TARGET_HEIGHT]
+    if meeting_target:
+        if FORMAT_PREFER_PREMUXED and any(c[3] for c in meeting_target):
+            meeting_target = [c for c in meeting_target if c[3]]
+        chosen = min(meeting_target, key=lambda c: (size_key(c), c[2]))
+    else:
+        # Kualitas tertinggi yang tersedia di bawah target; pada tinggi yang sama pre-muxed lalu terkecil
+        chosen = max(fitting, key=lambda c: (c[2], c[3] and FORMAT_PREFER_PREMUXED, -size_key(c)))
+    return chosen[0], chosen[1]
+
+
+async def _probe_with_subprocess(url):
+    # --flat-playlist: URL playlist murni cukup dibaca daftar item-nya (diproses sebagai batch)
+    command = ["yt-dlp", "-J", "--no-warnings", "--no-playlist", "--flat-playlist"]
+    cookies_file = get_cookies_file_for_job()
+    if cookies_file:
+        command.extend(["--cookies", cookies_file])
+    command.append(url)
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        return None, stderr.decode("utf-8", errors="ignore").strip() or f"yt-dlp exited with code {process.returncode}"
+    return json.loads(stdout), None
+
+
+async def probe_download(url):
+    """
+    Tahap probe sebelum unduhan: ambil metadata (dari cache atau extractor) lalu pilih format.
+    Mengembalikan (info, format spec, perkiraan ukuran, pesan error). info None tanpa error berarti
+    probe dilewati dan unduhan memakai DOWNLOAD_FORMAT_SELECTOR seperti biasa. Untuk playlist,
+    info dikembalikan dengan format spec None (pemanggil memprosesnya sebagai batch).
+    """
+    if not PROBE_ENABLED:
+        return None, DOWNLOAD_FORMAT_SELECTOR, None, None
+    info = probe_cache.get(url)
+    if info is None:
+        started_at = time.monotonic()
+        try:
+            with cookie_jar.lease(url):
+                if YTDLP_ENGINE == "inprocess" and ytdlp_engine_pool.available:
+                    info, error_message = await ytdlp_engine_pool.probe(url, build_ytdlp_options())
+                else:
+                    info, error_message = await _probe_with_subprocess(url)
+        except Exception as e:
+            logging.warning(f"Probe gagal untuk {url}: {e}. Melanjutkan tanpa pra-seleksi format.")
+            return None, DOWNLOAD_FORMAT_SELECTOR, None, None
+        observe_stage("probe", started_at)
+        if error_message:
+            return None, None, None, error_message
+        probe_cache.put(url, info)
+    else:
+        logging.info(f"Metadata {url} diambil dari cache probe.")
+
+    if info.get("_type") == "playlist":
+        return info, None, None, None
+    if info.get("_type", "video") != "video":
+        return None, DOWNLOAD_FORMAT_SELECTOR, None, None
+    format_spec, expected_size = select_format(info)
+    if format_spec is None:
+        return info, DOWNLOAD_FORMAT_SELECTOR, None, None
+    logging.info(f"Format terpilih untuk {url}: {format_spec} (±{(expected_size or 0)/1024/1024:.1f} MiB)")
+    return info, format_spec, expected_size, None
+
+
+def write_probe_info(info):
+    """
+    Menulis metadata probe ke file sementara untuk --load-info-json. Mengembalikan path-nya.
+    """
+    info_path = os.path.join(DOWNLOAD_DIR, f".probe-{uuid.uuid4().hex}.info.json")
+    with open(info_path, "w", encoding="utf-8") as info_file:
+        json.dump(info, info_file)
+    return info_path
+
+
+# --- Engine yt-dlp In-Process (Pool Worker Hangat) ---
+# Setiap worker pool adalah proses Python yang sudah mengimpor yt_dlp beserta semua extractor,
+# sehingga job tidak lagi membayar biaya startup interpreter + import (>1 detik) seperti CLI.
+# Pilih engine lewat YTDLP_ENGINE=inprocess; engine subprocess tetap tersedia sebagai fallback.
+YTDLP_ENGINE = os.environ.get("YTDLP_ENGINE", "subprocess").lower()
+# Jumlah proses worker in-process, default sama dengan batas unduhan bersamaan
+YTDLP_POOL_SIZE = int(os.environ.get("YTDLP_POOL_SIZE", MAX_CONCURRENT_DOWNLOADS))
+
+class YtdlpEnginePool:
+    """
+    Pool proses worker yt-dlp in-process. Progres dari progress hook worker dikirim lewat
+    multiprocessing.Queue lalu diteruskan ke event loop oleh thread dispatcher.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._executor = None
+        self._progress_queue = None
+        self._dispatcher_thread = None
+        self._loop = None
+        self._job_queues = {} # job_key -> asyncio.Queue progres milik job tersebut
+
+    @property
+    def available(self):
+        return self._executor is not None
+
+    async def start(self):
+        """
+        Membuat pool dan memanaskan semua worker. Harus dipanggil dari dalam event loop.
+        """
+        import threading
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._loop = asyncio.get_running_loop()
+        # spawn: jangan fork proses yang sudah punya event loop dan thread Pyrogram. Proses worker
+        # hanya mengimpor ytdlp_worker + yt_dlp; bot.py tidak dieksekusi ulang di sana
+        context = ytdlp_worker.spawn_context()
+        self._progress_queue = context.Queue()
+        settings = {
+            "result_fields": YTDLP_RESULT_FIELDS, "progress_fields": YTDLP_PROGRESS_FIELDS,
+            "progress_interval": PROGRESS_PARSE_INTERVAL, "error_tail_lines": YTDLP_STDERR_TAIL_LINES,
+        }
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.size, mp_context=context,
+            initializer=ytdlp_worker.init, initargs=(self._progress_queue, settings)
+        )
+        self._dispatcher_thread = threading.Thread(target=self._dispatch_progress, name="ytdlp-progress", daemon=True)
+        self._dispatcher_thread.start()
+
+        # Jalankan satu tugas ringan per worker agar semua proses sudah spawn + import sebelum job pertama
+        await asyncio.gather(*[self._loop.run_in_executor(self._executor, ytdlp_worker.ping) for _ in range(self.size)])
+        logging.info(f"Engine yt-dlp in-process siap dengan {self.size} worker.")
+
+    def stop(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._progress_queue.put(None) # Hentikan thread dispatcher
+
+    def _dispatch_progress(self):
+        # Berjalan di thread terpisah: blocking get() tidak boleh dilakukan di event loop
+        while True:
+            item = self._progress_queue.get()
+            if item is None:
+                return
+            job_key, progress_data = item
+            self._loop.call_soon_threadsafe(self._route_progress, job_key, progress_data)
+
+    def _route_progress(self, job_key, progress_data):
+        job_queue = self._job_queues.get(job_key)
+        if job_queue is not None:
+            job_queue.put_nowait(progress_data)
+
+    async def probe(self, url, options):
+        """
+        Mengambil metadata tanpa unduh di worker pool. Mengembalikan (info, pesan error).
+        """
+        return await self._loop.run_in_executor(self._executor, ytdlp_worker.probe, url, options)
+
+    async def download(self, url, options, reporter: DownloadProgressReporter, info_path=None):
+        """
+        Menjalankan satu unduhan di worker pool sambil meneruskan progres ke reporter.
+        Mengembalikan (hasil after_move, baris error, gagal?).
+        """
+        job_key = uuid.uuid4().hex
+        job_queue = asyncio.Queue()
+        self._job_queues[job_key] = job_queue
+        try:
+            future = self._loop.run_in_executor(self._executor, ytdlp_worker.download, job_key, url, options, info_path)
+            # Progres dibaca sampai penanda akhir dari worker (None), bukan sampai future selesai: hasil
+            # bisa tiba lebih dulu daripada progres terakhir yang masih di antrian/thread dispatcher
+            while True:
+                progress_task = asyncio.ensure_future(job_queue.get())
+                waiting = {progress_task} if future.done() else {future, progress_task}
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if progress_task not in done:
+                    progress_task.cancel()
+                    if future.exception() is not None:
+                        return future.result() # Worker mati (BrokenProcessPool): penanda tidak akan datang
+                    continue
+                progress_data = progress_task.result()
+                if progress_data is None:
+                    return await future
+                await reporter.report(progress_data)
+        finally:
+            del self._job_queues[job_key]
+
+
+ytdlp_engine_pool = YtdlpEnginePool(YTDLP_POOL_SIZE)
+
+
+async def download_with_ytdlp(url, status_message: Message, reservation=None, info=None, format_selector=DOWNLOAD_FORMAT_SELECTOR, output_dir=DOWNLOAD_DIR):
+    """
+    Mengunduh URL dengan engine yang dikonfigurasi (YTDLP_ENGINE) dan melaporkan progres di pesan status.
+    info (metadata hasil probe) dipakai ulang agar extractor tidak dijalankan dua kali.
+    File ditulis ke output_dir; fragmen yang sudah ada di sana dilanjutkan, bukan diunduh ulang.
+    Mengembalikan path file yang diunduh (atau None jika gagal), metadata dari yt-dlp, dan pesan error.
+    """
+    info_path = write_probe_info(info) if info else None
+    # Koneksi aria2c / fragmen paralel dipilih dari profil host, lalu hasilnya dicatat kembali
+    tuning = host_tuner.tuning_for(url, info)
+    metrics.ytdlp_active.inc()
+    try:
+        result = None
+        # Satu lease cookies untuk semua engine yang dicoba job ini; perubahan dari yt-dlp digabung saat keluar
+        with cookie_jar.lease(url):
+            if ARIA2_MODE == "rpc":
+                try:
+                    result = await _download_with_aria2_rpc(url, status_message, reservation, format_selector, info_path, output_dir, tuning)
+                except Aria2RpcUnsupported as e:
+                    logging.info(f"{url} tidak bisa lewat aria2c RPC ({e}), menggunakan yt-dlp.")
+            if result is None and YTDLP_ENGINE == "inprocess":
+                if ytdlp_engine_pool.available:
+                    try:
+                        result = await _download_with_ytdlp_inprocess(url, status_message, reservation, format_selector, info_path, output_dir, tuning)
+                    except Exception as e:
+                        # Misalnya BrokenProcessPool jika worker mati; job ini dicoba ulang lewat subprocess
+                        logging.error(f"Engine in-process gagal untuk {url}: {e}. Fallback ke subprocess.")
+                else:
+                    logging.warning("Engine in-process belum siap, menggunakan subprocess yt-dlp.")
+            if result is None:
+                result = await _download_with_ytdlp_subprocess(url, status_message, reservation, format_selector, info_path, output_dir, tuning)
+    finally:
+        metrics.ytdlp_active.dec()
+        if info_path:
+            remove_local_files([info_path])
+    await host_tuner.record(tuning, result[2])
+
+    downloaded_file_path = result[0]
+    if downloaded_file_path and os.path.exists(downloaded_file_path):
+        metrics.downloaded_bytes.inc(os.path.getsize(downloaded_file_path))
+    return result
+
+
+async def _download_with_ytdlp_inprocess(url, status_message: Message, reservation=None, format_selector=DOWNLOAD_FORMAT_SELECTOR, info_path=None, output_dir=DOWNLOAD_DIR, tuning=None):
+    """
+    Menjalankan yt-dlp lewat YoutubeDL API di pool worker hangat.
+    """
+    logging.info(f"Memulai unduhan in-process dengan yt-dlp untuk: {url}")
+    reporter = DownloadProgressReporter(url, status_message, reservation, tuning)
+    results, error_lines, failed = await ytdlp_engine_pool.download(url, build_ytdlp_options(format_selector, output_dir, tuning), reporter, info_path)
+    reporter.observe_stages()
+    for error_line in error_lines:
+        trace_event("ytdlp_output", line=error_line)
+        logging.debug(f"Info yt-dlp: {error_line}")
+    return _pick_downloaded_file(url, results, failed, error_lines)
+
+
+# Fungsi ini adalah async function karena menggunakan subprocess async dan edit pesan async
+async def _download_with_ytdlp_subprocess(url, status_message: Message, reservation=None, format_selector=DOWNLOAD_FORMAT_SELECTOR, info_path=None, output_dir=DOWNLOAD_DIR, tuning=None):
+    """
+    Menjalankan yt-dlp sebagai subprocess non-blocking dan melaporkan progres di pesan status.
+    """
+    logging.info(f"Memulai unduhan async dengan yt-dlp untuk: {url}")
+    reporter = DownloadProgressReporter(url, status_message, reservation, tuning)
+    ytdlp_command = build_ytdlp_command(url, format_selector, info_path, output_dir, tuning)
+    logging.info(f"Perintah dijalankan: {' '.join(ytdlp_command)}")
+
+    process = None # Inisialisasi proses di luar try untuk cleanup
+    stderr_task = None
+    try:
+        # Menjalankan subprocess yt-dlp secara async
+        process = await asyncio.create_subprocess_exec(
+            *ytdlp_command, # Gunakan * untuk meneruskan list sebagai argumen terpisah
+            stdout=asyncio.subprocess.PIPE, # Progres JSON dan baris hasil --print ada di stdout
+            stderr=asyncio.subprocess.PIPE, # Pesan error/warning yt-dlp ada di stderr
+            limit=YTDLP_PIPE_LIMIT,
+        )
+
+        # Kedua pipe dikuras bersamaan agar tidak ada yang penuh dan memblokir yt-dlp
+        stderr_tail = StderrTail()
+        def collect_stderr(line):
+            err_line = line.decode('utf-8', errors='ignore')
+            stderr_tail.append(err_line)
+            # Tidak di-log per baris pada level INFO: disimpan terbatas di trace job
+            trace_event("ytdlp_output", line=err_line)
+            logging.debug(f"Info yt-dlp: {err_line}")
+        stderr_task = asyncio.create_task(read_stream_lines(process.stderr, collect_stderr))
+
+        # Hasil akhir per file (bisa lebih dari satu untuk playlist, --ignore-errors)
+        results = []
+        result_prefix = YTDLP_RESULT_PREFIX.encode()
+
+        # --- Membaca dan Mem-parsing Progres dari stdout ---
+        async def handle_stdout(line):
+            if line.startswith(result_prefix):
+                # Baris hasil dari --print after_move:...
+                try:
+                    results.append(json.loads(line[len(result_prefix):]))
+                except json.JSONDecodeError:
+                    logging.warning(f"Baris hasil yt-dlp tidak bisa di-parse: {line[:200]!r}")
+                return
+            # Baris progres di antara jendela throttle dibuang sebelum decode/json.loads
+            if not reporter.needs_parse(line):
+                return
+            # yt-dlp --progress-template "%(progress)j" output adalah JSON
+            try:
+                progress_data = json.loads(line)
+            except json.JSONDecodeError:
+                # Jika output bukan JSON (misalnya, pesan lain dari yt-dlp yang tidak dalam format JSON)
+                logging.debug(f"Output non-JSON dari yt-dlp stdout: {line[:200]!r}")
+                return
+            if isinstance(progress_data, dict):
+                await reporter.report(progress_data)
+        await read_stream_lines(process.stdout, handle_stdout)
+
+        # --- Menunggu Proses yt-dlp Selesai dan Memeriksa Return Code ---
+        returncode = await process.wait() # Tunggu proses yt-dlp selesai sepenuhnya
+        await stderr_task
+        logging.info(f"Proses yt-dlp selesai dengan kode {returncode} untuk {url} ({reporter.skipped_lines} baris progres dilewati)")
+        reporter.observe_stages()
+
+        error_lines = stderr_tail.to_list()
+        if returncode != 0 and not error_lines:
+            error_lines.append(f"yt-dlp exited with code {returncode} without stderr output.")
+        return _pick_downloaded_file(url, results, returncode != 0, error_lines)
+
+    except Exception as e:
+        # Tangani error saat membuat subprocess atau membaca stream
+        error_message = f"Terjadi kesalahan saat menjalankan proses yt-dlp: {e}"
+        logging.error(error_message)
+        if stderr_task:
+            stderr_task.cancel()
+        # Coba terminasi proses jika sempat dibuat
+        if process and process.returncode is None:
+            try:
+                logging.warning("Mencoba terminasi proses yt-dlp yang sedang berjalan...")
+                process.terminate()
+                await asyncio.wait_for(process.wait(), timeout=5) # Tunggu sebentar setelah terminate
+                logging.warning("Proses yt-dlp berhasil di-terminate.")
+            except asyncio.TimeoutError:
+                 logging.error("Proses yt-dlp tidak terminate setelah diberi sinyal, mencoba kill.")
+                 try:
+                     process.kill()
+                     await asyncio.wait_for(process.wait(), timeout=5)
+                     logging.error("Proses yt-dlp berhasil di-kill.")
+                 except Exception as kill_e:
+                     logging.error(f"Gagal membunuh proses yt-dlp: {kill_e}")
+            except Exception as term_e:
+                logging.error(f"Gagal terminate proses yt-dlp: {term_e}")
+        return None, None, error_message
+
+
+# --- Backend Unduhan aria2c RPC (Satu Daemon untuk Semua Job) ---
+# Mode "process" (default): yt-dlp menjalankan aria2c sendiri untuk setiap job (--external-downloader).
+# Mode "rpc": satu aria2c jangka panjang dalam mode RPC menerima semua unduhan, sehingga DNS cache dan
+# koneksi dipakai bersama, dan batas koneksi global/per host ditegakkan di satu tempat.
+# yt-dlp hanya dipakai untuk ekstraksi (-j); URL media langsung dikirim ke aria2c lewat JSON-RPC.
+ARIA2_MODE = os.environ.get("ARIA2_MODE", "process").lower()
+# Port RPC daemon; 0 (default) = port bebas acak per proses, agar beberapa worker di satu host
+# masing-masing punya daemon sendiri (token RPC juga acak per proses)
+ARIA2_RPC_PORT = int(os.environ.get("ARIA2_RPC_PORT", 0))
+# Jeda sebelum mencoba memulai ulang daemon yang gagal start (detik); selama jeda job memakai aria2c per proses
+ARIA2_RPC_RETRY_INTERVAL = float(os.environ.get("ARIA2_RPC_RETRY_INTERVAL", 300))
+# Batas total koneksi aria2c untuk semua job
+ARIA2_MAX_CONNECTIONS = int(os.environ.get("ARIA2_MAX_CONNECTIONS", 48))
+# Batas koneksi ke satu host untuk semua job (aria2c sendiri maksimal 16 per unduhan)
+ARIA2_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("ARIA2_MAX_CONNECTIONS_PER_HOST", 16))
+# Interval polling progres dari aria2c (detik)
+ARIA2_POLL_INTERVAL = float(os.environ.get("ARIA2_POLL_INTERVAL", 1.0))
+# Protokol yang bisa diunduh langsung oleh aria2c; HLS/DASH tetap lewat yt-dlp
+ARIA2_RPC_PROTOCOLS = ("http", "https")
+
+
+class Aria2RpcUnsupported(Exception):
+    """
+    URL tidak bisa diunduh lewat daemon aria2c (misalnya HLS atau playlist); pakai jalur yt-dlp biasa.
+    """
+
+
+class ConnectionBudget:
+    """
+    Membagi koneksi aria2c antar unduhan dengan batas global dan batas per host.
+    """
+    def __init__(self, max_total, max_per_host):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self._in_use = 0
+        self._in_use_per_host = collections.Counter()
+        self._condition = None
+
+    async def acquire(self, host, wanted):
+        """
+        Menunggu sampai minimal satu koneksi tersedia, lalu mengambil maksimal `wanted`.
+        Mengembalikan jumlah koneksi yang didapat.
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            while True:
+                granted = min(wanted, self.max_total - self._in_use, self.max_per_host - self._in_use_per_host[host])
+                if granted > 0:
+                    self._in_use += granted
+                    self._in_use_per_host[host] += granted
+                    return granted
+                await self._condition.wait()
+
+    async def release(self, host, count):
+        async with self._condition:
+            self._in_use -= count
+            self._in_use_per_host[host] -= count
+            if self._in_use_per_host[host] <= 0:
+                del self._in_use_per_host[host]
+            self._condition.notify_all()
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+
+class Aria2RpcDaemon:
+    """
+    Menjalankan dan mengelola satu proses aria2c --enable-rpc, serta klien JSON-RPC-nya.
+    """
+    def __init__(self, port, max_connections, max_connections_per_host, retry_interval):
+        self.configured_port = port
+        self.port = port
+        self.budget = ConnectionBudget(max_connections, max_connections_per_host)
+        self.retry_interval = retry_interval
+        self._secret = uuid.uuid4().hex # Token RPC acak per proses bot
+        self._process = None
+        self._session = None
+        self._lock = None
+        self._retry_at = 0.0 # Setelah start gagal, start berikutnya ditolak sampai waktu ini (monotonic)
+
+    @property
+    def available(self):
+        return self._process is not None and self._process.returncode is None
+
+    async def start(self):
+        """
+        Memulai daemon dan menunggu RPC siap. Harus dipanggil dari dalam event loop.
+        """
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            if self.available:
+                return
+            if time.monotonic() < self._retry_at:
+                raise RuntimeError(f"start sebelumnya gagal, dicoba lagi dalam {self._retry_at - time.monotonic():.0f} detik")
+            try:
+                await self._start_process()
+            except Exception:
+                self._retry_at = time.monotonic() + self.retry_interval
+                raise
+            self._retry_at = 0.0
+
+    @staticmethod
+    def _free_port():
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            return probe.getsockname()[1]
+
+    async def _start_process(self):
+        self.port = self.configured_port or self._free_port()
+        command = [
+            "aria2c",
+            "--enable-rpc", f"--rpc-listen-port={self.port}", "--rpc-listen-all=false",
+            f"--rpc-secret={self._secret}",
+            f"--stop-with-process={os.getpid()}", # Daemon ikut berhenti jika bot mati
+            # Antrian aria2c tidak membatasi: jumlah unduhan aktif sudah diatur penjadwal dan ConnectionBudget
+            "--max-concurrent-downloads=1000",
+            "--max-connection-per-server=16", "--min-split-size=1M",
+            "--async-dns=true", "--file-allocation=none", "--disk-cache=32M",
+            "--allow-overwrite=true", "--auto-file-renaming=false", "--continue=true",
+            "--console-log-level=warn", "--summary-interval=0",
+        ]
+        # Daemon dipakai bersama semua job: selalu snapshot seluruh jar, bukan lease job yang
+        # kebetulan memicu (re)start dan filenya dihapus saat lease ditutup
+        cookies_file = cookie_jar.shared_file()
+        if cookies_file:
+            # load-cookies hanya bisa disetel global untuk daemon
+            command.append(f"--load-cookies={cookies_file}")
+        self._process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            for _ in range(50):
+                if self._process.returncode is not None:
+                    break
+                try:
+                    version = await self.call("aria2.getVersion")
+                    logging.info(f"Daemon aria2c RPC {version.get('version')} siap di port {self.port}.")
+                    return
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.1) # Daemon belum mendengarkan port
+        except BaseException:
+            # Error RPC/auth (mis. port dipakai daemon proses lain dengan token berbeda) = start gagal
+            await self._stop_process()
+            raise
+        await self._stop_process()
+        raise RuntimeError(f"Daemon aria2c RPC tidak merespons di port {self.port}")
+
+    async def stop(self):
+        await self._stop_process()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _stop_process(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            try:
+                await asyncio.wait_for(self._process.wait(), 5)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        self._process = None
+
+    async def call(self, method, *params):
+        payload = {"jsonrpc": "2.0", "id": uuid.uuid4().hex, "method": method, "params": [f"token:{self._secret}", *params]}
+        async with self._session.post(f"http://127.0.0.1:{self.port}/jsonrpc", json=payload) as response:
+            body = await response.json(content_type=None)
+        if "error" in body:
+            raise RuntimeError(f"aria2c RPC {method}: {body['error'].get('message')}")
+        return body["result"]
+
+    async def download(self, stream_url, headers, file_path, reporter: DownloadProgressReporter, tuning: DownloadTuning):
+        """
+        Mengunduh satu URL langsung ke file_path lewat daemon, melaporkan progres dengan polling.
+        Jumlah koneksi yang diminta dari budget mengikuti profil host (tuning).
+        """
+        host = urllib.parse.urlsplit(stream_url).hostname or ""
+        connections = await self.budget.acquire(host, tuning.connections)
+        gid = None
+        try:
+            options = {
+                "dir": os.path.dirname(file_path),
+                "out": os.path.basename(file_path),
+                "split": str(connections),
+                "max-connection-per-server": str(connections),
+                "min-split-size": f"{tuning.chunk_size_mb}M",
+                "header": [f"{name}: {value}" for name, value in (headers or {}).items()],
+            }
+            gid = await self.call("aria2.addUri", [stream_url], options)
+            while True:
+                await asyncio.sleep(ARIA2_POLL_INTERVAL)
+                status = await self.call("aria2.tellStatus", gid, ["status", "totalLength", "completedLength", "downloadSpeed", "errorMessage"])
+                total_bytes = int(status["totalLength"]) or None
+                downloaded_bytes = int(status["completedLength"])
+                speed = int(status["downloadSpeed"])
+                if status["status"] == "complete":
+                    await reporter.report({"status": "finished", "downloaded_bytes": downloaded_bytes, "total_bytes": total_bytes, "filename": file_path})
+                    return
+                if status["status"] in ("error", "removed"):
+                    raise RuntimeError(status.get("errorMessage") or f"aria2c status {status['status']}")
+                await reporter.report({
+                    "status": "downloading", "downloaded_bytes": downloaded_bytes, "total_bytes": total_bytes, "speed": speed,
+                    "eta": (total_bytes - downloaded_bytes) / speed if total_bytes and speed else None, "filename": file_path,
+                })
+        except BaseException:
+            if gid is not None and self.available:
+                try:
+                    await self.call("aria2.forceRemove", gid)
+                except Exception as e:
+                    logging.warning(f"Gagal membatalkan unduhan aria2c {gid}: {e}")
+            raise
+        finally:
+            if gid is not None and self.available:
+                try:
+                    await self.call("aria2.removeDownloadResult", gid)
+                except Exception:
+                    pass # Hasil sudah dibersihkan atau unduhan masih dihentikan
+            await self.budget.release(host, connections)
+
+
+aria2_daemon = Aria2RpcDaemon(ARIA2_RPC_PORT, ARIA2_MAX_CONNECTIONS, ARIA2_MAX_CONNECTIONS_PER_HOST, ARIA2_RPC_RETRY_INTERVAL)
+
+
+async def extract_info_with_ytdlp(url, format_selector=DOWNLOAD_FORMAT_SELECTOR, info_path=None, output_dir=DOWNLOAD_DIR):
+    """
+    Menjalankan yt-dlp -j (tanpa unduh) dengan selector format dan template output bot.
+    Dengan info_path (hasil probe) tidak ada request ke situs, hanya seleksi format dan nama file.
+    Mengembalikan (info dict, pesan error).
+    """
+    command = [
+        "yt-dlp", "-j", "--no-warnings", "--restrict-filenames", "--no-playlist",
+        "-f", format_selector,
+        "-o", os.path.join(output_dir, "%(title)s.%(ext)s"),
+    ]
+    cookies_file = get_cookies_file_for_job()
+    if cookies_file:
+        command.extend(["--cookies", cookies_file])
+    if info_path:
+        command.extend(["--load-info-json", info_path])
+    else:
+        command.append(url)
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        return None, stderr.decode("utf-8", errors="ignore").strip() or f"yt-dlp exited with code {process.returncode}"
+    lines = stdout.decode("utf-8", errors="ignore").strip().splitlines()
+    if len(lines) != 1:
+        raise Aria2RpcUnsupported(f"yt-dlp -j menghasilkan {len(lines)} entri")
+    return json.loads(lines[0]), None
+
+
+async def merge_streams(stream_paths, output_path):
+    """
+    Menggabungkan stream video dan audio tanpa re-encode (setara merger ffmpeg yt-dlp).
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+    for stream_path in stream_paths:
+        command.extend(["-i", stream_path])
+    for index in range(len(stream_paths)):
+        command.extend(["-map", f"{index}"])
+    command.extend(["-c", "copy", output_path])
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg gagal menggabungkan stream: {stderr.decode('utf-8', errors='ignore').strip()}")
+
+
+async def _download_with_aria2_rpc(url, status_message: Message, reservation=None, format_selector=DOWNLOAD_FORMAT_SELECTOR, info_path=None, output_dir=DOWNLOAD_DIR, tuning=None):
+    """
+    Ekstraksi dengan yt-dlp lalu unduh stream-stream format terpilih lewat daemon aria2c.
+    Melempar Aria2RpcUnsupported jika format/protokol tidak didukung (pemanggil fallback ke yt-dlp).
+    """
+    if not aria2_daemon.available:
+        # Daemon mati atau gagal start: coba hidupkan lagi (paling cepat tiap ARIA2_RPC_RETRY_INTERVAL),
+        # selama itu pakai aria2c per proses
+        try:
+            await aria2_daemon.start()
+        except Exception as e:
+            raise Aria2RpcUnsupported(f"daemon tidak tersedia: {e}")
+
+    reporter = DownloadProgressReporter(url, status_message, reservation, tuning)
+    info, error_message = await extract_info_with_ytdlp(url, format_selector, info_path, output_dir)
+    if error_message:
+        logging.error(f"Ekstraksi gagal untuk {url}: {error_message}")
+        return None, None, error_message
+
+    streams = info.get("requested_formats") or [info]
+    if any(stream.get("protocol") not in ARIA2_RPC_PROTOCOLS or not stream.get("url") for stream in streams):
+        raise Aria2RpcUnsupported(f"protokol {[stream.get('protocol') for stream in streams]}")
+
+    output_path = info.get("filename") or info.get("_filename")
+    base, _ = os.path.splitext(output_path)
+    if len(streams) == 1:
+        stream_paths = [output_path]
+    else:
+        stream_paths = [f"{base}.f{stream.get('format_id')}.{stream.get('ext')}" for stream in streams]
+
+    logging.info(f"Mengunduh {url} lewat aria2c RPC: {len(streams)} stream.")
+    try:
+        await asyncio.gather(*[
+            aria2_daemon.download(stream["url"], stream.get("http_headers"), stream_path, reporter, tuning or default_download_tuning())
+            for stream, stream_path in zip(streams, stream_paths)
+        ])
+        if len(streams) > 1:
+            await merge_streams(stream_paths, output_path)
+            remove_local_files(stream_paths)
+    except Exception as e:
+        remove_local_files(stream_paths + [output_path])
+        return None, None, f"Unduhan aria2c RPC gagal: {e}"
+    reporter.observe_stages()
+
+    fields = YTDLP_RESULT_FIELDS.split(",")
+    media_info = {field: info.get(field) for field in fields}
+    media_info["filepath"] = output_path
+    return _pick_downloaded_file(url, [media_info], False, [])
+
+
+# --- Upload Streaming ke Telegram (Pipeline Unduh + Upload) ---
+# Ukuran part upload maksimum yang diterima Telegram (upload.saveFilePart / saveBigFilePart)
+TELEGRAM_UPLOAD_PART_SIZE = 512 * 1024
+# File di atas ukuran ini wajib diunggah sebagai "big file"
+TELEGRAM_BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+
+class TelegramPartUploader:
+    """
+    Mengunggah file ke server Telegram part demi part saat data masih berdatangan.
+    Ukuran total boleh belum diketahui: part ditahan di memori sampai melewati batas big file
+    (atau stream selesai lebih dulu = file kecil). Untuk big file, semua part dikirim dengan
+    file_total_parts=-1 kecuali part terakhir, yang dikirim setelah part lain selesai.
+    """
+    def __init__(self, client: Client, workers, max_pending_parts, part_size=TELEGRAM_UPLOAD_PART_SIZE, on_progress=None):
+        self.client = client
+        self.workers = workers
+        self.part_size = part_size
+        self.on_progress = on_progress # Dipanggil dengan ukuran tiap part yang selesai diunggah
+        self.file_id = client.rnd_id()
+        self.uploaded_bytes = 0
+        self._buffer = bytearray()
+        self._held_parts = [] # Part yang ditahan sebelum diputuskan kecil/besar
+        self._is_big = False
+        self._lookahead = None # Part terbaru yang belum dikirim karena mungkin part terakhir
+        self._next_part = 0
+        # Antrian terbatas = backpressure: pembacaan stdout yt-dlp berhenti jika upload tertinggal
+        self._queue = asyncio.Queue(max_pending_parts)
+        self._session = None
+        self._worker_tasks = []
+        self._errors = []
+
+    async def start(self):
+        storage = self.client.storage
+        self._session = Session(self.client, await storage.dc_id(), await storage.auth_key(), await storage.test_mode(), is_media=True)
+        await self._session.start()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                if item is None:
+                    return
+                rpc, size = item
+                await self._invoke(rpc)
+                self.uploaded_bytes += size
+                if self.on_progress is not None:
+                    self.on_progress(size)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    async def _invoke(self, rpc):
+        for attempt in range(3):
+            try:
+                return await self._session.invoke(rpc)
+            except FloodWait as e:
+                metrics.flood_wait_seconds.inc(e.value, source="upload")
+                await asyncio.sleep(e.value)
+            except Exception:
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(1)
+
+    def _raise_worker_error(self):
+        if self._errors:
+            raise self._errors[0]
+
+    async def _put_big_part(self, part, total_parts=-1):
+        self._raise_worker_error()
+        rpc = raw.functions.upload.SaveBigFilePart(
+            file_id=self.file_id, file_part=self._next_part, file_total_parts=total_parts, bytes=part
+        )
+        self._next_part += 1
+        await self._queue.put((rpc, len(part)))
+
+    async def _add_part(self, part):
+        if self._is_big:
+            await self._put_big_part(self._lookahead)
+            self._lookahead = part
+            return
+        self._held_parts.append(part)
+        if len(self._held_parts) * self.part_size > TELEGRAM_BIG_FILE_THRESHOLD:
+            # Sudah pasti big file: kirim part yang ditahan, sisakan satu sebagai lookahead
+            self._is_big = True
+            held_parts, self._held_parts = self._held_parts, []
+            for held_part in held_parts[:-1]:
+                await self._put_big_part(held_part)
+            self._lookahead = held_parts[-1]
+
+    async def write(self, data):
+        """
+        Menambahkan data ke upload. Menunggu jika antrian part penuh.
+        """
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            await self._add_part(part)
+
+    async def finish(self, file_name):
+        """
+        Mengirim sisa data dan mengembalikan InputFile/InputFileBig untuk dipakai di SendMedia.
+        """
+        if self._buffer:
+            await self._add_part(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        if not self._is_big:
+            if not self._held_parts:
+                raise ValueError("File kosong, tidak ada data yang diunggah.")
+            md5_sum = hashlib.md5()
+            for file_part, part in enumerate(self._held_parts):
+                md5_sum.update(part)
+                rpc = raw.functions.upload.SaveFilePart(file_id=self.file_id, file_part=file_part, bytes=part)
+                await self._queue.put((rpc, len(part)))
+            await self._queue.join()
+            self._raise_worker_error()
+            return raw.types.InputFile(id=self.file_id, parts=len(self._held_parts), name=file_name, md5_checksum=md5_sum.hexdigest())
+
+        # Part terakhir membawa jumlah part sebenarnya, jadi dikirim setelah semua part lain diterima
+        await self._queue.join()
+        total_parts = self._next_part + 1
+        await self._put_big_part(self._lookahead, total_parts)
+        self._lookahead = None
+        await self._queue.join()
+        self._raise_worker_error()
+        return raw.types.InputFileBig(id=self.file_id, parts=total_parts, name=file_name)
+
+    async def close(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._session is not None:
+            await self._session.stop()
+            self._session = None
+
+
+async def send_uploaded_document(client: Client, chat_id, input_file, file_name, caption, attributes=None, thumb=None):
+    """
+    Mengirim file yang sudah diunggah (InputFile/InputFileBig) sebagai dokumen, atau sebagai video/audio
+    jika attributes berisi DocumentAttributeVideo/Audio. Setara dengan bagian akhir client.send_document,
+    dan mengembalikan objek Message hasil kiriman.
+    """
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=client.guess_mime_type(file_name) or "application/octet-stream",
+        file=input_file,
+        attributes=[*(attributes or []), raw.types.DocumentAttributeFilename(file_name=file_name)],
+        thumb=thumb
+    )
+    result = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=media,
+            random_id=client.rnd_id(),
+            **await pyrogram_utils.parse_text_entities(client, caption, ParseMode.MARKDOWN, None)
+        )
+    )
+    for update in result.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await pyrogram_types.Message._parse(
+                client, update.message, {user.id: user for user in result.users}, {chat.id: chat for chat in result.chats}
+            )
+    return None
+
+
+def build_ytdlp_stream_command(format_spec, probe_info_path, info_path):
+    """
+    Menyusun argumen yt-dlp untuk mode streaming: data media ke stdout, progres ke stderr.
+    Metadata diambil dari hasil probe (--load-info-json), tanpa ekstraksi ulang.
+    """
+    command = [
+        "yt-dlp",
+        "--no-warnings",
+        "--newline",
+        "--progress",
+        "--progress-template", "%(progress)j",
+        # Format satu-stream pilihan probe (sudah berisi video+audio): format yang butuh merge ffmpeg
+        # tidak bisa ditulis ke stdout
+        "-f", format_spec,
+        # Metadata ditulis ke file karena stdout dipakai untuk data media
+        "--print-to-file", f"before_dl:%(.{{{YTDLP_RESULT_FIELDS}}})j", info_path,
+        "-o", "-",
+        "--load-info-json", probe_info_path,
+    ]
+    cookies_file = get_cookies_file_for_job()
+    if cookies_file:
+        command.extend(["--cookies", cookies_file])
+    return command
+
+
+def can_stream_upload(format_spec, expected_size):
+    """
+    Mode streaming hanya untuk format satu-stream hasil probe yang perkiraan ukurannya muat dalam satu
+    upload; selain itu file yang terlalu besar baru ketahuan setelah batas upload terlampaui.
+    """
+    return (
+        STREAMING_UPLOAD_ENABLED and format_spec is not None and "+" not in format_spec
+        and expected_size is not None and expected_size <= TELEGRAM_MAX_UPLOAD_BYTES
+    )
+
+
+async def stream_download_and_upload(job, probed_info, format_spec):
+    """
+    Mengunduh format satu-stream hasil probe ke stdout yt-dlp dan langsung mengunggah part demi part
+    ke Telegram, tanpa menulis file media ke disk. Mengembalikan (pesan terkirim, metadata, pesan error);
+    pesan terkirim None berarti pemanggil harus fallback ke jalur unduh-lalu-upload biasa.
+    """
+    probe_info_path = write_probe_info(probed_info)
+    try:
+        # Lease cookies mencakup seluruh umur proses yt-dlp, termasuk penulisan cookie saat keluar
+        with cookie_jar.lease(job.url):
+            return await _stream_download_and_upload(job, format_spec, probe_info_path)
+    finally:
+        remove_local_files([probe_info_path])
+
+
+async def _stream_download_and_upload(job, format_spec, probe_info_path):
+    url = job.url
+    info_path = os.path.join(DOWNLOAD_DIR, f".stream-{job.job_id}.info.json")
+    command = build_ytdlp_stream_command(format_spec, probe_info_path, info_path)
+    reporter = DownloadProgressReporter(url, job.status_messages)
+    uploader = TelegramPartUploader(job.client, STREAMING_UPLOAD_WORKERS, STREAMING_UPLOAD_BUFFER_PARTS)
+    logging.info(f"Memulai unduhan streaming untuk {url}: {' '.join(command)}")
+
+    process = None
+    stderr_task = None
+    stderr_tail = StderrTail()
+    started_at = time.monotonic()
+    try:
+        await uploader.start()
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=YTDLP_PIPE_LIMIT
+        )
+        metrics.ytdlp_active.inc()
+
+        async def handle_stderr(line):
+            # Dengan -o -, progres JSON dan pesan yt-dlp sama-sama ada di stderr
+            if not line.startswith(b"{"):
+                stderr_tail.append(line.decode('utf-8', errors='ignore'))
+                return
+            if not reporter.needs_parse(line):
+                return
+            try:
+                progress_data = json.loads(line)
+            except json.JSONDecodeError:
+                stderr_tail.append(line.decode('utf-8', errors='ignore'))
+                return
+            if isinstance(progress_data, dict):
+                await reporter.report(progress_data)
+        stderr_task = asyncio.create_task(read_stream_lines(process.stderr, handle_stderr))
+
+        while True:
+            chunk = await process.stdout.read(TELEGRAM_UPLOAD_PART_SIZE)
+            if not chunk:
+                break
+            await uploader.write(chunk)
+            if uploader.uploaded_bytes > TELEGRAM_MAX_UPLOAD_BYTES:
+                # Perkiraan ukuran dari probe meleset; jalur biasa akan memecahnya
+                return None, None, "File melebihi batas upload Telegram"
+
+        returncode = await process.wait()
+        await stderr_task
+        if returncode != 0:
+            return None, None, stderr_tail.text() or f"yt-dlp exited with code {returncode}"
+
+        media_info = {}
+        if os.path.exists(info_path):
+            with open(info_path, encoding="utf-8") as info_file:
+                lines = info_file.read().splitlines()
+            if lines:
+                media_info = json.loads(lines[-1])
+        file_name = f"{media_info.get('title') or 'download'}.{media_info.get('ext') or 'mp4'}".replace("/", "_")
+
+        input_file = await uploader.finish(file_name)
+        sent_message = await send_uploaded_document(job.client, job.chat_id, input_file, file_name, f"✅ Unduhan selesai:\n`{url}`")
+        logging.info(f"Streaming {url} selesai: {uploader.uploaded_bytes} byte diunggah ke {job.chat_id}.")
+        metrics.downloaded_bytes.inc(uploader.uploaded_bytes)
+        metrics.uploaded_bytes.inc(uploader.uploaded_bytes)
+        observe_stage("stream", started_at, bytes=uploader.uploaded_bytes)
+        return sent_message, media_info, None
+
+    except Exception as e:
+        return None, None, f"Streaming upload gagal: {e}"
+    finally:
+        if stderr_task and not stderr_task.done():
+            stderr_task.cancel()
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+        if process:
+            metrics.ytdlp_active.dec()
+        await uploader.close()
+        if os.path.exists(info_path):
+            os.remove(info_path)
+
+
+# --- Pemecahan File Besar dan Upload Paralel ---
+async def probe_media_duration(file_path):
+    """
+    Membaca durasi media (detik) dengan ffprobe. Mengembalikan None jika tidak bisa dibaca.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        logging.warning("ffprobe tidak ditemukan, durasi media tidak bisa dibaca.")
+        return None
+    stdout, _ = await process.communicate()
+    try:
+        return float(stdout.decode().strip())
+    except ValueError:
+        return None
+
+
+async def _split_with_ffmpeg(file_path, duration, part_count, output_pattern):
+    """
+    Memecah media dengan ffmpeg stream-copy (tanpa re-encode). Muxer segment hanya memotong di keyframe,
+    sehingga tiap bagian tetap bisa diputar. Mengembalikan daftar path bagian atau None jika gagal.
+    """
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", file_path,
+        "-map", "0", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{duration / part_count:.3f}", "-reset_timestamps", "1",
+        output_pattern,
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        logging.warning("ffmpeg tidak ditemukan, tidak bisa memecah media.")
+        return None
+    _, stderr = await process.communicate()
+    directory, pattern = os.path.split(output_pattern)
+    prefix = pattern.split("%", 1)[0]
+    parts = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix))
+    if process.returncode != 0 or not parts:
+        logging.warning(f"ffmpeg gagal memecah {file_path}: {stderr.decode('utf-8', errors='ignore').strip()}")
+        remove_local_files(parts)
+        return None
+    return parts
+
+
+def _split_by_bytes(file_path, part_size):
+    """
+    Fallback untuk file non-media: potong per byte menjadi .001, .002, ... (gabungkan lagi dengan cat).
+    """
+    parts = []
+    with open(file_path, "rb") as source:
+        index = 1
+        while True:
+            part_path = f"{file_path}.{index:03d}"
+            with open(part_path, "wb") as target:
+                copied = 0
+                while copied < part_size:
+                    chunk = source.read(min(8 * 1024 * 1024, part_size - copied))
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    copied += len(chunk)
+            if copied == 0:
+                os.remove(part_path)
+                return parts
+            parts.append(part_path)
+            index += 1
+
+
+async def split_media_file(file_path, media_info, max_bytes):
+    """
+    Memecah file yang melebihi batas upload Telegram. Mengembalikan (daftar path bagian, pesan error).
+    """
+    file_size = os.path.getsize(file_path)
+    # Sisakan ruang karena potongan di keyframe tidak pernah tepat di target
+    target_bytes = int(max_bytes * 0.9)
+    part_count = -(-file_size // target_bytes)
+    duration = (media_info or {}).get("duration") or await probe_media_duration(file_path)
+
+    if duration:
+        base, ext = os.path.splitext(file_path)
+        # Coba lagi dengan bagian lebih banyak jika ada bagian yang masih terlalu besar (bitrate tidak rata)
+        for attempt in range(3):
+            parts = await _split_with_ffmpeg(file_path, duration, part_count, f"{base}.part%03d{ext}")
+            if parts is None:
+                break
+            if all(os.path.getsize(part) <= max_bytes for part in parts):
+                logging.info(f"{file_path} dipecah menjadi {len(parts)} bagian dengan ffmpeg.")
+                return parts, None
+            remove_local_files(parts)
+            part_count += max(1, part_count // 2)
+
+    logging.warning(f"Memecah {file_path} per byte (bukan media atau ffmpeg gagal).")
+    try:
+        parts = await asyncio.to_thread(_split_by_bytes, file_path, target_bytes)
+    except Exception as e:
+        return None, f"Gagal memecah file: {e}"
+    return parts, None
+
+
+def remove_local_files(paths):
+    """
+    Menghapus file lokal (abaikan yang sudah tidak ada).
+    """
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logging.info(f"File {path} dihapus.")
+        except Exception as e:
+            logging.error(f"Gagal menghapus file lokal {path}: {e}")
+
+
+def part_caption(url, index, total):
+    if total == 1:
+        return f"✅ Unduhan selesai:\n`{url}`"
+    return f"✅ Unduhan selesai (bagian {index + 1}/{total}):\n`{url}`"
+
+
+# --- Upload File Lokal (Media, Thumbnail, Progres) ---
+# Batas jumlah part per file (akun non-premium); part dibesarkan jika file akan melebihinya
+TELEGRAM_MAX_FILE_PARTS = 4000
+# Kontainer yang bisa diputar langsung (streaming) oleh klien Telegram sebagai video
+STREAMABLE_VIDEO_EXTENSIONS = (".mp4", ".m4v", ".mov")
+AUDIO_EXTENSIONS = (".m4a", ".mp3", ".ogg", ".opus", ".flac", ".wav")
+# Sisi terpanjang thumbnail (batas Telegram 320px, JPEG maksimal 200 KB)
+THUMBNAIL_MAX_SIDE = 320
+
+
+def upload_part_size(file_size):
+    """
+    Ukuran part untuk file: UPLOAD_PART_SIZE_KB, digandakan (tetap pembagi 512 KiB) sampai jumlah part
+    tidak melebihi TELEGRAM_MAX_FILE_PARTS.
+    """
+    part_size = UPLOAD_PART_SIZE_KB * 1024
+    while part_size < TELEGRAM_UPLOAD_PART_SIZE and -(-file_size // part_size) > TELEGRAM_MAX_FILE_PARTS:
+        part_size *= 2
+    return part_size
+
+
+class UploadProgressReporter:
+    """
+    Melaporkan progres upload (semua bagian sebuah job) ke pesan status lewat progress_updater,
+    sehingga ikut throttle yang sama dengan progres unduhan. add() tidak pernah menunggu API Telegram.
+    """
+    def __init__(self, url, status_message, total_bytes):
+        self.url = url
+        self.status_message = status_message
+        self.total_bytes = max(total_bytes, 1)
+        self.uploaded_bytes = 0
+        self.started_at = time.monotonic()
+        self._last_percent = None
+
+    def add(self, size):
+        self.uploaded_bytes += size
+        percent = min(100, int(self.uploaded_bytes * 100 / self.total_bytes))
+        if percent == self._last_percent:
+            return
+        self._last_percent = percent
+        elapsed = time.monotonic() - self.started_at
+        speed = self.uploaded_bytes / elapsed if elapsed > 0 else 0
+        eta_str = "N/A"
+        if speed > 0:
+            minutes, seconds = divmod(int((self.total_bytes - self.uploaded_bytes) / speed), 60)
+            eta_str = f"{minutes}m {seconds}s" if minutes > 0 else f"{seconds}s"
+        self.status_message.update_progress(
+            f"Mengunggah: `{self.url}`\n"
+            f"Progress: **{percent}%**\n"
+            f"Sudah terunggah: {self.uploaded_bytes/1024/1024:.2f} / {self.total_bytes/1024/1024:.2f} MiB\n"
+            f"Kecepatan: {speed/1024/1024:.2f} MiB/s\n"
+            f"ETA: {eta_str}",
+            parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True
+        )
+
+    def pyrogram_callback(self):
+        """
+        Callback progress untuk send_* Pyrogram (posisi kumulatif per file) yang diteruskan sebagai selisih ke add().
+        """
+        last_position = [0]
+        async def callback(current, total):
+            self.add(current - last_position[0])
+            last_position[0] = current
+        return callback
+
+
+def upload_media_kind(file_path, media_info):
+    """
+    Menentukan cara kirim: "video", "audio", atau "document" dari ekstensi dan metadata yt-dlp.
+    """
+    if not UPLOAD_AS_MEDIA or not media_info or not media_info.get("duration"):
+        return "document"
+    ext = os.path.splitext(file_path)[1].lower()
+    has_video = media_info.get("vcodec") not in (None, "none")
+    if ext in STREAMABLE_VIDEO_EXTENSIONS and has_video and media_info.get("width") and media_info.get("height"):
+        return "video"
+    if ext in AUDIO_EXTENSIONS and not has_video:
+        return "audio"
+    return "document"
+
+
+def cached_media_kind(file_id):
+    """
+    Jenis media file_id Telegram hasil cache: "video", "audio", atau "document" (sama seperti upload_media_kind).
+    """
+    try:
+        file_type = FileId.decode(file_id).file_type
+    except Exception:
+        return "document"
+    if file_type == FileType.VIDEO:
+        return "video"
+    if file_type == FileType.AUDIO:
+        return "audio"
+    return "document"
+
+
+def album_input_media(media, caption, kind, media_info=None):
+    """
+    Entri media group untuk path lokal atau file_id. Telegram hanya mengizinkan album audio dengan
+    audio dan dokumen dengan dokumen, jadi pemanggil mengelompokkan entri per jenis.
+    """
+    if kind == "video":
+        # Atribut hanya dipakai saat mengunggah file lokal; untuk file_id Telegram memakai yang tersimpan
+        attributes = {}
+        if media_info and os.path.exists(media):
+            attributes = dict(duration=int(media_info["duration"]), width=int(media_info["width"]), height=int(media_info["height"]))
+        return pyrogram_types.InputMediaVideo(media, caption=caption, parse_mode=ParseMode.MARKDOWN, supports_streaming=True, **attributes)
+    if kind == "audio":
+        attributes = {}
+        if media_info and os.path.exists(media):
+            attributes = dict(duration=int(media_info["duration"]), performer=media_info.get("uploader") or "", title=media_info.get("title") or "")
+        return pyrogram_types.InputMediaAudio(media, caption=caption, parse_mode=ParseMode.MARKDOWN, **attributes)
+    return pyrogram_types.InputMediaDocument(media, caption=caption, parse_mode=ParseMode.MARKDOWN)
+
+
+async def generate_thumbnail(file_path, duration):
+    """
+    Mengambil satu frame video dengan ffmpeg sebagai thumbnail JPEG. Mengembalikan path atau None.
+    """
+    thumb_path = f"{os.path.splitext(file_path)[0]}.thumb.jpg"
+    # Frame sedikit setelah awal: detik pertama sering layar hitam/intro
+    seek = min(duration * 0.1, 10) if duration else 0
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-ss", f"{seek:.2f}", "-i", file_path, "-frames:v", "1",
+        "-vf", f"scale={THUMBNAIL_MAX_SIDE}:{THUMBNAIL_MAX_SIDE}:force_original_aspect_ratio=decrease",
+        "-q:v", "5", thumb_path,
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    except FileNotFoundError:
+        logging.warning("ffmpeg tidak ditemukan, video dikirim tanpa thumbnail.")
+        return None
+    if await process.wait() != 0 or not os.path.exists(thumb_path):
+        logging.warning(f"Gagal membuat thumbnail untuk {file_path}.")
+        return None
+    return thumb_path
+
+
+def media_attributes(kind, media_info):
+    """
+    Atribut dokumen Telegram (raw) untuk video/audio agar tidak diproses ulang di server.
+    """
+    duration = int(media_info.get("duration") or 0)
+    if kind == "video":
+        return [raw.types.DocumentAttributeVideo(duration=duration, w=int(media_info["width"]), h=int(media_info["height"]), supports_streaming=True)]
+    if kind == "audio":
+        return [raw.types.DocumentAttributeAudio(duration=duration, title=media_info.get("title"), performer=media_info.get("uploader"))]
+    return []
+
+
+async def _upload_with_part_uploader(client: Client, chat_id, file_path, caption, kind, media_info, thumb_path, progress):
+    """
+    Mengunggah file dengan TelegramPartUploader (UPLOAD_PART_WORKERS part bersamaan, ukuran part dari
+    konfigurasi) lalu mengirimnya dengan SendMedia.
+    """
+    file_name = os.path.basename(file_path)
+    part_size = upload_part_size(os.path.getsize(file_path))
+    uploader = TelegramPartUploader(
+        client, UPLOAD_PART_WORKERS, UPLOAD_PART_WORKERS * 2, part_size,
+        on_progress=progress.add if progress is not None else None
+    )
+    try:
+        await uploader.start()
+        with open(file_path, "rb") as source:
+            while True:
+                # Dibaca di thread agar disk lambat tidak memblokir event loop
+                chunk = await asyncio.to_thread(source.read, part_size * UPLOAD_PART_WORKERS)
+                if not chunk:
+                    break
+                await uploader.write(chunk)
+        input_file = await uploader.finish(file_name)
+    finally:
+        await uploader.close()
+    thumb = await client.save_file(thumb_path) if thumb_path else None
+    return await send_uploaded_document(client, chat_id, input_file, file_name, caption, media_attributes(kind, media_info or {}), thumb)
+
+
+async def send_local_file(client: Client, chat_id, file_path, caption, media_info=None, progress: UploadProgressReporter = None):
+    """
+    Mengunggah satu file lokal sebagai video/audio (durasi, resolusi dan thumbnail dari metadata) atau dokumen.
+    Mengembalikan pesan terkirim.
+    """
+    kind = upload_media_kind(file_path, media_info)
+    thumb_path = await generate_thumbnail(file_path, media_info.get("duration")) if kind == "video" else None
+    try:
+        if UPLOAD_PART_WORKERS > 0:
+            return await _upload_with_part_uploader(client, chat_id, file_path, caption, kind, media_info, thumb_path, progress)
+
+        # Uploader bawaan Pyrogram (part 512 KiB, paralelisme tetap)
+        callback = progress.pyrogram_callback() if progress is not None else None
+        if kind == "video":
+            return await client.send_video(
+                chat_id=chat_id, video=file_path, caption=caption, parse_mode=ParseMode.MARKDOWN,
+                duration=int(media_info["duration"]), width=int(media_info["width"]), height=int(media_info["height"]),
+                thumb=thumb_path, supports_streaming=True, progress=callback,
+            )
+        if kind == "audio":
+            return await client.send_audio(
+                chat_id=chat_id, audio=file_path, caption=caption, parse_mode=ParseMode.MARKDOWN,
+                duration=int(media_info["duration"]), performer=media_info.get("uploader"), title=media_info.get("title"),
+                progress=callback,
+            )
+        # send_document tidak menerima disable_web_page_preview; caption media tidak punya preview link
+        return await client.send_document(
+            chat_id=chat_id, document=file_path, caption=caption, parse_mode=ParseMode.MARKDOWN, progress=callback,
+        )
+    finally:
+        if thumb_path:
+            remove_local_files([thumb_path])
+
+
+async def upload_files(client: Client, chat_id, url, file_paths, media_info=None, status_message: Message = None):
+    """
+    Mengunggah satu atau beberapa file (bagian) ke chat, maksimal UPLOAD_PARALLELISM upload bersamaan.
+    Progres gabungan semua bagian dilaporkan ke status_message (jika ada).
+    Mengembalikan daftar pesan terkirim sesuai urutan file_paths.
+    """
+    semaphore = asyncio.Semaphore(UPLOAD_PARALLELISM)
+    total_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+    progress = UploadProgressReporter(url, status_message, total_bytes) if status_message is not None else None
+
+    async def upload(index, file_path):
+        async with semaphore:
+            part_info = media_info
+            if media_info and len(file_paths) > 1:
+                # Durasi metadata milik file utuh; tiap bagian dibaca ulang dengan ffprobe
+                part_info = dict(media_info, duration=await probe_media_duration(file_path))
+            sent_message = await send_local_file(
+                client, chat_id, file_path, part_caption(url, index, len(file_paths)), part_info, progress
+            )
+            metrics.uploaded_bytes.inc(os.path.getsize(file_path))
+            return sent_message
+
+    started_at = time.monotonic()
+    sent_messages = await asyncio.gather(*[upload(index, file_path) for index, file_path in enumerate(file_paths)])
+    observe_stage("upload", started_at, bytes=total_bytes, parts=len(file_paths))
+    return sent_messages
+
+
+# --- Fungsi untuk Menangani Cloudflare (Sangat Kompleks, Hanya Kerangka) ---
+# Fungsi ini akan sangat bervariasi tergantung situs dan metode bypass yang digunakan (pyppeteer/selenium)
+# Jika Anda mengimplementasikan ini, pastikan library yang relevan terinstal dan dependencies sistem ada di Dockerfile.
+async def bypass_cloudflare(url):
+   """
+   Placeholder untuk fungsi bypass Cloudflare menggunakan browser headless.
+   """
+   logging.info(f"Mencoba melewati Cloudflare untuk: {url}")
+   logging.warning("Fungsi bypass Cloudflare belum diimplementasikan sepenuhnya.")
+   return None # Kembalikan data bypass (misalnya cookie, final URL) jika berhasil
+
+
+# --- Cache Hasil Unduhan (file_id Telegram) ---
+def get_sent_media(sent_message: Message):
+    """
+    Mengambil objek media (document/video/audio/animation) dari pesan hasil upload.
+    """
+    if sent_message is None:
+        return None
+    for attribute in ("document", "video", "audio", "animation"):
+        media = getattr(sent_message, attribute, None)
+        if media is not None:
+            return media
+    return None
+
+
+class ResultCache:
+    """
+    Index SQLite: kunci cache -> file_id Telegram dari upload sebelumnya, dengan TTL dan eviksi LRU.
+    Operasi SQLite dijalankan di thread agar tidak memblokir event loop.
+    """
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " cache_key TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " file_name TEXT,"
+            " file_size INTEGER,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used_at)")
+        self._connection.commit()
+        logging.info(f"Cache hasil dibuka: {self.path}")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _lookup(self, keys):
+        now = time.time()
+        with self._lock:
+            for cache_key in keys:
+                row = self._connection.execute(
+                    "SELECT file_id, created_at FROM results WHERE cache_key = ?", (cache_key,)
+                ).fetchone()
+                if row is None:
+                    continue
+                file_id, created_at = row
+                if now - created_at > self.ttl:
+                    self._connection.execute("DELETE FROM results WHERE cache_key = ?", (cache_key,))
+                    self._connection.commit()
+                    continue
+                self._connection.execute(
+                    "UPDATE results SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?", (now, cache_key)
+                )
+                self._connection.commit()
+                return file_id
+        return None
+
+    def _store(self, keys, file_id, file_name, file_size):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (cache_key, file_id, file_name, file_size, created_at, last_used_at, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                [(cache_key, file_id, file_name, file_size, now, now) for cache_key in keys]
+            )
+            # Eviksi: buang entri kedaluwarsa, lalu yang paling lama tidak dipakai jika melebihi batas
+            self._connection.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+            self._connection.execute(
+                "DELETE FROM results WHERE cache_key IN ("
+                " SELECT cache_key FROM results ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._connection.commit()
+
+    def _invalidate(self, file_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM results WHERE file_id = ?", (file_id,))
+            self._connection.commit()
+
+    async def lookup(self, keys):
+        """
+        Mengembalikan file_id untuk kunci pertama yang masih valid, atau None.
+        """
+        if self._connection is None:
+            return None
+        return await asyncio.to_thread(self._lookup, keys)
+
+    async def store(self, keys, sent_message: Message):
+        """
+        Menyimpan file_id dari pesan hasil upload untuk semua kunci.
+        """
+        media = get_sent_media(sent_message)
+        if self._connection is None or media is None:
+            return
+        try:
+            await asyncio.to_thread(self._store, keys, media.file_id, getattr(media, "file_name", None), getattr(media, "file_size", None))
+        except Exception as e:
+            logging.warning(f"Gagal menyimpan hasil ke cache: {e}")
+
+    async def invalidate(self, file_id):
+        if self._connection is None:
+            return
+        await asyncio.to_thread(self._invalidate, file_id)
+
+
+result_cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES)
+
+
+async def send_cached_result(client: Client, chat_id, url, status_message: Message, media_info=None):
+    """
+    Mengirim ulang hasil dari cache memakai file_id (tanpa unduh dan tanpa upload).
+    Mengembalikan True jika berhasil dikirim dari cache.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return False
+    file_id = await result_cache.lookup(result_cache_keys(url, media_info))
+    if not file_id:
+        return False
+
+    logging.info(f"Cache hit untuk {url}, mengirim ulang file_id ke {chat_id}.")
+    error_message = await send_file_id(client, chat_id, file_id, url, status_message, "✅ Terkirim dari cache")
+    if error_message:
+        # file_id bisa tidak valid lagi (misalnya file dihapus dari server Telegram); buang dan unduh ulang
+        logging.warning(f"Gagal mengirim ulang file_id dari cache untuk {url}: {error_message}. Entri cache dihapus.")
+        await result_cache.invalidate(file_id)
+        return False
+    return True
+
+
+async def send_file_id(client: Client, chat_id, file_id, url, status_message: Message, status_text, caption=None):
+    """
+    Mengirim file yang sudah ada di server Telegram (tanpa upload) lalu mengedit pesan status.
+    Mengembalikan pesan error atau None jika berhasil.
+    """
+    try:
+        await client.send_cached_media(
+            chat_id=chat_id,
+            file_id=file_id,
+            caption=caption or f"✅ Unduhan selesai:\n`{url}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    except Exception as e:
+        return str(e)
+
+    if status_message is None:
+        return None
+    try:
+        await progress_updater.edit(status_message, f"{status_text}: `{url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    except Exception as edit_e:
+        logging.warning(f"Gagal mengedit pesan status setelah kirim file_id: {edit_e}")
+    return None
+
+
+# --- Penggabungan Unduhan yang Sedang Berjalan (Single-Flight) ---
+# Jika beberapa chat meminta URL yang sama hampir bersamaan, hanya satu pipeline yt-dlp/aria2c yang berjalan.
+# Chat lain menumpang sebagai waiter: pesan statusnya ikut diupdate dan file dikirim ulang lewat file_id.
+class StatusMessageGroup:
+    """
+    Sekumpulan pesan status yang diedit bersamaan. Dipakai di tempat satu objek Message
+    (cukup edit_text), sehingga progres satu unduhan tampil di semua chat yang menunggu.
+    """
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.last_text = None # Teks status terakhir (dilaporkan worker ke broker)
+
+    def add(self, message: Message):
+        self.messages.append(message)
+
+    async def edit_text(self, text, **kwargs):
+        self.last_text = text
+        results = await asyncio.gather(
+            *[progress_updater.edit(message, text, **kwargs) for message in self.messages], return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logging.warning(f"Gagal mengedit salah satu pesan status: {error}")
+        if errors and len(errors) == len(results):
+            raise errors[0] # Semua gagal: biarkan pemanggil menangani seperti edit tunggal
+
+    def update_progress(self, text, **kwargs):
+        """
+        Update progres non-blocking; edit yang belum terkirim digantikan oleh update berikutnya.
+        """
+        self.last_text = text
+        for message in self.messages:
+            progress_updater.submit(message, text, **kwargs)
+
+
+class InFlightDownloads:
+    """
+    Registry job yang sedang antri/berjalan, per kunci penggabungan.
+    """
+    def __init__(self):
+        self._jobs = {}
+
+    def get(self, key):
+        return self._jobs.get(key)
+
+    def register(self, job):
+        self._jobs[job.coalesce_key] = job
+
+    def release(self, job):
+        # Idempoten; hanya hapus jika kunci masih milik job ini
+        if self._jobs.get(job.coalesce_key) is job:
+            del self._jobs[job.coalesce_key]
+
+
+inflight_downloads = InFlightDownloads()
+
+
+# --- Jurnal Job (Tahan Crash) ---
+# Setiap perubahan status job (queued -> downloading -> uploading -> done) dicatat di SQLite.
+# Saat start ulang, job yang belum done diantrikan lagi dengan job_id yang sama: direktori unduhannya
+# (DOWNLOAD_DIR/<job_id>) masih berisi fragmen .part/.aria2 yang dilanjutkan oleh yt-dlp/aria2c.
+JOB_STATES_UNFINISHED = ("queued", "downloading", "uploading")
+
+
+class JobJournal:
+    """
+    Jurnal SQLite untuk job unduhan beserta pesan status pemohon dan waiter-nya.
+    Operasi SQLite dijalankan di thread agar tidak memblokir event loop.
+    """
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self.unfinished_ids = set() # job_id yang belum done; direktori unduhannya tidak disapu janitor
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    def open(self):
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " chat_id INTEGER NOT NULL,"
+            " url TEXT NOT NULL,"
+            " status_message_id INTEGER,"
+            " state TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS job_waiters ("
+            " job_id TEXT NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " status_message_id INTEGER NOT NULL,"
+            " PRIMARY KEY (job_id, chat_id, status_message_id))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self._connection.execute("DELETE FROM jobs WHERE state = 'done' AND updated_at < ?", (time.time() - self.retention,))
+        self._connection.execute("DELETE FROM job_waiters WHERE job_id NOT IN (SELECT job_id FROM jobs WHERE state != 'done')")
+        self._connection.commit()
+        rows = self._connection.execute(
+            f"SELECT job_id FROM jobs WHERE state IN ({','.join('?' * len(JOB_STATES_UNFINISHED))})", JOB_STATES_UNFINISHED
+        ).fetchall()
+        self.unfinished_ids = {job_id for job_id, in rows}
+        logging.info(f"Jurnal job dibuka: {self.path} ({len(self.unfinished_ids)} job belum selesai)")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _record(self, job_id, chat_id, url, status_message_id, state):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs (job_id, chat_id, url, status_message_id, state, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (job_id, chat_id, url, status_message_id, state, now, now)
+            )
+            if state == "done":
+                self._connection.execute("DELETE FROM job_waiters WHERE job_id = ?", (job_id,))
+            self._connection.commit()
+
+    def _add_waiter(self, job_id, chat_id, status_message_id):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO job_waiters (job_id, chat_id, status_message_id) VALUES (?, ?, ?)",
+                (job_id, chat_id, status_message_id)
+            )
+            self._connection.commit()
+
+    def _unfinished(self):
+        with self._lock:
+            jobs = self._connection.execute(
+                f"SELECT job_id, chat_id, url, status_message_id, state FROM jobs"
+                f" WHERE state IN ({','.join('?' * len(JOB_STATES_UNFINISHED))}) ORDER BY created_at",
+                JOB_STATES_UNFINISHED
+            ).fetchall()
+            waiters = collections.defaultdict(list)
+            for job_id, chat_id, status_message_id in self._connection.execute(
+                "SELECT job_id, chat_id, status_message_id FROM job_waiters"
+            ):
+                waiters[job_id].append((chat_id, status_message_id))
+        return [
+            {"job_id": job_id, "chat_id": chat_id, "url": url, "status_message_id": status_message_id,
+             "state": state, "waiters": waiters.get(job_id, [])}
+            for job_id, chat_id, url, status_message_id, state in jobs
+        ]
+
+    async def record(self, job, state):
+        """
+        Mencatat status job. Item batch tidak dijurnal (batch dijalankan ulang oleh pengguna), begitu juga
+        job dari broker (broker yang mengantrikannya ulang setelah lease habis).
+        """
+        if self._connection is None or job.batch is not None or job.remote is not None:
+            return
+        if state == "done":
+            self.unfinished_ids.discard(job.job_id)
+        else:
+            self.unfinished_ids.add(job.job_id)
+        status_message_id = job.status_message.id if job.status_message is not None else None
+        try:
+            await asyncio.to_thread(self._record, job.job_id, job.chat_id, job.url, status_message_id, state)
+        except Exception as e:
+            logging.warning(f"Gagal mencatat status {state} job {job.job_id} di jurnal: {e}")
+
+    async def add_waiter(self, job, chat_id, status_message: Message):
+        if self._connection is None or job.batch is not None:
+            return
+        try:
+            await asyncio.to_thread(self._add_waiter, job.job_id, chat_id, status_message.id)
+        except Exception as e:
+            logging.warning(f"Gagal mencatat waiter job {job.job_id} di jurnal: {e}")
+
+    async def unfinished(self):
+        """
+        Mengembalikan job yang belum selesai (urut waktu masuk) beserta waiter-nya.
+        """
+        if self._connection is None:
+            return []
+        return await asyncio.to_thread(self._unfinished)
+
+
+job_journal = JobJournal(JOB_JOURNAL_PATH, JOB_JOURNAL_RETENTION)
+
+
+job_broker = None # Dibuat di main() jika BROKER_ENABLED (BOT_ROLE bukan all, atau BOT_CONSUME_BROKER)
+
+
+# --- Penjadwal Unduhan (Worker Pool dengan Fairness per Chat) ---
+# Semua /download masuk ke antrian ini, bukan langsung menjalankan yt-dlp.
+# Jumlah worker = MAX_CONCURRENT_DOWNLOADS, sehingga jumlah proses yt-dlp/aria2c tetap terbatas saat burst.
+class DownloadJob:
+    """
+    Satu permintaan unduhan dari pengguna beserta pesan status yang akan diupdate.
+    """
+    def __init__(self, client: Client, chat_id, url, status_message: Message, job_id=None):
+        # job_id dari jurnal dipakai ulang saat job dilanjutkan setelah restart
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.client = client
+        self.chat_id = chat_id
+        self.url = url
+        self.status_message = status_message
+        # Pesan status pemohon + semua chat lain yang menumpang di unduhan yang sama (lihat InFlightDownloads)
+        self.status_messages = StatusMessageGroup([status_message])
+        self.waiters = [] # List (chat_id, status_message) yang menunggu hasil job ini
+        self.coalesce_key = download_coalesce_key(url)
+        self.queue_position = None # Posisi antrian terakhir yang ditampilkan ke pengguna
+        self.created_at = time.monotonic()
+        self.disk_reservation = None # DiskReservation selama job berjalan
+        # Jalur antrian round-robin: default per chat; item batch memakai jalur milik batch-nya
+        self.schedule_key = chat_id
+        self.lane_running_limit = None # None = MAX_RUNNING_JOBS_PER_CHAT
+        self.batch = None # BatchDownload jika job ini item dari batch/playlist
+        self.batch_item = None
+        self.remote = None # BrokerWorker jika job ini diklaim dari broker (mode worker)
+        self.remote_waiters = set() # (chat_id, status_message_id) waiter broker yang sudah diketahui
+        self.handed_off = False # True jika URL job ternyata playlist dan diteruskan ke batch
+        self.trace = None # JobTrace selama job dijalankan worker
+
+    @property
+    def output_dir(self):
+        """
+        Direktori unduhan milik job; deterministik per job_id agar fragmen bisa dilanjutkan setelah crash.
+        """
+        return os.path.join(DOWNLOAD_DIR, self.job_id)
+
+    def add_waiter(self, chat_id, status_message: Message):
+        self.waiters.append((chat_id, status_message))
+        self.status_messages.add(status_message)
+
+
+class DownloadScheduler:
+    """
+    Antrian job dengan batas konkurensi global, kuota per chat, dan round-robin antar chat.
+    Setiap chat punya antrian sendiri; worker mengambil job bergiliran dari chat-chat tersebut
+    sehingga satu pengguna yang mengirim banyak link tidak memblokir pengguna lain.
+    """
+    def __init__(self, runner, max_workers, max_jobs_per_chat, max_running_per_chat, max_queue_size):
+        self._runner = runner # Coroutine function yang mengeksekusi satu DownloadJob
+        self.max_workers = max_workers
+        self.max_jobs_per_chat = max_jobs_per_chat
+        self.max_running_per_chat = max_running_per_chat
+        self.max_queue_size = max_queue_size
+        # chat_id -> deque job yang menunggu. Urutan key = urutan giliran round-robin.
+        self._pending = collections.OrderedDict()
+        self._running_per_chat = collections.Counter()
+        self._queued_count = 0
+        self._running_count = 0
+        self._condition = None # Dibuat di start() agar terikat ke event loop yang berjalan
+        self._workers = []
+        self._position_refresh_task = None
+
+    def start(self):
+        """
+        Membuat task worker. Harus dipanggil dari dalam event loop (di main()).
+        """
+        self._condition = asyncio.Condition()
+        for index in range(self.max_workers):
+            self._workers.append(asyncio.create_task(self._worker(index)))
+        logging.info(f"Penjadwal unduhan dimulai dengan {self.max_workers} worker.")
+
+    async def stop(self):
+        """
+        Menghentikan semua worker. Job yang masih antri dibuang.
+        """
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @property
+    def queued_count(self):
+        return self._queued_count
+
+    @property
+    def alive_workers(self):
+        return sum(1 for task in self._workers if not task.done())
+
+    @property
+    def running_count(self):
+        return self._running_count
+
+    def jobs_for_chat(self, schedule_key):
+        return len(self._pending.get(schedule_key, ())) + self._running_per_chat[schedule_key]
+
+    async def submit(self, job: DownloadJob, force=False):
+        """
+        Memasukkan job ke antrian. force=True (job yang dilanjutkan dari jurnal) melewati kuota dan batas antrian.
+        Mengembalikan posisi antrian (1 = berikutnya dijalankan) atau None jika ditolak, beserta pesan error.
+        """
+        async with self._condition:
+            # Jalur dengan batas sendiri (item batch) sudah dibatasi oleh pemiliknya
+            if not force and job.lane_running_limit is None and self.jobs_for_chat(job.schedule_key) >= self.max_jobs_per_chat:
+                return None, f"Anda sudah memiliki {self.max_jobs_per_chat} unduhan yang antri/berjalan. Tunggu hingga selesai."
+            if not force and self._queued_count >= self.max_queue_size:
+                return None, "Antrian unduhan sedang penuh. Silakan coba lagi nanti."
+
+            self._pending.setdefault(job.schedule_key, collections.deque()).append(job)
+            self._queued_count += 1
+            self._condition.notify()
+            position = self._queue_positions().get(job.job_id)
+
+        job.queue_position = position
+        logging.info(f"Job {job.job_id} ({job.url}) dari chat {job.chat_id} masuk antrian, posisi {position}.")
+        return position, None
+
+    def _take_next_job(self):
+        """
+        Mengambil job berikutnya secara round-robin. Harus dipanggil dengan _condition terkunci.
+        """
+        for chat_id in list(self._pending):
+            chat_queue = self._pending[chat_id]
+            if self._running_per_chat[chat_id] >= (chat_queue[0].lane_running_limit or self.max_running_per_chat):
+                continue
+            job = chat_queue.popleft()
+            if chat_queue:
+                # Chat ini mendapat giliran, pindahkan ke belakang antrian giliran
+                self._pending.move_to_end(chat_id)
+            else:
+                del self._pending[chat_id]
+            self._running_per_chat[chat_id] += 1
+            self._queued_count -= 1
+            self._running_count += 1
+            return job
+        return None
+
+    def _queue_positions(self):
+        """
+        Memperkirakan posisi setiap job yang antri dengan mensimulasikan urutan round-robin.
+        Mengembalikan dict job_id -> posisi (mulai dari 1).
+        """
+        positions = {}
+        queues = [list(chat_queue) for chat_queue in self._pending.values()]
+        position = 1
+        depth = 0
+        while True:
+            taken = False
+            for chat_queue in queues:
+                if depth < len(chat_queue):
+                    positions[chat_queue[depth].job_id] = position
+                    position += 1
+                    taken = True
+            if not taken:
+                return positions
+            depth += 1
+
+    def _schedule_position_refresh(self):
+        # Debounce: banyak job bisa mulai berdekatan, cukup satu refresh untuk semuanya
+        if self._position_refresh_task is None or self._position_refresh_task.done():
+            self._position_refresh_task = asyncio.create_task(self._refresh_queue_positions())
+
+    async def _refresh_queue_positions(self):
+        """
+        Mengupdate pesan status job yang posisi antriannya berubah.
+        """
+        await asyncio.sleep(QUEUE_POSITION_UPDATE_INTERVAL)
+        async with self._condition:
+            positions = self._queue_positions()
+            jobs = [job for chat_queue in self._pending.values() for job in chat_queue]
+
+        for job in jobs:
+            position = positions.get(job.job_id)
+            if position is None or position == job.queue_position:
+                continue
+            job.queue_position = position
+            job.status_messages.update_progress(
+                f"⏳ Dalam antrian untuk: `{job.url}`\nPosisi antrian: **{position}**",
+                parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True
+            )
+
+    async def _worker(self, index):
+        while True:
+            async with self._condition:
+                job = self._take_next_job()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._take_next_job()
+
+            logging.info(f"Worker {index} menjalankan job {job.job_id} ({job.url}) untuk chat {job.chat_id}.")
+            self._schedule_position_refresh()
+            try:
+                await self._runner(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Job {job.job_id} gagal dengan error tidak terduga: {e}")
+            finally:
+                async with self._condition:
+                    self._running_per_chat[job.schedule_key] -= 1
+                    if self._running_per_chat[job.schedule_key] <= 0:
+                        del self._running_per_chat[job.schedule_key]
+                    self._running_count -= 1
+                    # Slot chat ini terbuka lagi, worker lain mungkin bisa mengambil job dari chat yang sama
+                    self._condition.notify_all()
+
+
+# --- Manajemen Kapasitas Disk DOWNLOAD_DIR ---
+class DiskReservation:
+    """
+    Ruang disk yang dipesan satu job. Reporter progres menaikkan pesanan saat ukuran sebenarnya diketahui.
+    """
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.job_id = job_id
+
+    def update(self, size_bytes):
+        self.manager.update(self.job_id, size_bytes)
+
+
+class DiskSpaceManager:
+    """
+    Admission control berbasis ruang disk: job baru hanya berjalan jika perkiraan ukurannya muat di
+    kapasitas (ruang kosong dikurangi cadangan minimum, dibatasi kuota) setelah dikurangi pesanan job lain.
+    """
+    def __init__(self, directory, quota_bytes, min_free_bytes, default_estimate_bytes):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.default_estimate_bytes = default_estimate_bytes
+        self._reservations = {} # job_id -> byte yang dipesan
+        self._releases = 0 # Naik setiap release(); acquire yang sedang mengukur di luar lock tidak melewatkannya
+        self._condition = None # Dibuat di start() agar terikat ke event loop yang berjalan
+
+    def start(self):
+        self._condition = asyncio.Condition()
+
+    @property
+    def reserved_bytes(self):
+        return sum(self._reservations.values())
+
+    def _usage(self, job_ids):
+        # Dipanggil lewat asyncio.to_thread (di luar lock): os.walk bisa lambat untuk direktori besar.
+        # Setiap job menulis ke direktorinya sendiri (DOWNLOAD_DIR/<job_id>), jadi isi direktori itu
+        # adalah bagian pesanan job yang sudah terpakai.
+        directory_usage = directory_size(self.directory) if self.quota_bytes else 0
+        job_sizes = {job_id: directory_size(os.path.join(self.directory, job_id)) for job_id in job_ids}
+        return directory_usage, job_sizes, shutil.disk_usage(self.directory).free
+
+    def _available(self, directory_usage, job_sizes, free_bytes):
+        # Ruang kosong sudah dikurangi semua file di disk (termasuk sisa unduhan gagal); yang belum
+        # terpakai hanya sisa pesanan setiap job: pesanan dikurangi isi direktori job tersebut
+        outstanding = sum(max(0, reserved - job_sizes.get(job_id, 0)) for job_id, reserved in self._reservations.items())
+        capacity = free_bytes - self.min_free_bytes
+        if self.quota_bytes:
+            capacity = min(capacity, self.quota_bytes - directory_usage)
+        return capacity - outstanding
+
+    async def acquire(self, job_id, estimate_bytes=None, on_wait=None):
+        """
+        Memesan ruang untuk job, menunggu job lain selesai jika belum muat.
+        Mengembalikan (DiskReservation, None) atau (None, pesan error) jika tidak akan pernah muat.
+        Pengukuran disk dan notifikasi menunggu dilakukan di luar lock agar admission job lain dan
+        release() tidak ikut tertahan.
+        """
+        if self._condition is None:
+            self.start()
+        estimate_bytes = estimate_bytes or self.default_estimate_bytes
+        notified = False
+        while True:
+            usage = await asyncio.to_thread(self._usage, list(self._reservations))
+            async with self._condition:
+                available = self._available(*usage)
+                if estimate_bytes <= available or (not self._reservations and available > 0):
+                    # Tanpa job lain, perkiraan default yang terlalu besar tidak boleh memblokir selamanya
+                    self._reservations[job_id] = estimate_bytes
+                    return DiskReservation(self, job_id), None
+                if not self._reservations:
+                    return None, f"Ruang disk tidak cukup untuk unduhan ini (tersedia {max(0, available)/1024/1024:.0f} MiB)."
+                releases_seen = self._releases
+            if on_wait is not None and not notified:
+                notified = True
+                await on_wait()
+            async with self._condition:
+                if self._releases != releases_seen:
+                    continue # Ada job yang selesai selama pengukuran/notifikasi: ukur ulang langsung
+                try:
+                    # Cek ulang berkala: janitor atau proses lain bisa membebaskan ruang tanpa notify
+                    await asyncio.wait_for(self._condition.wait(), 30)
+                except asyncio.TimeoutError:
+                    pass
+
+    def update(self, job_id, size_bytes):
+        if job_id in self._reservations and size_bytes > self._reservations[job_id]:
+            self._reservations[job_id] = size_bytes
+
+    async def release(self, job_id):
+        async with self._condition:
+            self._reservations.pop(job_id, None)
+            self._releases += 1
+            self._condition.notify_all()
+
+
+def directory_size(path):
+    """
+    Total ukuran file di bawah path (byte).
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass # File bisa dihapus/dipindah saat dipindai
+    return total
+
+
+def is_download_fragment(file_name):
+    """
+    File sementara yt-dlp/aria2c: .part, .ytdl, .aria2, .temp, dan fragmen HLS/DASH (.part-FragN).
+    """
+    return file_name.endswith(DOWNLOAD_FRAGMENT_SUFFIXES) or "-Frag" in file_name
+
+
+def sweep_download_dir(directory, fragment_max_age, file_max_age, keep_dirs=()):
+    """
+    Menghapus fragmen unduhan yang tidak disentuh lebih dari fragment_max_age detik dan file lain
+    (misalnya hasil yang gagal dihapus) yang lebih tua dari file_max_age. Mengembalikan (jumlah file, byte).
+    Unduhan aktif terus memperbarui mtime, jadi tidak ikut terhapus. Subdirektori di keep_dirs
+    (direktori job yang belum selesai di jurnal) dilewati; direktori job kosong yang usang dihapus.
+    """
+    now = time.time()
+    removed_files = 0
+    removed_bytes = 0
+    for root, dirs, files in os.walk(directory, topdown=False):
+        relative = os.path.relpath(root, directory)
+        if relative != "." and relative.split(os.sep)[0] in keep_dirs:
+            continue
+        if relative != "." and not dirs and not files:
+            try:
+                if now - os.stat(root).st_mtime >= file_max_age:
+                    os.rmdir(root)
+            except OSError:
+                pass
+            continue
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat_result = os.stat(path)
+                max_age = fragment_max_age if is_download_fragment(name) else file_max_age
+                if now - stat_result.st_mtime < max_age:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            removed_files += 1
+            removed_bytes += stat_result.st_size
+    return removed_files, removed_bytes
+
+
+async def run_download_janitor():
+    """
+    Task latar belakang: menyapu DOWNLOAD_DIR secara berkala (juga sekali saat startup untuk sisa crash).
+    """
+    while True:
+        try:
+            removed_files, removed_bytes = await asyncio.to_thread(
+                sweep_download_dir, DOWNLOAD_DIR, JANITOR_FRAGMENT_MAX_AGE, JANITOR_FILE_MAX_AGE, set(job_journal.unfinished_ids)
+            )
+            if removed_files:
+                logging.info(f"Janitor menghapus {removed_files} file usang ({removed_bytes/1024/1024:.1f} MiB) dari {DOWNLOAD_DIR}.")
+                metrics.janitor_removed_bytes.inc(removed_bytes)
+        except Exception as e:
+            logging.error(f"Janitor DOWNLOAD_DIR gagal: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL)
+
+
+disk_space = DiskSpaceManager(DOWNLOAD_DIR, DOWNLOAD_DIR_QUOTA_BYTES, DISK_MIN_FREE_BYTES, DISK_DEFAULT_JOB_ESTIMATE_BYTES)
+metrics.add_gauge("ytbot_disk_reserved_bytes", "Ruang disk yang sedang dipesan job berjalan", lambda: disk_space.reserved_bytes)
+
+
+# --- Eksekusi Satu Job Unduhan (dipanggil oleh worker penjadwal) ---
+async def process_download_job(job: DownloadJob):
+    """
+    Menjalankan job dan memastikan job selalu dilepas dari registry penggabungan unduhan.
+    Job baru berjalan setelah ruang disk untuk perkiraan ukurannya berhasil dipesan.
+    """
+    async def notify_waiting_for_disk():
+        job.status_messages.update_progress(f"⏳ Menunggu ruang disk kosong untuk: `{job.url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+    # Trace job berlaku untuk semua tahap di bawah ini (lihat current_trace)
+    job.trace = job_tracer.begin(
+        job.job_id, job.created_at, chat_id=job.chat_id, url=job.url,
+        **({"batch_id": job.batch.batch_id} if job.batch is not None else {})
+    )
+    trace_token = current_trace.set(job.trace)
+    observe_stage("queue_wait", job.created_at)
+    cancelled = False
+    try:
+        await job_journal.record(job, "downloading")
+        disk_wait_started_at = time.monotonic()
+        job.disk_reservation, error_message = await disk_space.acquire(job.job_id, on_wait=notify_waiting_for_disk)
+        observe_stage("disk_wait", disk_wait_started_at)
+        if error_message:
+            logging.warning(f"Job {job.job_id} ({job.url}) ditolak: {error_message}")
+            record_job_result("rejected_disk", error_message)
+            inflight_downloads.release(job)
+            try:
+                await job.status_messages.edit_text(f"❌ {error_message}", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as edit_e:
+                logging.warning(f"Gagal mengedit pesan penolakan ruang disk: {edit_e}")
+            return
+        try:
+            os.makedirs(job.output_dir, exist_ok=True)
+            if job.batch is not None:
+                await job.batch.run_item(job)
+            else:
+                await download_and_deliver(job)
+        finally:
+            await disk_space.release(job.job_id)
+    except asyncio.CancelledError:
+        # Bot dihentikan: status di jurnal dan fragmen di direktori job dibiarkan untuk dilanjutkan saat start ulang
+        cancelled = True
+        raise
+    finally:
+        if not cancelled:
+            await job_journal.record(job, "done")
+            cleanup_started_at = time.monotonic()
+            shutil.rmtree(job.output_dir, ignore_errors=True)
+            observe_stage("cleanup", cleanup_started_at)
+            if job.remote is not None and not job.handed_off:
+                # Job yang diteruskan ke batch baru selesai di broker setelah batch-nya selesai
+                await job.remote.job_finished(job)
+        elif job.trace is not None:
+            job.trace.attributes.setdefault("result", "interrupted")
+        inflight_downloads.release(job)
+        if job.batch is not None:
+            job.batch.finish_item(job)
+        job_tracer.finish(job.trace)
+        current_trace.reset(trace_token)
+
+
+async def deliver_to_waiters(job: DownloadJob, sent_messages):
+    """
+    Mengirim hasil upload job (satu file atau beberapa bagian) ke semua waiter memakai file_id
+    (tanpa upload ulang).
+    """
+    medias = [get_sent_media(sent_message) for sent_message in sent_messages]
+    served = 0
+    # Waiter baru bisa bergabung selama await di bawah, jadi iterasi sampai daftar habis
+    while True:
+        if served >= len(job.waiters) and job.remote is not None:
+            # Mode worker: waiter dari frontend masuk lewat broker; job disegel agar tidak ada yang tertinggal
+            await job.remote.sync_waiters(job, seal=True)
+        if served >= len(job.waiters):
+            break
+        waiter_chat_id, waiter_status_message = job.waiters[served]
+        served += 1
+        for index, media in enumerate(medias):
+            if media is None:
+                continue
+            # Pesan status waiter diedit setelah bagian terakhir terkirim
+            is_last = index == len(medias) - 1
+            error_message = await send_file_id(
+                job.client, waiter_chat_id, media.file_id, job.url,
+                waiter_status_message if is_last else None, "✅ Unduhan selesai",
+                caption=part_caption(job.url, index, len(medias))
+            )
+            if error_message:
+                logging.error(f"Gagal mengirim hasil job {job.job_id} ke waiter {waiter_chat_id}: {error_message}")
+                break
+    # Tidak ada await antara pengecekan terakhir dan release, sehingga tidak ada waiter yang tertinggal
+    inflight_downloads.release(job)
+    if served:
+        logging.info(f"Hasil job {job.job_id} dikirim ke {served} waiter.")
+
+
+async def download_and_deliver(job: DownloadJob):
+    """
+    Mengunduh URL milik job, mengirim file ke chat, lalu membersihkan file lokal.
+    """
+    client = job.client
+    chat_id = job.chat_id
+    url = job.url
+    # Semua pesan status (pemohon + waiter) diupdate bersamaan
+    status_message = job.status_messages
+
+    # --- Tahap Probe: Metadata + Pemilihan Format ---
+    probed_info, format_selector, expected_size, error_message = await probe_download(url)
+    if probed_info and probed_info.get("_type") == "playlist":
+        # URL playlist: serahkan ke mode batch yang memakai pesan status pemohon sebagai ringkasan
+        inflight_downloads.release(job)
+        if batch_running_for_chat(chat_id):
+            # Batas satu batch per chat sama seperti /download dengan beberapa URL
+            logging.info(f"{url} adalah playlist, ditolak karena batch lain masih berjalan untuk chat {chat_id}.")
+            record_job_result("rejected_batch")
+            await status_message.edit_text(f"📦 `{url}` adalah playlist, tetapi batch sebelumnya masih berjalan. Kirim ulang /download setelah batch itu selesai.", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            return
+        logging.info(f"{url} adalah playlist, diproses sebagai batch untuk chat {chat_id}.")
+        batch = start_batch(client, chat_id, [url], job.status_message)
+        if job.remote is not None:
+            # Job broker tetap dipegang worker ini (lease, requeue saat berhenti) sampai batch selesai
+            job.handed_off = True
+            job.remote.watch_batch(job.job_id, batch, url, notified_waiters=job.remote_waiters)
+        for waiter_chat_id, waiter_status_message in job.waiters:
+            try:
+                await progress_updater.edit(waiter_status_message, f"📦 `{url}` adalah playlist. Kirim ulang /download untuk memprosesnya.", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as e:
+                logging.warning(f"Gagal mengedit pesan waiter {waiter_chat_id}: {e}")
+        return
+    if probed_info and await send_cached_result(client, chat_id, url, job.status_message, media_info=probed_info):
+        # URL berbeda untuk video yang sama (extractor + id) sudah pernah dikirim: tidak perlu unduh
+        served = 0
+        while served < len(job.waiters):
+            waiter_chat_id, waiter_status_message = job.waiters[served]
+            served += 1
+            await send_cached_result(client, waiter_chat_id, url, waiter_status_message, media_info=probed_info)
+        record_job_result("cached")
+        return
+
+    # --- Mode Pipeline: Unduh Sambil Upload ---
+    # Setelah probe dan cek cache: hanya format satu-stream yang muat dalam satu upload
+    if not error_message and can_stream_upload(format_selector, expected_size):
+        sent_message, media_info, stream_error = await stream_download_and_upload(job, probed_info, format_selector)
+        if sent_message:
+            if RESULT_CACHE_ENABLED:
+                await result_cache.store(result_cache_keys(url, media_info), sent_message)
+            await deliver_to_waiters(job, [sent_message])
+            record_job_result("success")
+            try:
+                await status_message.edit_text(f"✅ Unduhan selesai dan terkirim: `{url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as e:
+                logging.warning(f"Gagal mengedit pesan status setelah streaming: {e}")
+            return
+        logging.warning(f"Mode streaming tidak bisa dipakai untuk {url} ({stream_error}). Fallback ke unduhan biasa.")
+
+    if expected_size and job.disk_reservation is not None:
+        job.disk_reservation.update(expected_size * 2 if expected_size > TELEGRAM_MAX_UPLOAD_BYTES else expected_size)
+
+    # --- Alur Logika Unduhan ---
+    # Memanggil fungsi unduhan yang sekarang async dan melaporkan progres ke status_message
+    if error_message:
+        downloaded_file_path, media_info = None, None
+    else:
+        downloaded_file_path, media_info, error_message = await download_with_ytdlp(
+            url, status_message, job.disk_reservation, probed_info, format_selector, job.output_dir
+        )
+
+
+    # --- Mengirim File Setelah Unduhan Selesai atau Melaporkan Error ---
+    if downloaded_file_path:
+        logging.info(f"Unduhan lokal selesai: {downloaded_file_path}. Mengirim file ke {chat_id}.")
+        upload_paths = [downloaded_file_path]
+        await job_journal.record(job, "uploading")
+        try:
+            # Update pesan status terakhir sebelum upload
+            try:
+                await status_message.edit_text("✅ Unduhan selesai. Mengunggah file ke Telegram...")
+            except Exception as e:
+                 logging.warning(f"Gagal mengedit pesan status sebelum upload: {e}")
+                 # Kirim pesan baru jika edit gagal
+                 await client.send_message(chat_id, "✅ Unduhan selesai. Mengunggah file ke Telegram...", parse_mode=ParseMode.MARKDOWN)
+
+
+            # --- Pecah File yang Melebihi Batas Upload Telegram ---
+            file_size = os.path.getsize(downloaded_file_path)
+            if file_size > TELEGRAM_MAX_UPLOAD_BYTES:
+                logging.info(f"{downloaded_file_path} ({file_size} byte) melebihi batas upload, dipecah.")
+                try:
+                    await status_message.edit_text(f"✂️ File {file_size/1024/1024:.0f} MiB melebihi batas Telegram, memecah file...")
+                except Exception as e:
+                    logging.warning(f"Gagal mengedit pesan status sebelum memecah file: {e}")
+                split_started_at = time.monotonic()
+                upload_paths, split_error = await split_media_file(downloaded_file_path, media_info, TELEGRAM_MAX_UPLOAD_BYTES)
+                observe_stage("split", split_started_at, bytes=file_size, parts=len(upload_paths or []), error=split_error)
+                if split_error:
+                    raise RuntimeError(split_error)
+
+            # Mengunggah file (atau bagian-bagiannya secara paralel) menggunakan Pyrogram
+            sent_messages = await upload_files(client, chat_id, url, upload_paths, media_info, status_message)
+            logging.info(f"File {downloaded_file_path} berhasil dikirim ke {chat_id} dalam {len(sent_messages)} bagian")
+
+            # Simpan file_id agar permintaan berikutnya untuk video yang sama cukup dikirim ulang
+            # (hanya untuk hasil satu file; hasil yang dipecah tidak di-cache)
+            if RESULT_CACHE_ENABLED and len(sent_messages) == 1:
+                await result_cache.store(result_cache_keys(url, media_info), sent_messages[0])
+
+            await deliver_to_waiters(job, sent_messages)
+            record_job_result("success")
+
+            # --- Cleanup ---
+            # Hapus file lokal (dan bagian-bagiannya) setelah dikirim
+            cleanup_started_at = time.monotonic()
+            remove_local_files(set(upload_paths + [downloaded_file_path]))
+            observe_stage("cleanup", cleanup_started_at, files=len(set(upload_paths + [downloaded_file_path])))
+
+        except Exception as e:
+            logging.error(f"Gagal mengirim file {downloaded_file_path} ke {chat_id}: {e}")
+            record_job_result("upload_failed", e)
+            # Lepas dulu dari registry agar tidak ada waiter baru yang menumpang ke job yang gagal
+            inflight_downloads.release(job)
+            # Menggunakan parse_mode=ParseMode.MARKDOWN
+            try:
+                 await status_message.edit_text(f"❌ Gagal mengirim file `{os.path.basename(downloaded_file_path)}`:\n`{e}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as edit_e:
+                 logging.warning(f"Gagal mengedit pesan error pengiriman: {edit_e}. Mengirim pesan error baru.")
+                 await client.send_message(chat_id, f"❌ Gagal mengirim file `{os.path.basename(downloaded_file_path)}`:\n`{e}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+
+            # Penting: Jika pengiriman gagal, file lokal (dan bagian-bagiannya) mungkin masih ada. Hapus di sini juga.
+            logging.info(f"Mencoba menghapus file lokal setelah gagal kirim: {downloaded_file_path}")
+            remove_local_files(set(upload_paths + [downloaded_file_path]))
+
+
+    else:
+        # Jika unduhan gagal (error_message sudah diisi oleh download_with_ytdlp)
+        logging.error(f"Unduhan gagal untuk {url}. Error: {error_message}")
+        record_job_result("download_failed", error_message)
+        inflight_downloads.release(job)
+        # Edit pesan status terakhir dengan pesan error
+        try:
+             await status_message.edit_text(f"❌ Unduhan gagal untuk `{url}`.\nError: `{error_message}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as edit_e:
+             logging.warning(f"Gagal mengedit pesan error unduhan: {edit_e}. Mengirim pesan error baru.")
+             await client.send_message(chat_id, f"❌ Unduhan gagal untuk `{url}`.\nError: `{error_message}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+
+    # Opsional: Membersihkan direktori unduhan secara berkala atau setelah setiap unduhan
+    # Jika DOWNLOAD_DIR hanya digunakan oleh satu proses download pada satu waktu, bisa dibersihkan.
+    # Jika multiple concurrent downloads mungkin terjadi, ini TIDAK AMAN.
+    # Pendekatan yang lebih aman adalah memastikan setiap file dihapus setelah diproses.
+    # Kode cleanup os.remove() di atas lebih disarankan.
+
+
+download_scheduler = DownloadScheduler(
+    process_download_job,
+    max_workers=MAX_CONCURRENT_DOWNLOADS,
+    max_jobs_per_chat=MAX_JOBS_PER_CHAT,
+    max_running_per_chat=MAX_RUNNING_JOBS_PER_CHAT,
+    max_queue_size=MAX_QUEUE_SIZE,
+)
+metrics.add_gauge("ytbot_queue_depth", "Job yang menunggu di antrian penjadwal", lambda: download_scheduler.queued_count)
+metrics.add_gauge("ytbot_jobs_running", "Job yang sedang dijalankan worker", lambda: download_scheduler.running_count)
+
+
+# --- Mode Batch / Playlist ---
+# /download dengan beberapa URL atau URL playlist: item diekspansi bertahap (flat extraction),
+# dijalankan paralel lewat penjadwal dengan batas BATCH_MAX_PARALLEL, dikirim sebagai media group,
+# dan progresnya dirangkum di satu pesan status.
+MEDIA_GROUP_MAX_ITEMS = 10 # Batas Telegram untuk satu media group
+
+
+async def expand_batch_urls(urls):
+    """
+    Async generator: mengembalikan URL item satu per satu dari daftar URL (video atau playlist).
+    Playlist diekspansi dengan --flat-playlist --lazy-playlist sehingga item pertama bisa mulai
+    diunduh sebelum seluruh playlist selesai dibaca. Metadata lengkap video tunggal disimpan ke
+    cache probe agar tidak diekstraksi ulang.
+    """
+    for url in urls:
+        command = ["yt-dlp", "--flat-playlist", "--lazy-playlist", "-j", "--no-warnings"]
+        # Lease dibuka/ditutup eksplisit (bukan with + ContextVar): generator ini bisa dilanjutkan dari task lain
+        cookie_lease = cookie_jar.lease(url)
+        cookies_file = cookie_lease.open()
+        if cookies_file:
+            command.extend(["--cookies", cookies_file])
+        command.append(url)
+        # Baris -j untuk video (bukan playlist) berisi metadata lengkap dan bisa jauh melebihi limit default 64 KiB
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=YTDLP_PIPE_LIMIT)
+        except BaseException:
+            cookie_lease.close()
+            raise
+        stderr_task = asyncio.create_task(process.stderr.read())
+        yielded = 0
+        try:
+            while True:
+                line_bytes = await process.stdout.readline()
+                if not line_bytes:
+                    break
+                try:
+                    entry = json.loads(line_bytes)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("_type") in ("url", "url_transparent"):
+                    entry_url = entry.get("url") or entry.get("webpage_url")
+                else:
+                    # Bukan playlist: ini metadata lengkap videonya
+                    entry_url = url if yielded == 0 else entry.get("webpage_url") or url
+                    probe_cache.put(entry_url, entry)
+                if entry_url:
+                    yielded += 1
+                    yield entry_url
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr = (await stderr_task).decode("utf-8", errors="ignore").strip()
+            cookie_lease.close()
+        if not yielded:
+            # Biarkan item gagal dengan pesan error yang jelas dari tahap probe/unduh
+            logging.warning(f"Ekspansi {url} tidak menghasilkan item: {stderr}")
+            yield url
+
+
+class BatchItem:
+    def __init__(self, index, url):
+        self.index = index
+        self.url = url
+        self.last_text = "⏳ Antri"
+        self.error = None
+        self.done = False
+
+
+class BatchItemStatus:
+    """
+    Pengganti pesan status untuk item batch: update item dikumpulkan ke pesan ringkasan batch
+    alih-alih mengedit pesan Telegram sendiri.
+    """
+    def __init__(self, batch, item: BatchItem):
+        self.batch = batch
+        self.item = item
+
+    def add(self, message):
+        pass # Item batch tidak punya waiter
+
+    async def edit_text(self, text, **kwargs):
+        self.update_progress(text)
+
+    def update_progress(self, text, **kwargs):
+        self.item.last_text = text
+        if text.startswith("❌") and self.item.error is None:
+            self.item.error = text.lstrip("❌ ")
+        self.batch.refresh()
+
+
+class BatchDownload:
+    """
+    Satu permintaan batch: ekspansi item, fan-out ke penjadwal, pengiriman media group, dan ringkasan.
+    """
+    def __init__(self, client: Client, chat_id, urls, status_message: Message):
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.client = client
+        self.chat_id = chat_id
+        self.urls = urls
+        self.status_message = status_message
+        self.items = []
+        self.expanding = True
+        self.truncated = False
+        self.expansion_error = None # Ekspansi URL berhenti karena error (item yang sudah masuk tetap diproses)
+        self._closed = False # Pengirim media group sudah berhenti; item yang masih menitip file digagalkan
+        self._slots = asyncio.Semaphore(BATCH_MAX_PARALLEL)
+        self._all_done = asyncio.Event()
+        self._ready = [] # (item, media, caption, future) yang menunggu dikirim
+        self._ready_condition = asyncio.Condition()
+        self._first_ready_at = None
+
+    # --- Ringkasan Progres ---
+    def render(self, final=False):
+        done = sum(1 for item in self.items if item.done and item.error is None)
+        failed = [item for item in self.items if item.error is not None]
+        running = [item for item in self.items if not item.done and item.error is None]
+        total = f"{len(self.items)}{'+' if self.expanding else ''}"
+        title = "📦 Batch selesai" if final else "📦 Batch unduhan"
+        lines = [f"{title}: {total} item — ✅ {done} | ❌ {len(failed)} | ⬇️ {len(running)}"]
+        if not final:
+            for item in running[:5]:
+                progress_line = next((line for line in item.last_text.splitlines() if line.startswith("Progress:")), item.last_text.splitlines()[0])
+                lines.append(f"{item.index}. `{item.url[:60]}` — {progress_line[:80]}")
+            if len(running) > 5:
+                lines.append(f"… dan {len(running) - 5} item lain")
+        for item in failed[:10]:
+            lines.append(f"❌ {item.index}. `{item.url[:60]}`: {item.error[:120]}")
+        if self.truncated:
+            lines.append(f"⚠️ Hanya {BATCH_MAX_ITEMS} item pertama yang diproses.")
+        if self.expansion_error:
+            lines.append(f"⚠️ Ekspansi URL gagal, sisa URL tidak diproses: {self.expansion_error[:200]}")
+        return "\n".join(lines)
+
+    def refresh(self):
+        progress_updater.submit(self.status_message, self.render(), parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+    # --- Orkestrasi ---
+    async def run(self):
+        sender_task = asyncio.create_task(self._send_ready_groups())
+        try:
+            try:
+                async for item_url in expand_batch_urls(self.urls):
+                    if len(self.items) >= BATCH_MAX_ITEMS:
+                        self.truncated = True
+                        break
+                    await self._slots.acquire()
+                    item = BatchItem(len(self.items) + 1, item_url)
+                    self.items.append(item)
+                    await self._submit_item(item)
+                    self.refresh()
+            except Exception as e:
+                # Misalnya yt-dlp gagal dijalankan; item yang sudah diajukan tetap ditunggu
+                logging.error(f"Ekspansi batch {self.batch_id} gagal: {e}")
+                self.expansion_error = str(e) or type(e).__name__
+            self.expanding = False
+            self._check_all_done()
+            await self._all_done.wait()
+        finally:
+            # Juga saat dibatalkan: pengirim harus bisa berhenti, kalau tidak batch tidak pernah selesai
+            # dan chat ini tidak bisa memulai batch baru
+            self.expanding = False
+            self._all_done.set()
+            async with self._ready_condition:
+                self._ready_condition.notify_all()
+            await sender_task
+            self._closed = True
+            for _, _, _, future, _, _ in self._ready:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batch dihentikan sebelum file terkirim."))
+            self._ready.clear()
+        metrics.jobs.inc(result="batch")
+        try:
+            await progress_updater.edit(self.status_message, self.render(final=True), parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as e:
+            logging.warning(f"Gagal mengedit ringkasan batch {self.batch_id}: {e}")
+
+    async def _submit_item(self, item: BatchItem):
+        item_status = BatchItemStatus(self, item)
+        job = DownloadJob(self.client, self.chat_id, item.url, item_status)
+        job.status_messages = item_status
+        job.schedule_key = f"batch:{self.batch_id}"
+        job.lane_running_limit = BATCH_MAX_PARALLEL
+        job.batch = self
+        job.batch_item = item
+        while True:
+            _, error_message = await download_scheduler.submit(job)
+            if error_message is None:
+                return
+            # Antrian global penuh: tunggu sebentar, item batch tidak dibuang
+            item.last_text = f"⏳ {error_message}"
+            await asyncio.sleep(5)
+
+    def finish_item(self, job: DownloadJob):
+        """
+        Dipanggil saat job item selesai (berhasil, gagal, atau ditolak).
+        """
+        item = job.batch_item
+        item.done = True
+        if item.error is None and not item.last_text.startswith("✅"):
+            item.error = "Gagal tanpa pesan error."
+        self._slots.release()
+        self.refresh()
+        self._check_all_done()
+
+    def _check_all_done(self):
+        if not self.expanding and all(item.done for item in self.items):
+            self._all_done.set()
+            asyncio.create_task(self._wake_sender())
+
+    async def _wake_sender(self):
+        async with self._ready_condition:
+            self._ready_condition.notify_all()
+
+    # --- Eksekusi Item (dipanggil dari worker penjadwal) ---
+    async def run_item(self, job: DownloadJob):
+        item = job.batch_item
+        url = item.url
+        status = job.status_messages
+        info, format_selector, expected_size, error_message = await probe_download(url)
+        if not error_message and format_selector is None:
+            error_message = "Playlist di dalam batch tidak didukung."
+        if error_message:
+            status.update_progress(f"❌ {error_message}")
+            return
+
+        file_id = None
+        if RESULT_CACHE_ENABLED:
+            file_id = await result_cache.lookup(result_cache_keys(url, info))
+        if file_id:
+            await self._deliver(item, [file_id])
+            status.update_progress("✅ Terkirim dari cache")
+            return
+
+        if expected_size and job.disk_reservation is not None:
+            job.disk_reservation.update(expected_size * 2 if expected_size > TELEGRAM_MAX_UPLOAD_BYTES else expected_size)
+        downloaded_file_path, media_info, error_message = await download_with_ytdlp(url, status, job.disk_reservation, info, format_selector, job.output_dir)
+        if not downloaded_file_path:
+            status.update_progress(f"❌ {error_message}")
+            return
+
+        paths = [downloaded_file_path]
+        try:
+            if os.path.getsize(downloaded_file_path) > TELEGRAM_MAX_UPLOAD_BYTES:
+                split_started_at = time.monotonic()
+                paths, error_message = await split_media_file(downloaded_file_path, media_info, TELEGRAM_MAX_UPLOAD_BYTES)
+                observe_stage("split", split_started_at, parts=len(paths or []), error=error_message)
+                if error_message:
+                    status.update_progress(f"❌ {error_message}")
+                    return
+            status.update_progress("📤 Menunggu upload")
+            with trace_span("upload", parts=len(paths), media_group=True):
+                sent_messages = await self._deliver(item, paths, media_info)
+            if RESULT_CACHE_ENABLED and len(sent_messages) == 1:
+                await result_cache.store(result_cache_keys(url, media_info), sent_messages[0])
+            status.update_progress("✅ Terkirim")
+        except Exception as e:
+            logging.error(f"Gagal mengirim item batch {url}: {e}")
+            status.update_progress(f"❌ Gagal mengirim: {e}")
+        finally:
+            remove_local_files(set(paths + [downloaded_file_path]))
+
+    # --- Pengiriman Media Group ---
+    async def _deliver(self, item: BatchItem, medias, media_info=None):
+        """
+        Menitipkan file (path lokal atau file_id) item ke pengirim media group dan menunggu terkirim.
+        media_info (metadata yt-dlp) menentukan jenis media file lokal; jenis file_id dibaca dari file_id-nya.
+        """
+        loop = asyncio.get_running_loop()
+        entries = []
+        for index, media in enumerate(medias):
+            if not os.path.exists(media):
+                entries.append((media, cached_media_kind(media), None))
+                continue
+            part_info = media_info
+            if media_info and len(medias) > 1:
+                # Durasi metadata milik file utuh; tiap bagian dibaca ulang dengan ffprobe
+                part_info = dict(media_info, duration=await probe_media_duration(media))
+            entries.append((media, upload_media_kind(media, part_info), part_info))
+        futures = []
+        async with self._ready_condition:
+            if self._closed:
+                raise RuntimeError("Batch dihentikan sebelum file terkirim.")
+            for index, (media, kind, part_info) in enumerate(entries):
+                caption = f"✅ {item.index}. `{item.url}`"
+                if len(medias) > 1:
+                    caption += f" (bagian {index + 1}/{len(medias)})"
+                future = loop.create_future()
+                self._ready.append((item, media, caption, future, kind, part_info))
+                futures.append(future)
+            if self._first_ready_at is None:
+                self._first_ready_at = loop.time()
+            self._ready_condition.notify_all()
+        return await asyncio.gather(*futures)
+
+    def _group_is_due(self, now):
+        if len(self._ready) >= MEDIA_GROUP_MAX_ITEMS:
+            return True
+        if not self._ready:
+            return False
+        # Tidak ada item lain yang mungkin menyusul, atau item pertama sudah menunggu cukup lama
+        others_pending = self.expanding or any(not item.done for item in self.items if item not in {entry[0] for entry in self._ready})
+        return not others_pending or now - self._first_ready_at >= BATCH_GROUP_LINGER
+
+    async def _send_ready_groups(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._ready_condition:
+                while not self._group_is_due(loop.time()):
+                    if self._all_done.is_set() and not self._ready:
+                        return
+                    timeout = None
+                    if self._ready:
+                        timeout = max(0.1, self._first_ready_at + BATCH_GROUP_LINGER - loop.time())
+                    try:
+                        await asyncio.wait_for(self._ready_condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                group = self._ready[:MEDIA_GROUP_MAX_ITEMS]
+                del self._ready[:MEDIA_GROUP_MAX_ITEMS]
+                self._first_ready_at = loop.time() if self._ready else None
+            await self._send_group(group)
+
+    async def _send_group(self, group):
+        # Video, audio, dan dokumen tidak bisa berbagi satu album: kirim satu album per jenis
+        albums = {}
+        for entry in group:
+            albums.setdefault(entry[4], []).append(entry)
+        for album in albums.values():
+            await self._send_album(album)
+
+    async def _send_album(self, group):
+        started_at = time.monotonic()
+        try:
+            if len(group) == 1:
+                _, media, caption, _, _, media_info = group[0]
+                if os.path.exists(media):
+                    sent_messages = [await send_local_file(self.client, self.chat_id, media, caption, media_info)]
+                else:
+                    sent_messages = [await self.client.send_cached_media(self.chat_id, file_id=media, caption=caption, parse_mode=ParseMode.MARKDOWN)]
+            else:
+                sent_messages = await self.client.send_media_group(self.chat_id, media=[
+                    album_input_media(media, caption, kind, media_info)
+                    for _, media, caption, _, kind, media_info in group
+                ])
+        except Exception as e:
+            for _, _, _, future, _, _ in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        observe_stage("upload", started_at, parts=len(group))
+        for (_, media, _, future, _, _), sent_message in zip(group, sent_messages):
+            if os.path.exists(media):
+                metrics.uploaded_bytes.inc(os.path.getsize(media))
+            if not future.done():
+                future.set_result(sent_message)
+
+
+active_batches = {} # batch_id -> (BatchDownload, task)
+
+
+def batch_running_for_chat(chat_id):
+    return any(batch.chat_id == chat_id for batch, _ in active_batches.values())
+
+
+def start_batch(client: Client, chat_id, urls, status_message: Message):
+    """
+    Menjalankan batch di task terpisah (bukan di worker penjadwal, karena batch menunggu item-itemnya
+    yang dijalankan worker).
+    """
+    batch = BatchDownload(client, chat_id, urls, status_message)
+    task = asyncio.create_task(batch.run())
+    active_batches[batch.batch_id] = (batch, task)
+    task.add_done_callback(lambda _: active_batches.pop(batch.batch_id, None))
+    logging.info(f"Batch {batch.batch_id} dimulai untuk chat {chat_id}: {len(urls)} URL.")
+    return batch
+
+
+# --- Melanjutkan Job dari Jurnal Setelah Restart ---
+async def fetch_status_message(client: Client, chat_id, message_id):
+    """
+    Mengambil kembali pesan status lama agar progres job yang dilanjutkan tampil di pesan yang sama.
+    Mengembalikan None jika pesan sudah tidak ada.
+    """
+    if message_id is None:
+        return None
+    try:
+        message = await client.get_messages(chat_id, message_id)
+    except Exception as e:
+        logging.warning(f"Gagal mengambil pesan status {message_id} di chat {chat_id}: {e}")
+        return None
+    if message is None or getattr(message, "empty", False):
+        return None
+    return message
+
+
+async def resume_journaled_jobs(client: Client):
+    """
+    Mengantrikan ulang job yang belum selesai saat bot berhenti/crash, dengan job_id dan pesan status yang sama.
+    """
+    entries = await job_journal.unfinished()
+    if not entries:
+        return
+    logging.info(f"Melanjutkan {len(entries)} job dari jurnal.")
+    for entry in entries:
+        chat_id = entry["chat_id"]
+        url = entry["url"]
+        resume_text = f"♻️ Bot dimulai ulang, melanjutkan unduhan untuk: `{url}`"
+        status_message = await fetch_status_message(client, chat_id, entry["status_message_id"])
+        try:
+            if status_message is None:
+                status_message = await client.send_message(chat_id, resume_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            else:
+                await progress_updater.edit(status_message, resume_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as e:
+            logging.warning(f"Gagal memberi tahu chat {chat_id} bahwa job {entry['job_id']} dilanjutkan: {e}")
+            if status_message is None:
+                continue # Jurnal tetap menyimpan job ini; dicoba lagi pada start berikutnya
+
+        job = DownloadJob(client, chat_id, url, status_message, job_id=entry["job_id"])
+        for waiter_chat_id, waiter_message_id in entry["waiters"]:
+            waiter_status_message = await fetch_status_message(client, waiter_chat_id, waiter_message_id)
+            if waiter_status_message is not None:
+                job.add_waiter(waiter_chat_id, waiter_status_message)
+        if inflight_downloads.get(job.coalesce_key) is None:
+            inflight_downloads.register(job)
+        await download_scheduler.submit(job, force=True)
+        logging.info(f"Job {job.job_id} ({url}) untuk chat {chat_id} dilanjutkan dari status {entry['state']}.")
+
+
+# --- Frontend dan Worker Broker ---
+async def enqueue_broker_job(client: Client, chat_id, urls, status_message: Message):
+    """
+    Mode frontend: menumpang ke job yang sama di broker atau mengantrikan job baru untuk diambil worker.
+    """
+    coalesce_key = download_coalesce_key(urls[0]) if len(urls) == 1 else None
+    if coalesce_key:
+        job_id = await job_broker.join(coalesce_key, chat_id, status_message.id)
+        if job_id:
+            metrics.requests.inc(result="coalesced")
+            logging.info(f"Permintaan {urls[0]} dari chat {chat_id} digabung ke job broker {job_id}.")
+            try:
+                await progress_updater.edit(status_message, f"🔗 URL ini sedang diunduh untuk permintaan lain, menunggu hasilnya: `{urls[0]}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as edit_e:
+                logging.warning(f"Gagal mengedit pesan status waiter: {edit_e}")
+            return
+
+    job_id = uuid.uuid4().hex[:12]
+    position, error_message = await job_broker.enqueue(
+        job_id, coalesce_key, chat_id, urls, status_message.id, MAX_JOBS_PER_CHAT, MAX_QUEUE_SIZE
+    )
+    if error_message:
+        logging.warning(f"Job broker untuk {urls} dari chat {chat_id} ditolak: {error_message}")
+        metrics.requests.inc(result="rejected")
+        text = f"❌ {error_message}"
+    else:
+        logging.info(f"Job {job_id} ({len(urls)} URL) dari chat {chat_id} masuk broker, posisi {position}.")
+        metrics.requests.inc(result="queued" if len(urls) == 1 else "batch")
+        text = f"⏳ Dalam antrian untuk: `{urls[0]}`\nPosisi antrian: **{position}**" if len(urls) == 1 else f"📦 Batch {len(urls)} URL dalam antrian, posisi **{position}**"
+    try:
+        await progress_updater.edit(status_message, text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    except Exception as edit_e:
+        logging.warning(f"Gagal mengedit pesan status job broker: {edit_e}")
+
+
+class BrokerWorker:
+    """
+    Mode worker: mengklaim job dari broker selama penjadwal lokal punya slot kosong, menjalankannya
+    dengan pipeline yang sama (unduh, upload, edit status langsung dari worker), memperbarui lease
+    beserta teks status terakhir, dan menyinkronkan waiter yang masuk lewat frontend.
+    """
+    def __init__(self, broker, client: Client, scheduler: DownloadScheduler, worker_id):
+        self.broker = broker
+        self.client = client
+        self.scheduler = scheduler
+        self.worker_id = worker_id
+        self.jobs = {} # job_id -> DownloadJob atau BatchDownload yang sedang dipegang worker ini
+        self._tasks = []
+        self._batch_tasks = set()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._claim_loop()), asyncio.create_task(self._heartbeat_loop())]
+        logging.info(f"Worker broker {self.worker_id} mulai mengambil job.")
+
+    async def stop(self):
+        """
+        Menghentikan klaim dan mengembalikan job yang belum selesai ke broker agar diambil worker lain.
+        Harus dipanggil setelah penjadwal lokal dihentikan.
+        """
+        for task in self._tasks + list(self._batch_tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._batch_tasks, return_exceptions=True)
+        self._tasks = []
+        if self.jobs:
+            try:
+                await self.broker.requeue(list(self.jobs))
+                logging.info(f"{len(self.jobs)} job dikembalikan ke broker.")
+            except Exception as e:
+                logging.error(f"Gagal mengembalikan job ke broker (akan diantrikan ulang setelah lease habis): {e}")
+
+    def _has_capacity(self):
+        load = self.scheduler.running_count + self.scheduler.queued_count
+        return len(self.jobs) < self.scheduler.max_workers and load < self.scheduler.max_workers
+
+    async def _claim_loop(self):
+        while True:
+            try:
+                if not self._has_capacity():
+                    await asyncio.sleep(BROKER_POLL_INTERVAL)
+                    continue
+                entry = await self.broker.claim(self.worker_id, MAX_RUNNING_JOBS_PER_CHAT, BROKER_LEASE_TIMEOUT)
+                if entry is None:
+                    await asyncio.sleep(BROKER_POLL_INTERVAL)
+                    continue
+                await self._start_job(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Worker broker gagal mengambil job: {e}")
+                await asyncio.sleep(BROKER_POLL_INTERVAL)
+
+    async def _start_job(self, entry):
+        job_id = entry["job_id"]
+        chat_id = entry["chat_id"]
+        urls = entry["urls"]
+        status_message = await fetch_status_message(self.client, chat_id, entry["status_message_id"])
+        if status_message is None:
+            try:
+                status_message = await self.client.send_message(chat_id, f"Memulai unduhan untuk: `{urls[0]}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as e:
+                logging.error(f"Job broker {job_id}: pesan status tidak bisa diambil maupun dikirim ke {chat_id}: {e}")
+                await self.broker.finish(job_id, f"❌ Gagal mengirim pesan status: {e}")
+                return
+        logging.info(f"Worker {self.worker_id} mengklaim job {job_id} ({len(urls)} URL) untuk chat {chat_id}.")
+
+        if len(urls) > 1:
+            self.watch_batch(job_id, start_batch(self.client, chat_id, urls, status_message))
+            return
+
+        job = DownloadJob(self.client, chat_id, urls[0], status_message, job_id=job_id)
+        job.remote = self
+        await self._add_waiters(job, entry["waiters"])
+        self.jobs[job_id] = job
+        await self.scheduler.submit(job, force=True)
+
+    def watch_batch(self, job_id, batch, playlist_url=None, notified_waiters=()):
+        """
+        Memegang job broker selama batch berjalan: job ikut heartbeat dan dikembalikan ke broker di stop(),
+        lalu ditandai selesai setelah batch selesai. playlist_url diisi jika batch berasal dari job satu URL
+        yang ternyata playlist; waiter broker yang belum diberi tahu (di luar notified_waiters) diberi tahu.
+        """
+        self.jobs[job_id] = batch
+        task = asyncio.create_task(self._watch_batch(job_id, active_batches[batch.batch_id][1], playlist_url, set(notified_waiters)))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _watch_batch(self, job_id, batch_task, playlist_url, notified_waiters):
+        await asyncio.wait([batch_task])
+        if batch_task.cancelled():
+            return # Worker berhenti: job tetap di self.jobs dan dikembalikan ke broker di stop()
+        self.jobs.pop(job_id, None)
+        try:
+            waiters = await self.broker.finish(job_id)
+        except Exception as e:
+            logging.error(f"Gagal menandai job {job_id} selesai di broker: {e}")
+            return
+        for waiter_chat_id, waiter_message_id in waiters:
+            if playlist_url is None or (waiter_chat_id, waiter_message_id) in notified_waiters:
+                continue
+            waiter_status_message = await fetch_status_message(self.client, waiter_chat_id, waiter_message_id)
+            if waiter_status_message is None:
+                continue
+            try:
+                await progress_updater.edit(waiter_status_message, f"📦 `{playlist_url}` adalah playlist. Kirim ulang /download untuk memprosesnya.", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as e:
+                logging.warning(f"Gagal mengedit pesan waiter {waiter_chat_id}: {e}")
+
+    async def _add_waiters(self, job: DownloadJob, waiters):
+        for waiter in waiters:
+            if waiter in job.remote_waiters:
+                continue
+            job.remote_waiters.add(waiter)
+            waiter_chat_id, waiter_message_id = waiter
+            waiter_status_message = await fetch_status_message(self.client, waiter_chat_id, waiter_message_id)
+            if waiter_status_message is not None:
+                job.add_waiter(waiter_chat_id, waiter_status_message)
+
+    async def sync_waiters(self, job: DownloadJob, seal=False):
+        """
+        Mengambil waiter baru dari broker. seal=True menutup job untuk waiter baru (dipanggil sebelum
+        pengiriman hasil ke waiter selesai), sehingga frontend membuat job baru untuk permintaan berikutnya.
+        """
+        try:
+            waiters = await (self.broker.seal(job.job_id) if seal else self.broker.waiters(job.job_id))
+            await self._add_waiters(job, waiters)
+        except Exception as e:
+            logging.warning(f"Gagal menyinkronkan waiter job {job.job_id} dari broker: {e}")
+
+    async def job_finished(self, job: DownloadJob):
+        """
+        Menandai job selesai di broker. Waiter yang masuk setelah sinkronisasi terakhir (misalnya saat
+        job gagal) diberi tahu hasil akhirnya.
+        """
+        self.jobs.pop(job.job_id, None)
+        try:
+            waiters = await self.broker.finish(job.job_id, job.status_messages.last_text)
+        except Exception as e:
+            logging.error(f"Gagal menandai job {job.job_id} selesai di broker: {e}")
+            return
+        for waiter_chat_id, waiter_message_id in waiters:
+            if (waiter_chat_id, waiter_message_id) in job.remote_waiters:
+                continue
+            waiter_status_message = await fetch_status_message(self.client, waiter_chat_id, waiter_message_id)
+            if waiter_status_message is None:
+                continue
+            try:
+                await progress_updater.edit(waiter_status_message, f"{job.status_messages.last_text or 'Selesai'}\nKirim ulang /download jika file belum Anda terima: `{job.url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+            except Exception as e:
+                logging.warning(f"Gagal mengedit pesan waiter {waiter_chat_id}: {e}")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(BROKER_HEARTBEAT_INTERVAL)
+            try:
+                status_texts = {
+                    job_id: job.status_messages.last_text if isinstance(job, DownloadJob) else None
+                    for job_id, job in self.jobs.items()
+                }
+                if status_texts:
+                    await self.broker.heartbeat(self.worker_id, status_texts)
+                for job in list(self.jobs.values()):
+                    if isinstance(job, DownloadJob):
+                        await self.sync_waiters(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Heartbeat worker broker gagal: {e}")
+
+
+broker_worker = None # Dibuat di main() jika BOT_ROLE=worker (atau mode all dengan BOT_CONSUME_BROKER)
+
+
+# --- Event Handler untuk Pesan Masuk (Pyrogram) ---
+
+# Handler untuk perintah /start
+@app.on_message(filters.command("start") & filters.private) # Hanya merespons /start di chat pribadi
+async def handle_start_command(client: Client, message: Message):
+    """
+    Menangani perintah /start. Mengirim pesan sambutan.
+    """
+    logging.info(f"Received /start command from chat ID: {message.chat.id}")
+
+    welcome_message = """
+Halo! 👋 Saya adalah bot pengunduh video.
+
+Saya bisa mengunduh video dari berbagai platform menggunakan yt-dlp.
+
+**Cara Menggunakan:**
+Kirimkan perintah `/download` diikuti dengan link video yang ingin Anda unduh.
+
+Contoh:
+`/download https://www.youtube.com/watch?v=dQw4w9WgXcQ`
+
+Beberapa link sekaligus (dipisah spasi) atau link playlist juga bisa; hasilnya dikirim sebagai album.
+
+Saya akan berusaha mengunduh video tersebut dan mengirimkannya kepada Anda.
+
+*Pastikan Anda menggunakan perintah ini di chat pribadi dengan bot.*
+    """
+    # Mengirim pesan balasan ke pengguna menggunakan Markdown
+    # Menggunakan parse_mode=ParseMode.MARKDOWN
+    await message.reply_text(welcome_message, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True) # disable_web_page_preview=True agar link contoh tidak menampilkan preview
+
+
+# Handler untuk perintah /download
+async def start_batch_command(client: Client, message: Message, urls):
+    """
+    /download dengan beberapa URL: satu pesan ringkasan untuk seluruh batch.
+    """
+    chat_id = message.chat.id
+    if batch_running_for_chat(chat_id):
+        await message.reply_text("📦 Batch sebelumnya masih berjalan. Tunggu hingga selesai.")
+        metrics.requests.inc(result="rejected")
+        return
+    logging.info(f"Processing batch request from chat ID {chat_id}: {len(urls)} URL")
+    try:
+        status_message = await message.reply_text(f"📦 Menyiapkan batch untuk {len(urls)} URL...")
+    except Exception as e:
+        logging.error(f"Gagal mengirim pesan status batch ke {chat_id}: {e}")
+        return
+    if BOT_ROLE == "frontend":
+        # Batch dijalankan utuh oleh satu worker
+        await enqueue_broker_job(client, chat_id, urls, status_message)
+        return
+    metrics.requests.inc(result="batch")
+    start_batch(client, chat_id, urls, status_message)
+
+
+@app.on_message(filters.command("download") & filters.private) # Hanya merespons /download di chat pribadi
+async def handle_download_command(client: Client, message: Message):
+    """
+    Menangani perintah /download. Memproses link, memulai unduhan async, dan mengirim file.
+    """
+    chat_id = message.chat.id
+    logging.info(f"Received /download command from chat ID: {chat_id}")
+
+    # Memeriksa apakah URL disediakan setelah perintah
+    if len(message.command) < 2:
+        # Menggunakan parse_mode=ParseMode.MARKDOWN
+        await message.reply_text("Mohon berikan URL setelah perintah /download. Contoh: `/download <link_video>`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        logging.warning(f"Received /download command without URL from chat ID: {chat_id}")
+        return
+
+    # Mengambil URL dari argumen perintah (boleh lebih dari satu, dipisah spasi/baris baru)
+    urls = list(dict.fromkeys(argument.strip() for argument in message.command[1:] if argument.strip()))
+    if len(urls) > 1:
+        await start_batch_command(client, message, urls)
+        return
+    url = urls[0]
+
+    logging.info(f"Processing download request for URL: {url}")
+
+    # Memberi tahu pengguna bahwa proses unduhan dimulai dan simpan objek pesan ini
+    # Pesan ini akan diupdate dengan progres
+    try:
+        status_message = await message.reply_text(f"Memulai unduhan untuk: `{url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    except Exception as e:
+        logging.error(f"Gagal mengirim pesan status awal ke {chat_id}: {e}")
+        # Jika gagal mengirim pesan status, tidak bisa update progres. Berikan pesan error fatal.
+        await client.send_message(chat_id, f"❌ Gagal memulai proses unduhan. Tidak dapat mengirim pesan status awal: `{e}`", parse_mode=ParseMode.MARKDOWN)
+        return
+
+
+    # --- Cek Cache Hasil ---
+    # Video yang sudah pernah dikirim cukup dikirim ulang dengan file_id, tanpa masuk antrian unduhan
+    if await send_cached_result(client, chat_id, url, status_message):
+        metrics.requests.inc(result="cached")
+        return
+
+    # --- Mode Frontend: Serahkan ke Worker lewat Broker ---
+    if BOT_ROLE == "frontend":
+        await enqueue_broker_job(client, chat_id, [url], status_message)
+        return
+
+    # --- Gabung ke Unduhan yang Sama yang Sedang Berjalan ---
+    # URL yang sama sedang antri/diunduh untuk chat lain: jangan jalankan pipeline kedua
+    running_job = inflight_downloads.get(download_coalesce_key(url))
+    if running_job is not None:
+        running_job.add_waiter(chat_id, status_message)
+        await job_journal.add_waiter(running_job, chat_id, status_message)
+        metrics.requests.inc(result="coalesced")
+        logging.info(f"Permintaan {url} dari chat {chat_id} digabung ke job {running_job.job_id}.")
+        try:
+            await progress_updater.edit(status_message, f"🔗 URL ini sedang diunduh untuk permintaan lain, menunggu hasilnya: `{url}`", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as edit_e:
+            logging.warning(f"Gagal mengedit pesan status waiter: {edit_e}")
+        return
+
+    # --- Masukkan ke Antrian Penjadwal ---
+    # Unduhan tidak langsung dijalankan; worker pool yang akan mengeksekusinya sesuai giliran
+    job = DownloadJob(client, chat_id, url, status_message)
+    # Daftarkan sebelum submit (tanpa await di antaranya) agar permintaan identik berikutnya ikut menumpang
+    inflight_downloads.register(job)
+    # Dicatat sebelum submit agar status "queued" tidak menimpa status dari worker yang sudah mengambil job
+    await job_journal.record(job, "queued")
+    position, error_message = await download_scheduler.submit(job)
+    if error_message:
+        logging.warning(f"Job untuk {url} dari chat {chat_id} ditolak: {error_message}")
+        metrics.requests.inc(result="rejected")
+        inflight_downloads.release(job)
+        await job_journal.record(job, "done")
+        try:
+            await job.status_messages.edit_text(f"❌ {error_message}", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as edit_e:
+            logging.warning(f"Gagal mengedit pesan penolakan job: {edit_e}")
+        return
+
+    metrics.requests.inc(result="queued")
+
+    # Hanya tampilkan posisi jika job benar-benar harus menunggu slot worker kosong
+    if position > download_scheduler.max_workers - download_scheduler.running_count:
+        try:
+            await progress_updater.edit(status_message, f"⏳ Dalam antrian untuk: `{url}`\nPosisi antrian: **{position}**", parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except Exception as edit_e:
+            logging.warning(f"Gagal mengedit pesan posisi antrian: {edit_e}")
+
+
+# --- Startup Bertahap (Fast Boot) ---
+class BootPhases:
+    """
+    Urutan startup yang diukur: durasi setiap fase dicatat untuk log, /health, dan metrik.
+    Bot baru dilaporkan siap (readiness) setelah finish() dipanggil.
+    """
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.durations = {} # fase -> detik
+        self.running = set()
+        self.ready = False
+        self.total_seconds = None
+
+    async def run(self, name, awaitable):
+        self.running.add(name)
+        started_at = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.running.discard(name)
+            self.durations[name] = round(time.monotonic() - started_at, 3)
+
+    def finish(self):
+        self.total_seconds = round(time.monotonic() - self.started_at, 3)
+        self.ready = True
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.durations.items())
+        logging.info(f"Boot selesai dalam {self.total_seconds:.2f}s ({phases}).")
+
+    def summary(self):
+        return {"ready": self.ready, "total_seconds": self.total_seconds, "phases": dict(self.durations), "running": sorted(self.running)}
+
+
+boot_phases = BootPhases()
+metrics.add_gauge("ytbot_boot_seconds", "Durasi startup sampai bot siap (detik)", lambda: boot_phases.total_seconds or 0)
+
+
+async def warm_up_ytdlp():
+    """
+    Menjalankan yt-dlp --version sekali: binary dan modulnya sudah di page cache sebelum job pertama,
+    dan yt-dlp yang tidak terpasang terdeteksi saat boot. Mengembalikan versi atau None.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec("yt-dlp", "--version", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    except FileNotFoundError:
+        logging.error("yt-dlp tidak ditemukan di PATH; unduhan akan gagal.")
+        return None
+    stdout, _ = await process.communicate()
+    version = stdout.decode("utf-8", errors="ignore").strip() or None
+    logging.info(f"yt-dlp {version} siap.")
+    return version
+
+
+async def open_local_state():
+    """
+    Fase boot: cache hasil, jurnal job, dan profil host (file lokal di DATA_DIR).
+    """
+    # Buka cache hasil sebelum handler menerima /download
+    if RESULT_CACHE_ENABLED:
+        try:
+            result_cache.open()
+        except Exception as e:
+            logging.error(f"Gagal membuka cache hasil {RESULT_CACHE_PATH}, cache dinonaktifkan: {e}")
+            result_cache.close()
+
+    # Jurnal job dibuka sebelum janitor agar direktori job yang belum selesai tidak ikut disapu.
+    # Pada mode frontend/worker, broker yang menyimpan job dan mengantrikan ulang job worker yang mati.
+    if JOB_JOURNAL_ENABLED and BOT_ROLE == "all":
+        try:
+            job_journal.open()
+        except Exception as e:
+            logging.error(f"Gagal membuka jurnal job {JOB_JOURNAL_PATH}, job tidak akan dilanjutkan setelah restart: {e}")
+            job_journal.close()
+
+    if BOT_ROLE != "frontend":
+        # Profil koneksi per host hasil belajar sebelum restart
+        host_tuner.load()
+
+
+async def start_aria2_daemon():
+    try:
+        await aria2_daemon.start()
+    except Exception as e:
+        logging.error(f"Gagal memulai daemon aria2c RPC, menggunakan aria2c per proses: {e}")
+
+
+async def start_ytdlp_pool():
+    try:
+        await ytdlp_engine_pool.start()
+    except Exception as e:
+        logging.error(f"Gagal memulai engine yt-dlp in-process, menggunakan subprocess: {e}")
+        ytdlp_engine_pool.stop()
+
+
+# --- Menjalankan Bot dan Health Check Server ---
+# --- Menjalankan Bot dan Health Check Server ---
+# Struktur terbaik dengan Pyrogram async:
+async def main():
+    global job_broker, broker_worker
+    logging.info(f"Memulai aplikasi bot dan health check server (peran: {BOT_ROLE})...")
+    # 1. Health server lebih dulu (bukan task yang balapan dengan startup): selama boot /health
+    #    menjawab 503 beserta fase yang sedang berjalan, sehingga orkestrator tidak mengirim trafik
+    await boot_phases.run("health_server", start_health_server())
+
+    # 2. State lokal dan cookies: cepat, dan harus siap sebelum job pertama
+    await boot_phases.run("local_state", open_local_state())
+    if BOT_ROLE != "frontend":
+        # Cookie jar diparse dan divalidasi sekali; semua engine unduhan memakai hasilnya
+        await boot_phases.run("cookies", asyncio.to_thread(cookie_jar.load))
+        # Hot reload saat file cookies diganti + penulisan balik batch perubahan dari yt-dlp
+        cookie_jar.start()
+
+    # Broker harus siap sebelum handler frontend menerima /download; gagal terhubung = tidak bisa berjalan
+    if BROKER_ENABLED:
+        job_broker = create_job_broker(BROKER_URL)
+        await boot_phases.run("broker", job_broker.open())
+
+    progress_updater.start()
+    job_tracer.start()
+    janitor_task = None
+    if BOT_ROLE != "frontend":
+        # Worker pool penjadwal unduhan harus berjalan sebelum handler menerima /download
+        download_scheduler.start()
+        disk_space.start()
+        # Janitor menyapu sisa unduhan (fragmen .part/.ytdl/aria2, file gagal dihapus) secara berkala
+        janitor_task = asyncio.create_task(run_download_janitor())
+
+    # 3. Fase lambat berjalan paralel: koneksi Telegram, daemon aria2c RPC, pemanasan yt-dlp.
+    #    Job yang masuk sebelum pool in-process siap tetap jalan lewat subprocess.
+    slow_phases = [boot_phases.run("telegram", app.start())]
+    if BOT_ROLE != "frontend":
+        slow_phases.append(boot_phases.run("ytdlp_warmup", warm_up_ytdlp()))
+        # Daemon aria2c RPC dipakai bersama semua job jika ARIA2_MODE=rpc
+        if ARIA2_MODE == "rpc":
+            slow_phases.append(boot_phases.run("aria2_daemon", start_aria2_daemon()))
+        # Panaskan pool yt-dlp in-process jika engine tersebut dipilih
+        if YTDLP_ENGINE == "inprocess":
+            slow_phases.append(boot_phases.run("ytdlp_pool", start_ytdlp_pool()))
+    await asyncio.gather(*slow_phases)
+    logging.info("Pyrogram Client terhubung ke Telegram.")
+
+    # 4. Job yang terputus oleh restart/crash dilanjutkan setelah client bisa mengedit pesan status
+    try:
+        await boot_phases.run("resume", resume_journaled_jobs(app))
+    except Exception as e:
+        logging.error(f"Gagal melanjutkan job dari jurnal: {e}")
+    if BOT_ROLE == "worker" or (BOT_ROLE == "all" and BOT_CONSUME_BROKER):
+        # Job yang masih tercatat milik WORKER_ID ini (worker start ulang) langsung diantrikan ulang
+        released = await job_broker.release_worker(WORKER_ID)
+        if released:
+            logging.info(f"{released} job milik worker {WORKER_ID} sebelumnya diantrikan ulang.")
+        broker_worker = BrokerWorker(job_broker, app, download_scheduler, WORKER_ID)
+        broker_worker.start()
+        logging.info("Worker siap mengambil job dari broker.")
+    else:
+        logging.info("Bot siap menerima perintah.")
+    # 5. Readiness baru dinyalakan setelah semua fase selesai
+    boot_phases.finish()
 
     # Keep the event loop running indefinitely to process updates and tasks
     # This await Future() will block the main coroutine until cancelled (e.g., via signal)
@@ -549,6 +5181,23 @@ async def main():
         logging.info("Main task cancelled. Starting shutdown.")
     finally:
         # Pindahkan logika cleanup ke sini, di dalam konteks async main()
+        for _, batch_task in list(active_batches.values()):
+            batch_task.cancel()
+        await download_scheduler.stop()
+        if broker_worker is not None:
+            await broker_worker.stop()
+        await progress_updater.stop()
+        await job_tracer.stop()
+        if janitor_task is not None:
+            janitor_task.cancel()
+        await aria2_daemon.stop()
+        ytdlp_engine_pool.stop()
+        result_cache.close()
+        job_journal.close()
+        host_tuner.save()
+        await cookie_jar.stop()
+        if job_broker is not None:
+            await job_broker.close()
         if app and app.is_connected:
             logging.info("Menghentikan Pyrogram client...")
             await app.stop() # Gunakan await di sini
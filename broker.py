@@ -0,0 +1,572 @@
+import os
+import logging
+import json
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import time
+import urllib.parse
+
+# Modul ini diimpor bot.py (handler Telegram dan worker) dan app.py (gateway HTTP). Isinya hanya yang
+# harus sama di semua proses yang memakai broker: konfigurasi antrian, kunci job, dan kelas broker.
+# Tidak boleh mengimpor Pyrogram atau membutuhkan kredensial Telegram.
+
+# --- Konfigurasi Bersama ---
+# Folder untuk data persisten bot (cache hasil, broker SQLite default, dll.)
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")
+# sqlite:///path/ke/file.sqlite3 (host yang sama / volume bersama) atau redis://host:6379/0 (butuh paket redis)
+BROKER_URL = os.environ.get("BROKER_URL", "sqlite:///" + os.path.join(DATA_DIR, "broker.sqlite3"))
+# Lama entri job yang sudah selesai disimpan sebelum dibuang (detik); juga dipakai jurnal job bot
+JOB_JOURNAL_RETENTION = int(os.environ.get("JOB_JOURNAL_RETENTION", 24 * 3600))
+# Batas jumlah job (antri + berjalan) yang boleh dimiliki satu chat
+MAX_JOBS_PER_CHAT = int(os.environ.get("MAX_JOBS_PER_CHAT", 3))
+# Batas total panjang antrian (semua chat), job baru ditolak jika antrian penuh
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 100))
+
+# --- Konfigurasi Format (Bagian dari Kunci Job) ---
+# Frontend bot dan gateway harus menghasilkan kunci penggabungan/cache yang sama untuk URL yang sama
+# Batas ukuran file upload Telegram (default 2000 MiB untuk akun non-premium/bot)
+TELEGRAM_MAX_UPLOAD_BYTES = int(os.environ.get("TELEGRAM_MAX_UPLOAD_MB", 2000)) * 1024 * 1024
+# Selector format yt-dlp: utamakan kombinasi yang muat di batas upload (ukuran tak diketahui tetap diizinkan),
+# baru kemudian kualitas terbaik apa pun (file yang masih terlalu besar akan dipecah).
+DOWNLOAD_FORMAT_SELECTOR = os.environ.get(
+    "DOWNLOAD_FORMAT_SELECTOR",
+    f"bv*[filesize<?{TELEGRAM_MAX_UPLOAD_BYTES * 9 // 10}]+ba/b[filesize<?{TELEGRAM_MAX_UPLOAD_BYTES}]/bv*+ba/b"
+)
+# Tahap probe: metadata diambil sekali (yt-dlp -J), format dipilih bot, lalu unduhan memakai info yang sama
+PROBE_ENABLED = os.environ.get("PROBE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Kualitas minimum yang dianggap cukup; format terkecil yang mencapai tinggi ini dipilih
+FORMAT_TARGET_HEIGHT = int(os.environ.get("FORMAT_TARGET_HEIGHT", 720))
+# Utamakan format pre-muxed (tanpa merge ffmpeg) dibanding pasangan video+audio terpisah
+FORMAT_PREFER_PREMUXED = os.environ.get("FORMAT_PREFER_PREMUXED", "true").lower() in ("1", "true", "yes")
+
+
+# --- Kunci Job (Cache Hasil dan Penggabungan Unduhan) ---
+# Parameter query yang hanya berisi tracking dan tidak mengubah konten yang diunduh
+TRACKING_QUERY_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid", "igsh", "ref_src", "pp"}
+
+# Kunci format unduhan saat ini. Ikut menjadi bagian kunci cache agar hasil dengan format lain tidak tertukar.
+DOWNLOAD_FORMAT_KEY = f"{DOWNLOAD_FORMAT_SELECTOR}|probe={PROBE_ENABLED}|h={FORMAT_TARGET_HEIGHT}|muxed={FORMAT_PREFER_PREMUXED}"
+
+
+def normalize_url(url):
+    """
+    Menormalkan URL agar variasi link ke video yang sama menghasilkan kunci cache yang sama.
+    """
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = (parsed.hostname or "").lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parsed.path.rstrip("/") or "/"
+    query = [
+        (key, value) for key, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if key not in TRACKING_QUERY_PARAMS and not key.startswith("utm_")
+    ]
+
+    # Bentuk pendek YouTube diarahkan ke bentuk watch?v=
+    if host == "youtu.be" and path != "/":
+        query.append(("v", path.lstrip("/")))
+        host, path = "youtube.com", "/watch"
+    elif host in ("youtube.com", "music.youtube.com") and path.startswith("/shorts/"):
+        query.append(("v", path[len("/shorts/"):]))
+        path = "/watch"
+
+    return urllib.parse.urlunsplit(((parsed.scheme or "https").lower(), host, path, urllib.parse.urlencode(sorted(query)), ""))
+
+
+def result_cache_keys(url, media_info=None, format_key=DOWNLOAD_FORMAT_KEY):
+    """
+    Mengembalikan daftar kunci cache untuk URL (dan ID video dari extractor jika sudah diketahui).
+    """
+    keys = [hashlib.sha256(f"url|{normalize_url(url)}|{format_key}".encode()).hexdigest()]
+    if media_info and media_info.get("extractor_key") and media_info.get("id"):
+        video_key = f"video|{media_info['extractor_key']}|{media_info['id']}|{format_key}"
+        keys.append(hashlib.sha256(video_key.encode()).hexdigest())
+    return keys
+
+
+def download_coalesce_key(url):
+    """
+    Kunci penggabungan unduhan: URL yang dinormalkan + format (sama dengan kunci utama cache hasil).
+    """
+    return result_cache_keys(url)[0]
+
+
+# --- Broker Job (Scale-Out Frontend / Worker) ---
+# Frontend mengantrikan job ke broker; worker (di host yang sama atau host lain) mengklaim job,
+# lalu mengunduh, mengunggah dan mengedit pesan status sendiri dengan sesi bot miliknya.
+# Siklus job di broker: queued -> running -> sealed (waiter ditutup, hasil sedang dikirim) -> done.
+# Worker memperbarui lease secara berkala; job yang lease-nya kedaluwarsa diantrikan ulang, kecuali job
+# sealed: hasilnya sudah (sebagian) terkirim ke peminta/waiter, jadi ditutup (done) agar tidak terkirim dua kali.
+SEALED_ABANDONED_STATUS = "⚠️ Worker berhenti saat hasil sedang dikirim. Kirim ulang /download jika file belum Anda terima."
+
+
+class SqliteJobBroker:
+    """
+    Broker di file SQLite bersama. Setiap operasi berjalan dalam transaksi BEGIN IMMEDIATE sehingga
+    aman dipakai banyak proses; klaim job memilih chat dengan job berjalan paling sedikit (fairness per chat).
+    """
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return self._connection is not None
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS broker_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " coalesce_key TEXT,"
+            " chat_id INTEGER NOT NULL,"
+            " urls TEXT NOT NULL,"
+            " status_message_id INTEGER,"
+            " state TEXT NOT NULL,"
+            " worker_id TEXT,"
+            " status_text TEXT,"
+            " heartbeat_at REAL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS broker_waiters ("
+            " job_id TEXT NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " status_message_id INTEGER NOT NULL,"
+            " PRIMARY KEY (job_id, chat_id, status_message_id))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS broker_jobs_state ON broker_jobs (state, created_at)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS broker_jobs_coalesce ON broker_jobs (coalesce_key)")
+        logging.info(f"Broker SQLite dibuka: {self.path}")
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+
+    async def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _transaction(self, function, *args):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    async def _run(self, function, *args):
+        return await asyncio.to_thread(self._transaction, function, *args)
+
+    def _waiters(self, job_id):
+        return [tuple(row) for row in self._connection.execute(
+            "SELECT chat_id, status_message_id FROM broker_waiters WHERE job_id = ?", (job_id,)
+        )]
+
+    def _enqueue(self, job_id, coalesce_key, chat_id, urls, status_message_id, max_jobs_per_chat, max_queue_size):
+        active = self._connection.execute(
+            "SELECT COUNT(*) FROM broker_jobs WHERE chat_id = ? AND state != 'done'", (chat_id,)
+        ).fetchone()[0]
+        if active >= max_jobs_per_chat:
+            return None, f"Anda sudah memiliki {max_jobs_per_chat} unduhan yang antri/berjalan. Tunggu hingga selesai."
+        queued = self._connection.execute("SELECT COUNT(*) FROM broker_jobs WHERE state = 'queued'").fetchone()[0]
+        if queued >= max_queue_size:
+            return None, "Antrian unduhan sedang penuh. Silakan coba lagi nanti."
+        now = time.time()
+        self._connection.execute(
+            "INSERT INTO broker_jobs (job_id, coalesce_key, chat_id, urls, status_message_id, state, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, coalesce_key, chat_id, json.dumps(urls), status_message_id, now, now)
+        )
+        return queued + 1, None
+
+    def _join(self, coalesce_key, chat_id, status_message_id):
+        row = self._connection.execute(
+            "SELECT job_id FROM broker_jobs WHERE coalesce_key = ? AND state IN ('queued', 'running') LIMIT 1", (coalesce_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            "INSERT OR IGNORE INTO broker_waiters (job_id, chat_id, status_message_id) VALUES (?, ?, ?)",
+            (row[0], chat_id, status_message_id)
+        )
+        return row[0]
+
+    def _close_sealed(self, condition, parameters):
+        """
+        Menutup job sealed yang ditinggalkan worker (tanpa mengantrikan ulang). Mengembalikan jumlahnya.
+        """
+        now = time.time()
+        job_ids = [row[0] for row in self._connection.execute(
+            f"SELECT job_id FROM broker_jobs WHERE state = 'sealed' AND {condition}", parameters
+        )]
+        self._connection.executemany(
+            "UPDATE broker_jobs SET state = 'done', worker_id = NULL, status_text = ?, updated_at = ? WHERE job_id = ?",
+            [(SEALED_ABANDONED_STATUS, now, job_id) for job_id in job_ids]
+        )
+        self._connection.executemany("DELETE FROM broker_waiters WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+        return len(job_ids)
+
+    def _claim(self, worker_id, max_running_per_chat, lease_timeout):
+        now = time.time()
+        # Job milik worker yang berhenti memperbarui lease diantrikan ulang (mempertahankan created_at/urutan);
+        # job sealed ditutup karena hasilnya sudah sedang dikirim
+        self._close_sealed("heartbeat_at < ?", (now - lease_timeout,))
+        self._connection.execute(
+            "UPDATE broker_jobs SET state = 'queued', worker_id = NULL, updated_at = ?"
+            " WHERE state = 'running' AND heartbeat_at < ?", (now, now - lease_timeout)
+        )
+        running_in_chat = (
+            "(SELECT COUNT(*) FROM broker_jobs r WHERE r.chat_id = j.chat_id AND r.state IN ('running', 'sealed'))"
+        )
+        row = self._connection.execute(
+            f"SELECT job_id, chat_id, urls, status_message_id FROM broker_jobs j"
+            f" WHERE state = 'queued' AND {running_in_chat} < ? ORDER BY {running_in_chat}, created_at LIMIT 1",
+            (max_running_per_chat,)
+        ).fetchone()
+        if row is None:
+            return None
+        job_id, chat_id, urls, status_message_id = row
+        self._connection.execute(
+            "UPDATE broker_jobs SET state = 'running', worker_id = ?, heartbeat_at = ?, updated_at = ? WHERE job_id = ?",
+            (worker_id, now, now, job_id)
+        )
+        return {"job_id": job_id, "chat_id": chat_id, "urls": json.loads(urls), "status_message_id": status_message_id,
+                "waiters": self._waiters(job_id)}
+
+    def _heartbeat(self, worker_id, status_texts):
+        now = time.time()
+        self._connection.executemany(
+            "UPDATE broker_jobs SET heartbeat_at = ?, status_text = COALESCE(?, status_text), updated_at = ?"
+            " WHERE job_id = ? AND worker_id = ?",
+            [(now, status_text, now, job_id, worker_id) for job_id, status_text in status_texts.items()]
+        )
+
+    def _seal(self, job_id):
+        self._connection.execute(
+            "UPDATE broker_jobs SET state = 'sealed', updated_at = ? WHERE job_id = ? AND state = 'running'", (time.time(), job_id)
+        )
+        return self._waiters(job_id)
+
+    def _finish(self, job_id, status_text):
+        now = time.time()
+        waiters = self._waiters(job_id)
+        self._connection.execute(
+            "UPDATE broker_jobs SET state = 'done', status_text = COALESCE(?, status_text), updated_at = ? WHERE job_id = ?",
+            (status_text, now, job_id)
+        )
+        self._connection.execute("DELETE FROM broker_waiters WHERE job_id = ?", (job_id,))
+        self._connection.execute("DELETE FROM broker_jobs WHERE state = 'done' AND updated_at < ?", (now - self.retention,))
+        return waiters
+
+    def _requeue(self, job_ids):
+        for job_id in job_ids:
+            self._close_sealed("job_id = ?", (job_id,))
+        self._connection.executemany(
+            "UPDATE broker_jobs SET state = 'queued', worker_id = NULL, updated_at = ? WHERE job_id = ? AND state = 'running'",
+            [(time.time(), job_id) for job_id in job_ids]
+        )
+
+    def _release_worker(self, worker_id):
+        self._close_sealed("worker_id = ?", (worker_id,))
+        return self._connection.execute(
+            "UPDATE broker_jobs SET state = 'queued', worker_id = NULL, updated_at = ?"
+            " WHERE worker_id = ? AND state = 'running'", (time.time(), worker_id)
+        ).rowcount
+
+    def _status(self, job_id):
+        row = self._connection.execute(
+            "SELECT chat_id, urls, state, worker_id, status_text, created_at, updated_at FROM broker_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        chat_id, urls, state, worker_id, status_text, created_at, updated_at = row
+        return {"job_id": job_id, "chat_id": chat_id, "urls": json.loads(urls), "state": state, "worker_id": worker_id,
+                "status_text": status_text, "created_at": created_at, "updated_at": updated_at}
+
+    async def enqueue(self, job_id, coalesce_key, chat_id, urls, status_message_id, max_jobs_per_chat, max_queue_size):
+        """
+        Mengantrikan job. Mengembalikan (posisi antrian, None) atau (None, pesan error) jika ditolak.
+        """
+        return await self._run(self._enqueue, job_id, coalesce_key, chat_id, urls, status_message_id, max_jobs_per_chat, max_queue_size)
+
+    async def join(self, coalesce_key, chat_id, status_message_id):
+        """
+        Menumpang ke job yang masih antri/berjalan dengan kunci yang sama. Mengembalikan job_id atau None.
+        """
+        return await self._run(self._join, coalesce_key, chat_id, status_message_id)
+
+    async def claim(self, worker_id, max_running_per_chat, lease_timeout):
+        return await self._run(self._claim, worker_id, max_running_per_chat, lease_timeout)
+
+    async def heartbeat(self, worker_id, status_texts):
+        await self._run(self._heartbeat, worker_id, status_texts)
+
+    async def waiters(self, job_id):
+        return await self._run(self._waiters, job_id)
+
+    async def seal(self, job_id):
+        """
+        Menutup job untuk waiter baru dan mengembalikan daftar waiter final.
+        """
+        return await self._run(self._seal, job_id)
+
+    async def finish(self, job_id, status_text=None):
+        return await self._run(self._finish, job_id, status_text)
+
+    async def requeue(self, job_ids):
+        await self._run(self._requeue, job_ids)
+
+    async def release_worker(self, worker_id):
+        return await self._run(self._release_worker, worker_id)
+
+    async def status(self, job_id):
+        return await self._run(self._status, job_id)
+
+
+class RedisJobBroker:
+    """
+    Broker di Redis (atau server yang kompatibel). Operasi multi-kunci dijalankan sebagai skrip Lua
+    agar atomik. Antrian FIFO; seperti SqliteJobBroker, claim mendahulukan chat dengan job berjalan paling
+    sedikit dan melewati chat yang sudah mencapai batas job berjalan. Kuota per chat diterapkan saat enqueue.
+    """
+    PREFIX = "ytbot:"
+    # Dipakai _CLAIM dan _REQUEUE: job sealed yang ditinggalkan worker ditutup seperti _FINISH, bukan diantrikan ulang
+    _CLOSE_SEALED = """
+        local function close_sealed(prefix, job_id, now, retention, status_text)
+            local key = prefix .. 'job:' .. job_id
+            redis.call('ZREM', prefix .. 'running', job_id)
+            redis.call('HSET', key, 'state', 'done', 'worker_id', '', 'status_text', status_text, 'updated_at', now)
+            redis.call('EXPIRE', key, retention)
+            redis.call('DEL', prefix .. 'waiters:' .. job_id)
+            redis.call('DECR', prefix .. 'chat_active:' .. redis.call('HGET', key, 'chat_id'))
+        end
+    """
+    _ENQUEUE = """
+        local prefix, job_id, chat_id = ARGV[1], ARGV[2], ARGV[3]
+        if tonumber(redis.call('GET', prefix .. 'chat_active:' .. chat_id) or '0') >= tonumber(ARGV[7]) then return -1 end
+        local queued = redis.call('LLEN', prefix .. 'queue')
+        if queued >= tonumber(ARGV[8]) then return -2 end
+        redis.call('HSET', prefix .. 'job:' .. job_id, 'chat_id', chat_id, 'urls', ARGV[4], 'status_message_id', ARGV[5],
+            'coalesce_key', ARGV[6], 'state', 'queued', 'created_at', ARGV[9], 'updated_at', ARGV[9])
+        redis.call('RPUSH', prefix .. 'queue', job_id)
+        redis.call('INCR', prefix .. 'chat_active:' .. chat_id)
+        if ARGV[6] ~= '' then redis.call('SET', prefix .. 'coalesce:' .. ARGV[6], job_id) end
+        return queued + 1
+    """
+    _JOIN = """
+        local prefix = ARGV[1]
+        local job_id = redis.call('GET', prefix .. 'coalesce:' .. ARGV[2])
+        if not job_id then return false end
+        local state = redis.call('HGET', prefix .. 'job:' .. job_id, 'state')
+        if state ~= 'queued' and state ~= 'running' then return false end
+        redis.call('RPUSH', prefix .. 'waiters:' .. job_id, ARGV[3] .. ':' .. ARGV[4])
+        return job_id
+    """
+    _CLAIM = _CLOSE_SEALED + """
+        local prefix, worker_id, now = ARGV[1], ARGV[2], tonumber(ARGV[3])
+        for _, expired in ipairs(redis.call('ZRANGEBYSCORE', prefix .. 'running', '-inf', now - tonumber(ARGV[4]))) do
+            if redis.call('HGET', prefix .. 'job:' .. expired, 'state') == 'sealed' then
+                close_sealed(prefix, expired, now, tonumber(ARGV[5]), ARGV[6])
+            else
+                redis.call('ZREM', prefix .. 'running', expired)
+                redis.call('HSET', prefix .. 'job:' .. expired, 'state', 'queued', 'worker_id', '', 'updated_at', now)
+                redis.call('LPUSH', prefix .. 'queue', expired)
+            end
+        end
+        local running_in_chat = {}
+        for _, running_id in ipairs(redis.call('ZRANGE', prefix .. 'running', 0, -1)) do
+            local running_chat = redis.call('HGET', prefix .. 'job:' .. running_id, 'chat_id')
+            if running_chat then running_in_chat[running_chat] = (running_in_chat[running_chat] or 0) + 1 end
+        end
+        -- Chat dengan job berjalan paling sedikit didahulukan, lalu urutan antrian
+        local max_running, job_id, fewest = tonumber(ARGV[7]), nil, nil
+        for _, queued_id in ipairs(redis.call('LRANGE', prefix .. 'queue', 0, -1)) do
+            local running = running_in_chat[redis.call('HGET', prefix .. 'job:' .. queued_id, 'chat_id')] or 0
+            if running < max_running and (fewest == nil or running < fewest) then
+                job_id, fewest = queued_id, running
+                if running == 0 then break end
+            end
+        end
+        if not job_id then return false end
+        redis.call('LREM', prefix .. 'queue', 1, job_id)
+        local key = prefix .. 'job:' .. job_id
+        redis.call('HSET', key, 'state', 'running', 'worker_id', worker_id, 'heartbeat_at', now, 'updated_at', now)
+        redis.call('ZADD', prefix .. 'running', now, job_id)
+        return {job_id, redis.call('HGET', key, 'chat_id'), redis.call('HGET', key, 'urls'),
+            redis.call('HGET', key, 'status_message_id'), redis.call('LRANGE', prefix .. 'waiters:' .. job_id, 0, -1)}
+    """
+    _HEARTBEAT = """
+        local prefix, worker_id, now = ARGV[1], ARGV[2], ARGV[3]
+        for index = 4, #ARGV, 2 do
+            local key = prefix .. 'job:' .. ARGV[index]
+            if redis.call('HGET', key, 'worker_id') == worker_id then
+                redis.call('ZADD', prefix .. 'running', now, ARGV[index])
+                redis.call('HSET', key, 'heartbeat_at', now, 'updated_at', now)
+                if ARGV[index + 1] ~= '' then redis.call('HSET', key, 'status_text', ARGV[index + 1]) end
+            end
+        end
+        return 0
+    """
+    _SEAL = """
+        local prefix, job_id = ARGV[1], ARGV[2]
+        local key = prefix .. 'job:' .. job_id
+        if redis.call('HGET', key, 'state') == 'running' then
+            redis.call('HSET', key, 'state', 'sealed', 'updated_at', ARGV[3])
+            local coalesce_key = redis.call('HGET', key, 'coalesce_key')
+            if coalesce_key and coalesce_key ~= '' and redis.call('GET', prefix .. 'coalesce:' .. coalesce_key) == job_id then
+                redis.call('DEL', prefix .. 'coalesce:' .. coalesce_key)
+            end
+        end
+        return redis.call('LRANGE', prefix .. 'waiters:' .. job_id, 0, -1)
+    """
+    _FINISH = """
+        local prefix, job_id = ARGV[1], ARGV[2]
+        local key = prefix .. 'job:' .. job_id
+        local waiters = redis.call('LRANGE', prefix .. 'waiters:' .. job_id, 0, -1)
+        local state = redis.call('HGET', key, 'state')
+        if not state or state == 'done' then return waiters end
+        redis.call('HSET', key, 'state', 'done', 'updated_at', ARGV[3])
+        if ARGV[4] ~= '' then redis.call('HSET', key, 'status_text', ARGV[4]) end
+        redis.call('EXPIRE', key, tonumber(ARGV[5]))
+        redis.call('ZREM', prefix .. 'running', job_id)
+        redis.call('LREM', prefix .. 'queue', 0, job_id)
+        redis.call('DEL', prefix .. 'waiters:' .. job_id)
+        redis.call('DECR', prefix .. 'chat_active:' .. redis.call('HGET', key, 'chat_id'))
+        local coalesce_key = redis.call('HGET', key, 'coalesce_key')
+        if coalesce_key and coalesce_key ~= '' and redis.call('GET', prefix .. 'coalesce:' .. coalesce_key) == job_id then
+            redis.call('DEL', prefix .. 'coalesce:' .. coalesce_key)
+        end
+        return waiters
+    """
+    _REQUEUE = _CLOSE_SEALED + """
+        local prefix, worker_id, count = ARGV[1], ARGV[2], 0
+        for index = 6, #ARGV do
+            local key = prefix .. 'job:' .. ARGV[index]
+            local state = redis.call('HGET', key, 'state')
+            if (state == 'running' or state == 'sealed') and (worker_id == '' or redis.call('HGET', key, 'worker_id') == worker_id) then
+                if state == 'sealed' then
+                    close_sealed(prefix, ARGV[index], ARGV[3], tonumber(ARGV[4]), ARGV[5])
+                else
+                    redis.call('ZREM', prefix .. 'running', ARGV[index])
+                    redis.call('HSET', key, 'state', 'queued', 'worker_id', '', 'updated_at', ARGV[3])
+                    redis.call('LPUSH', prefix .. 'queue', ARGV[index])
+                    count = count + 1
+                end
+            end
+        end
+        return count
+    """
+
+    def __init__(self, url, retention):
+        self.url = url
+        self.retention = retention
+        self._redis = None
+        self._scripts = {}
+
+    @property
+    def connected(self):
+        return self._redis is not None
+
+    async def open(self):
+        import redis.asyncio as redis_asyncio # Opsional: hanya dibutuhkan jika BROKER_URL=redis://
+        self._redis = redis_asyncio.from_url(self.url, decode_responses=True)
+        await self._redis.ping()
+        for name in ("_ENQUEUE", "_JOIN", "_CLAIM", "_HEARTBEAT", "_SEAL", "_FINISH", "_REQUEUE"):
+            self._scripts[name] = self._redis.register_script(getattr(self, name))
+        logging.info(f"Broker Redis terhubung: {self.url}")
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    async def _call(self, name, *args):
+        return await self._scripts[name](args=[self.PREFIX, *args])
+
+    @staticmethod
+    def _parse_waiters(entries):
+        waiters = []
+        for entry in entries or []:
+            chat_id, status_message_id = entry.rsplit(":", 1)
+            waiters.append((int(chat_id), int(status_message_id)))
+        return list(dict.fromkeys(waiters))
+
+    async def enqueue(self, job_id, coalesce_key, chat_id, urls, status_message_id, max_jobs_per_chat, max_queue_size):
+        result = await self._call(
+            "_ENQUEUE", job_id, chat_id, json.dumps(urls), status_message_id or "", coalesce_key or "",
+            max_jobs_per_chat, max_queue_size, time.time()
+        )
+        if result == -1:
+            return None, f"Anda sudah memiliki {max_jobs_per_chat} unduhan yang antri/berjalan. Tunggu hingga selesai."
+        if result == -2:
+            return None, "Antrian unduhan sedang penuh. Silakan coba lagi nanti."
+        return result, None
+
+    async def join(self, coalesce_key, chat_id, status_message_id):
+        return await self._call("_JOIN", coalesce_key, chat_id, status_message_id) or None
+
+    async def claim(self, worker_id, max_running_per_chat, lease_timeout):
+        result = await self._call("_CLAIM", worker_id, time.time(), lease_timeout, self.retention, SEALED_ABANDONED_STATUS, max_running_per_chat)
+        if not result:
+            return None
+        job_id, chat_id, urls, status_message_id, waiters = result
+        return {"job_id": job_id, "chat_id": int(chat_id), "urls": json.loads(urls),
+                "status_message_id": int(status_message_id) if status_message_id else None,
+                "waiters": self._parse_waiters(waiters)}
+
+    async def heartbeat(self, worker_id, status_texts):
+        arguments = []
+        for job_id, status_text in status_texts.items():
+            arguments.extend([job_id, status_text or ""])
+        if arguments:
+            await self._call("_HEARTBEAT", worker_id, time.time(), *arguments)
+
+    async def waiters(self, job_id):
+        return self._parse_waiters(await self._redis.lrange(f"{self.PREFIX}waiters:{job_id}", 0, -1))
+
+    async def seal(self, job_id):
+        return self._parse_waiters(await self._call("_SEAL", job_id, time.time()))
+
+    async def finish(self, job_id, status_text=None):
+        return self._parse_waiters(await self._call("_FINISH", job_id, time.time(), status_text or "", self.retention))
+
+    async def requeue(self, job_ids):
+        if job_ids:
+            await self._call("_REQUEUE", "", time.time(), self.retention, SEALED_ABANDONED_STATUS, *job_ids)
+
+    async def release_worker(self, worker_id):
+        job_ids = await self._redis.zrange(f"{self.PREFIX}running", 0, -1)
+        if not job_ids:
+            return 0
+        return await self._call("_REQUEUE", worker_id, time.time(), self.retention, SEALED_ABANDONED_STATUS, *job_ids)
+
+    async def status(self, job_id):
+        fields = await self._redis.hgetall(f"{self.PREFIX}job:{job_id}")
+        if not fields:
+            return None
+        return {"job_id": job_id, "chat_id": int(fields["chat_id"]), "urls": json.loads(fields["urls"]),
+                "state": fields.get("state"), "worker_id": fields.get("worker_id") or None,
+                "status_text": fields.get("status_text"), "created_at": float(fields["created_at"]),
+                "updated_at": float(fields.get("updated_at") or fields["created_at"])}
+
+
+def create_job_broker(url):
+    """
+    Membuat broker sesuai skema BROKER_URL (sqlite:///path atau redis://...).
+    """
+    if url.startswith("sqlite:///"):
+        return SqliteJobBroker(url[len("sqlite:///"):], JOB_JOURNAL_RETENTION)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobBroker(url, JOB_JOURNAL_RETENTION)
+    raise ValueError(f"Skema BROKER_URL tidak dikenal: {url}")
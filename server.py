@@ -1,5 +1,13 @@
+import os
 import sys
 from gunicorn.app.wsgiapp import run
 if __name__ == '__main__':
-    sys.argv = "gunicorn --bind 0.0.0.0:5151 app:app".split()
+    # Gateway HTTP bot (app.py): aiohttp Application, jadi worker gunicorn harus worker async aiohttp
+    sys.argv = [
+        "gunicorn",
+        "--bind", f"0.0.0.0:{os.environ.get('GATEWAY_PORT', '5151')}",
+        "--workers", os.environ.get("GATEWAY_WORKERS", "2"),
+        "--worker-class", "aiohttp.GunicornWebWorker",
+        "app:app",
+    ]
     sys.exit(run())
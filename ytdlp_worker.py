@@ -0,0 +1,145 @@
+import os
+import time
+import collections
+import multiprocessing
+from multiprocessing import spawn
+
+# Titik masuk proses worker engine yt-dlp in-process (YtdlpEnginePool di bot.py).
+# Modul ini sengaja ringan: proses worker hanya mengimpor modul ini dan yt_dlp, bukan bot.py
+# (konfigurasi env, sys.exit, direktori, Client Pyrogram, handler logging/trace).
+
+
+# --- Konteks Multiprocessing ---
+_get_preparation_data = spawn.get_preparation_data
+
+
+def _preparation_data_without_main(name):
+    # Dengan spawn/forkserver, anak mengimpor ulang skrip utama induk (bot.py) sebagai __mp_main__
+    # sebelum menjalankan apa pun. Worker pool tidak butuh apa pun dari __main__: fungsi yang dijalankan
+    # ada di modul ini dan di concurrent.futures, jadi langkah itu dilewati.
+    data = _get_preparation_data(name)
+    data.pop("init_main_from_name", None)
+    data.pop("init_main_from_path", None)
+    return data
+
+
+def spawn_context():
+    """
+    Konteks spawn untuk ProcessPoolExecutor worker yt-dlp. Proses anak tidak mengeksekusi ulang bot.py.
+    Berlaku untuk semua proses spawn dari proses ini; bot.py tidak memakai multiprocessing untuk hal lain.
+    """
+    spawn.get_preparation_data = _preparation_data_without_main
+    return multiprocessing.get_context("spawn")
+
+
+# --- Fungsi Proses Worker ---
+# Diisi oleh init() di setiap proses worker
+_progress_queue = None
+_settings = {}
+
+
+def init(progress_queue, settings):
+    """
+    Initializer proses worker: simpan antrian progres dan pengaturan dari bot.py, lalu panaskan
+    import yt_dlp + extractor. settings: result_fields, progress_fields, progress_interval, error_tail_lines.
+    """
+    global _progress_queue, _settings
+    _progress_queue = progress_queue
+    _settings = settings
+    import yt_dlp
+    # Membuat YoutubeDL memuat semua kelas extractor sekali di sini, bukan di job pertama
+    yt_dlp.YoutubeDL({"quiet": True})
+
+
+def ping():
+    return os.getpid()
+
+
+def download(job_key, url, options, info_path=None):
+    """
+    Dijalankan di proses worker. Mengunduh URL dengan YoutubeDL API.
+    Mengembalikan (hasil after_move, baris error, gagal?).
+    """
+    import yt_dlp
+    from yt_dlp.postprocessor import PostProcessor
+
+    results = []
+    error_lines = collections.deque(maxlen=_settings["error_tail_lines"])
+    result_fields = _settings["result_fields"].split(",")
+    last_progress_sent_at = [0.0]
+
+    class ResultCollector(PostProcessor):
+        # Setara dengan --print after_move:... di engine subprocess
+        def run(self, info):
+            results.append({key: info.get(key) for key in result_fields if info.get(key) is not None})
+            return [], info
+
+    class ErrorLogger:
+        def debug(self, msg):
+            pass
+
+        def info(self, msg):
+            pass
+
+        def warning(self, msg):
+            pass
+
+        def error(self, msg):
+            error_lines.append(msg)
+
+    def progress_hook(data):
+        # Hook dipanggil per chunk; progres "downloading" dikirim ke proses utama paling sering sekali
+        # per progress_interval detik agar antrian IPC tidak dibanjiri
+        now = time.monotonic()
+        if data.get("status") == "downloading" and now - last_progress_sent_at[0] < _settings["progress_interval"]:
+            return
+        last_progress_sent_at[0] = now
+        _progress_queue.put((job_key, {key: data.get(key) for key in _settings["progress_fields"]}))
+
+    ydl_options = dict(options, logger=ErrorLogger(), progress_hooks=[progress_hook])
+    try:
+        with yt_dlp.YoutubeDL(ydl_options) as ydl:
+            ydl.add_post_processor(ResultCollector(ydl), when="after_move")
+            if info_path:
+                # Setara --load-info-json: pakai metadata probe, ekstraksi ulang hanya jika URL stream kedaluwarsa
+                retcode = ydl.download_with_info_file(info_path)
+            else:
+                retcode = ydl.download([url])
+    except Exception as e:
+        error_lines.append(str(e))
+        retcode = 1
+    finally:
+        # Penanda akhir progres job: proses utama membaca antrian sampai penanda ini sebelum memakai
+        # hasil, sehingga progres terakhir (termasuk "finished") tidak tertinggal di antrian
+        _progress_queue.put((job_key, None))
+    return results, list(error_lines), retcode != 0
+
+
+def probe(url, options):
+    """
+    Dijalankan di proses worker. Setara yt-dlp -J --no-playlist --flat-playlist.
+    """
+    import yt_dlp
+
+    error_lines = []
+
+    class ErrorLogger:
+        def debug(self, msg):
+            pass
+
+        def info(self, msg):
+            pass
+
+        def warning(self, msg):
+            pass
+
+        def error(self, msg):
+            error_lines.append(msg)
+
+    probe_options = dict(options, logger=ErrorLogger(), noplaylist=True, extract_flat="in_playlist", ignoreerrors=False)
+    try:
+        with yt_dlp.YoutubeDL(probe_options) as ydl:
+            info = ydl.extract_info(url, download=False, process=True)
+            return ydl.sanitize_info(info), None
+    except Exception as e:
+        return None, "\n".join(error_lines) or str(e)